@@ -0,0 +1,252 @@
+"""Admission control for git-http-backend processes shared across workers
+
+git4nginx tools for using git via http(s) with Nginx
+Copyright (C) 2019  Glen Pitt-Pladdy
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+Limits how many upload-pack and receive-pack backends run at once on the
+host, in total, per service and per repo. Requests over the limits queue
+and are granted slots as others finish: pushes first, then users with the
+fewest running requests, then in order of arrival. Requests that can't be
+granted a slot within max_wait are refused so clients can retry later.
+
+All workers share a small state file under an exclusive lock. Whichever
+process holds the lock schedules all waiting requests, so waiters only
+need to check whether they have been granted. Entries belonging to
+processes that have exited are dropped so slots are never lost.
+"""
+
+import os
+import json
+import time
+import fcntl
+import random
+import logging
+import threading
+import collections
+import metrics
+
+
+SERVICES = ['git-upload-pack', 'git-receive-pack']
+# lower runs first
+PRIORITY = {'git-receive-pack': 0, 'git-upload-pack': 1}
+POLL_INTERVAL = 0.05
+
+
+
+class Scheduler(object):
+    """Concurrency limits and queueing for backend processes on this host
+    """
+    def __init__(self, path, limits=None, repo_limits=None, max_wait=30.0, retry_after=10):
+        """Setup
+
+        :arg path: str, directory shared by all workers
+        :arg limits: dict|None, maximum running for each service and/or 'total'
+        :arg repo_limits: dict|None, maximum running in a single repo for each service
+        :arg max_wait: float, seconds a request may queue before it is refused
+        :arg retry_after: int, seconds clients are told to wait before retrying
+        """
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self._state_path = os.path.join(path, 'state.json')
+        self.limits = limits or {}
+        self.repo_limits = repo_limits or {}
+        self.max_wait = max_wait
+        self.retry_after = retry_after
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    def _new_id(self):
+        """Unique id for a request on this host
+
+        :return: str
+        """
+        with self._lock:
+            self._sequence += 1
+            return '{}_{}_{}'.format(os.getpid(), time.time_ns(), self._sequence)
+
+    def _update(self, change=None):
+        """Modify the shared state under lock, scheduling waiting requests
+
+        :arg change: callable|None, passed the state to modify
+        :return: dict, state after scheduling
+        """
+        with open(self._state_path, 'a+') as f_state:
+            fcntl.flock(f_state, fcntl.LOCK_EX)
+            f_state.seek(0)
+            content = f_state.read()
+            try:
+                state = json.loads(content) if content else {}
+            except ValueError as exc:
+                logging.error("Admission state corrupt, resetting: %s", exc)
+                state = {}
+            state.setdefault('active', [])
+            state.setdefault('waiting', [])
+            for kind in ['active', 'waiting']:
+                state[kind] = [entry for entry in state[kind] if metrics.pid_alive(entry['pid'])]
+            if change is not None:
+                change(state)
+            self._schedule(state)
+            f_state.seek(0)
+            f_state.truncate()
+            f_state.write(json.dumps(state))
+        return state
+
+    def _schedule(self, state):
+        """Move waiting requests that fit within the limits to active
+
+        :arg state: dict, shared state
+        """
+        running = collections.Counter()
+        users = collections.Counter()
+        for entry in state['active']:
+            running['total'] += 1
+            running[entry['service']] += 1
+            running[(entry['repo'], entry['service'])] += 1
+            users[entry['user']] += 1
+        waiting = []
+        for entry in sorted(state['waiting'], key=lambda entry: (entry['priority'], users[entry['user']], entry['enqueued'])):
+            if (
+                    running['total'] >= self.limits.get('total', float('inf'))
+                    or running[entry['service']] >= self.limits.get(entry['service'], float('inf'))
+                    or running[(entry['repo'], entry['service'])] >= self.repo_limits.get(entry['service'], float('inf'))
+            ):
+                waiting.append(entry)
+                continue
+            state['active'].append(entry)
+            running['total'] += 1
+            running[entry['service']] += 1
+            running[(entry['repo'], entry['service'])] += 1
+            users[entry['user']] += 1
+        state['waiting'] = waiting
+
+    def enqueue(self, repo, service, user):
+        """Queue a request, granting it a slot straight away if possible
+
+        :arg repo: str, repo path
+        :arg service: str, git-upload-pack or git-receive-pack
+        :arg user: str, authenticated user
+        :return: tuple of:
+            request id, str - for granted(), cancel() and release()
+            granted, bool
+        """
+        entry = {
+            'id': self._new_id(),
+            'pid': os.getpid(),
+            'repo': repo,
+            'service': service,
+            'user': user,
+            'priority': PRIORITY.get(service, len(PRIORITY)),
+            'enqueued': time.time(),
+        }
+        state = self._update(lambda state: state['waiting'].append(entry))
+        return entry['id'], is_active(state, entry['id'])
+
+    def granted(self, request_id):
+        """Check if a queued request now has a slot
+
+        :arg request_id: str, from enqueue()
+        :return: bool
+        """
+        return is_active(self._update(), request_id)
+
+    def cancel(self, request_id):
+        """Give up waiting, unless the slot was granted meanwhile
+
+        :arg request_id: str, from enqueue()
+        :return: bool, True if the request was granted and must be released
+        """
+        def change(state):
+            """Remove from the queue"""
+            state['waiting'] = [entry for entry in state['waiting'] if entry['id'] != request_id]
+        return is_active(self._update(change), request_id)
+
+    def release(self, request_id):
+        """Free the slot held by a request so waiting requests can run
+
+        :arg request_id: str, from enqueue()
+        """
+        def change(state):
+            """Remove from running"""
+            state['active'] = [entry for entry in state['active'] if entry['id'] != request_id]
+        self._update(change)
+
+    def check(self, request_id, deadline):
+        """One step of waiting for a slot
+
+        :arg request_id: str, from enqueue()
+        :arg deadline: float, time.monotonic() to give up at
+        :return: bool|None, True if granted, False to keep waiting or None if refused
+        """
+        if time.monotonic() < deadline:
+            return self.granted(request_id)
+        if self.cancel(request_id):
+            return True
+        return None
+
+    def abandon(self, request_id):
+        """Drop a request whether waiting or granted (eg. client went away)
+
+        :arg request_id: str, from enqueue()
+        """
+        if self.cancel(request_id):
+            self.release(request_id)
+
+    def acquire(self, repo, service, user):
+        """Wait for a slot, up to max_wait
+
+        :arg repo: str, repo path
+        :arg service: str, git-upload-pack or git-receive-pack
+        :arg user: str, authenticated user
+        :return: str|None, request id to release(), or None if refused
+        """
+        deadline = time.monotonic() + self.max_wait
+        request_id, granted = self.enqueue(repo, service, user)
+        try:
+            while granted is False:
+                time.sleep(poll_delay())
+                granted = self.check(request_id, deadline)
+        except BaseException:
+            self.abandon(request_id)
+            raise
+        return request_id if granted else None
+
+    def status(self):
+        """Running and queued requests
+
+        :return: dict, running, waiting counts
+        """
+        state = self._update()
+        return {'running': len(state['active']), 'waiting': len(state['waiting'])}
+
+
+
+def poll_delay():
+    """Time between checks while waiting, with jitter so waiters don't contend for the lock in step
+
+    :return: float, seconds
+    """
+    return POLL_INTERVAL * random.uniform(0.5, 1.5)
+
+
+def is_active(state, request_id):
+    """Check if a request has a slot
+
+    :arg state: dict, shared state
+    :arg request_id: str
+    :return: bool
+    """
+    return any(entry['id'] == request_id for entry in state['active'])
@@ -0,0 +1,301 @@
+"""Authenticate against a htpasswd file, then lookup the groups and other info
+
+git4nginx tools for using git via http(s) with Nginx
+Copyright (C) 2019  Glen Pitt-Pladdy
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+Supports bcrypt ($2y$ etc.) and SHA-crypt ($5$, $6$) password hashes,
+eg. created with: htpasswd -B
+Each is verified with the first available of:
+    bcrypt      bcrypt module, passlib, crypt module (if the system crypt has it)
+    SHA-crypt   crypt module (removed in Python 3.13), passlib
+If the htpasswd file has entries that can't be verified here the plugin
+refuses to load, eg. on Python 3.13+ without passlib for SHA-crypt.
+
+Verifying a hash is deliberately slow so successful verifications are kept
+in a bounded LRU cache for a limited time (clients issue several requests
+for each fetch/push). Config:
+    htpasswd: str, path to htpasswd file
+    cache_size: int, optional number of verified credentials to cache, default 1024
+    cache_ttl: int, optional seconds to cache verified credentials, default 300
+    users: dict, optional groups and info for users as per lookup_groups
+"""
+
+import os
+import time
+import hmac
+import hashlib
+import threading
+import collections
+try:
+    import bcrypt
+except ImportError:
+    bcrypt = None
+try:
+    import crypt
+except ImportError:
+    # removed in Python 3.13
+    crypt = None
+try:
+    import passlib.hash
+except ImportError:
+    passlib = None
+
+
+
+def verify_bcrypt(password, password_hash):
+    """Check a password with the bcrypt module
+
+    :arg password: str
+    :arg password_hash: str, bcrypt hash
+    :return: bool, True if password matches
+    """
+    # bcrypt module only understands $2b$, $2y$ is the same algorithm
+    return bcrypt.checkpw(password.encode('utf-8'), ('$2b$' + password_hash[4:]).encode('ascii'))
+
+
+def verify_crypt(password, password_hash):
+    """Check a password with the system crypt()
+
+    :arg password: str
+    :arg password_hash: str, hash in a format the system supports
+    :return: bool, True if password matches
+    """
+    return hmac.compare_digest(crypt.crypt(password, password_hash) or '', password_hash)
+
+
+def verify_passlib(password, password_hash):
+    """Check a password with passlib
+
+    :arg password: str
+    :arg password_hash: str, bcrypt or SHA-crypt hash
+    :return: bool, True if password matches
+    """
+    if password_hash.startswith('$2'):
+        return passlib.hash.bcrypt.verify(password, password_hash)
+    if password_hash.startswith('$5$'):
+        return passlib.hash.sha256_crypt.verify(password, password_hash)
+    return passlib.hash.sha512_crypt.verify(password, password_hash)
+
+
+def hash_scheme(password_hash):
+    """Scheme of a htpasswd hash
+
+    :arg password_hash: str
+    :return: str|None, bcrypt, SHA-crypt or None if not supported
+    """
+    if password_hash.startswith(('$2a$', '$2b$', '$2y$')):
+        return 'bcrypt'
+    if password_hash.startswith(('$5$', '$6$')):
+        return 'SHA-crypt'
+    return None
+
+
+# scheme: function(password, password_hash), first available
+VERIFIERS = {}
+if bcrypt is not None:
+    VERIFIERS['bcrypt'] = verify_bcrypt
+elif passlib is not None and passlib.hash.bcrypt.has_backend():
+    VERIFIERS['bcrypt'] = verify_passlib
+elif crypt is not None and crypt.METHOD_BLOWFISH in crypt.methods:
+    VERIFIERS['bcrypt'] = verify_crypt
+if crypt is not None:
+    VERIFIERS['SHA-crypt'] = verify_crypt
+elif passlib is not None:
+    VERIFIERS['SHA-crypt'] = verify_passlib
+# what to install for a scheme
+REQUIRES = {
+    'bcrypt': "bcrypt or passlib module",
+    'SHA-crypt': "crypt module (Python < 3.13) or passlib module",
+}
+
+
+class HtpasswdCache(object):
+    """htpasswd file contents and recently verified credentials
+    """
+    def __init__(self, cache_size=1024, cache_ttl=300):
+        """Setup
+
+        :arg cache_size: int, maximum verified credentials to keep
+        :arg cache_ttl: int|float, seconds to keep verified credentials
+        """
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.path = None
+        self.mtime = None
+        self.entries = {}
+        self.verified = collections.OrderedDict()
+        # credentials are only kept as keyed hashes, key is only in memory
+        self._key = os.urandom(32)
+        self._lock = threading.Lock()
+
+    def _load(self, logger, path):
+        """(Re)read the htpasswd file if changed
+
+        :arg logger:
+        :arg path: str, path to htpasswd file
+        """
+        mtime = os.stat(path).st_mtime_ns
+        if path == self.path and mtime == self.mtime:
+            return
+        entries = {}
+        with open(path, 'rt') as f_htpasswd:
+            for line in f_htpasswd:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                if ':' not in line:
+                    logger.warning("Ignoring invalid htpasswd line in: %s", path)
+                    continue
+                username, password_hash = line.split(':', 1)
+                entries[username] = password_hash
+        logger.info("Loaded %d htpasswd entries from: %s", len(entries), path)
+        unsupported = [username for username, password_hash in entries.items() if hash_scheme(password_hash) is None]
+        if unsupported:
+            logger.warning("Unsupported hash type (use bcrypt or SHA-crypt) for users: %s", ', '.join(sorted(unsupported)))
+        for scheme in missing_schemes(entries):
+            logger.critical("%s htpasswd entries require the %s", scheme, REQUIRES[scheme])
+        self.entries = entries
+        self.path = path
+        self.mtime = mtime
+
+    def _credential(self, username, password):
+        """Keyed hash identifying the credentials for the cache
+        """
+        return hmac.new(self._key, '{}\0{}'.format(username, password).encode('utf-8'), hashlib.sha256).digest()
+
+    @staticmethod
+    def _verify(logger, password, password_hash):
+        """Check a password against a hash (slow)
+
+        :return: bool, True if password matches
+        """
+        scheme = hash_scheme(password_hash)
+        if scheme is None:
+            logger.error("Unsupported htpasswd hash type (use bcrypt or SHA-crypt)")
+            return False
+        if scheme not in VERIFIERS:
+            logger.critical("%s htpasswd entries require the %s", scheme, REQUIRES[scheme])
+            return False
+        try:
+            return VERIFIERS[scheme](password, password_hash)
+        except ValueError as exc:
+            logger.error("Invalid %s htpasswd entry: %s", scheme, exc)
+            return False
+
+    def check(self, logger, path, username, password):
+        """Check credentials
+
+        :arg logger:
+        :arg path: str, path to htpasswd file
+        :arg username: str, username client is authenticating with
+        :arg password: str, password client is authanticating with
+        :return: bool, True if credentials are valid
+        """
+        with self._lock:
+            self._load(logger, path)
+            password_hash = self.entries.get(username)
+            if password_hash is None:
+                logger.warning("Username not found in htpasswd: %s", username)
+                return False
+            credential = self._credential(username, password)
+            if credential in self.verified:
+                verified_hash, expires = self.verified[credential]
+                if verified_hash == password_hash and expires > time.monotonic():
+                    self.verified.move_to_end(credential)
+                    return True
+                del self.verified[credential]
+        # slow part outside the lock
+        if not self._verify(logger, password, password_hash):
+            return False
+        with self._lock:
+            self.verified[credential] = (password_hash, time.monotonic() + self.cache_ttl)
+            while len(self.verified) > self.cache_size:
+                self.verified.popitem(last=False)
+        return True
+
+
+_cache = HtpasswdCache()
+
+
+def missing_schemes(entries):
+    """Supported schemes used by htpasswd entries that can't be verified without another module
+
+    :arg entries: dict, username: password hash
+    :return: list of str, schemes
+    """
+    return sorted(set(map(hash_scheme, entries.values())) - set(VERIFIERS) - {None})
+
+
+def init(logger, auth_config):
+    """Setup cache for the config (called by plugin registry)
+
+    :arg logger:
+    :arg auth_config: dict, authentication config for plugin
+    :raises RuntimeError: if htpasswd entries use a scheme that can't be verified here
+    """
+    global _cache   # pylint: disable=global-statement,invalid-name
+    cache = HtpasswdCache(
+        auth_config.get('cache_size', 1024),
+        auth_config.get('cache_ttl', 300),
+    )
+    # read now so missing modules are found at load rather than on login
+    cache._load(logger, auth_config['htpasswd'])     # pylint: disable=protected-access
+    missing = missing_schemes(cache.entries)
+    if missing:
+        raise RuntimeError("htpasswd entries can't be verified, install the {}".format(
+            ', '.join(REQUIRES[scheme] for scheme in missing)
+        ))
+    _cache = cache
+    logger.info("htpasswd cache: %d entries for %d seconds", _cache.cache_size, _cache.cache_ttl)
+
+
+def teardown(logger):
+    """Forget verified credentials (called by plugin registry)
+
+    :arg logger:
+    """
+    logger.info("Clearing htpasswd cache")
+    _cache.verified.clear()
+
+
+def authenticate(logger, auth_config, username, password):
+    """Check password against htpasswd and lookup the groups and other info
+
+    :arg logger:
+    :arg auth_config: dict, authentication config for plugin
+    :arg username: str, username client is authenticating with
+    :arg password: str|None, password client is authanticating with
+        IMPORTANT: this plugin requires the password so authentication must
+        not be performed upstream.
+    :return: tuple of:
+        authenticated: bool, if the user is successfully authenticated
+        groups: list, groups user has membership of
+        info: dict, additional info exposed to hooks
+    """
+    # sanity check
+    if password is None:
+        logger.critical("Authentication plugin requires the password - upstream authentication must not be configured")
+        return False, [], {}
+    try:
+        if not _cache.check(logger, auth_config['htpasswd'], username, password):
+            return False, [], {}
+    except OSError as exc:
+        logger.critical("Unable to read htpasswd file: %s", exc)
+        return False, [], {}
+    # lookup groups and info
+    user = auth_config.get('users', {}).get(username) or {}
+    return True, user.get('groups', []), user.get('info', {})
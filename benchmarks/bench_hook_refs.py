@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""Benchmark hook checks as the number of refs pushed grows
+
+Builds a repo with a chain of commits, then times the branch_flow plugin
+checking a push of new and updated flow branches (refs/heads/rN/master with
+upstream test), against the per-ref rev-list old^..upstream it used before.
+
+Usage: bench_hook_refs.py [--refs 10,100,1000] [--commits 1000]
+"""
+
+
+import os
+import sys
+import time
+import logging
+import argparse
+import tempfile
+import subprocess
+sys.path.append(os.path.realpath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')))
+sys.path.append(os.path.realpath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'hooks', 'pre_receive_plugins')))
+import hook_helper
+from hook_helper import push_context
+import branch_flow
+
+
+
+EMPTY_TREE = '4b825dc642cb6eb9a060e54bf8d69288fbee4904'
+GIT_ENV = dict(
+    os.environ,
+    GIT_AUTHOR_NAME='Bench', GIT_AUTHOR_EMAIL='bench@example.com',
+    GIT_COMMITTER_NAME='Bench', GIT_COMMITTER_EMAIL='bench@example.com',
+)
+
+
+
+def build_repo(repo, commits):
+    """Create a bare repo with a linear history, test (the upstream) at the tip
+
+    :arg repo: str, path for the repo
+    :arg commits: int, length of history
+    :return: list, oids oldest first
+    """
+    subprocess.check_call(['git', 'init', '-q', '--bare', repo])
+    oids = []
+    for number in range(commits):
+        command = ['git', '--git-dir', repo, 'commit-tree', '-m', str(number), EMPTY_TREE]
+        if oids:
+            command += ['-p', oids[-1]]
+        oids.append(subprocess.check_output(command, env=GIT_ENV).decode('ascii').strip())
+    subprocess.check_call(['git', '--git-dir', repo, 'update-ref', 'refs/heads/test', oids[-1]])
+    return oids
+
+
+def references(oids, refs, kind):
+    """Ref updates of a push to flow branches, all allowed
+
+    :arg oids: list, commits oldest first
+    :arg refs: int, number of refs
+    :arg kind: str, create or update
+    :return: list of [old, new, ref]
+    """
+    if kind == 'create':
+        return [[push_context.ZERO, oids[number], 'refs/heads/r{}/master'.format(number)] for number in range(refs)]
+    # from a commit with a parent
+    return [[oids[number + 1], oids[number + 2], 'refs/heads/r{}/master'.format(number)] for number in range(refs)]
+
+
+def per_ref(repo, updates):
+    """Check each update with rev-list old^..upstream (as branch_flow did before)
+
+    :return: int, updates allowed
+    """
+    gitwrapper = hook_helper.GitWrapper(repo)
+    allowed = 0
+    try:
+        for old, new, _ in updates:
+            revisions = gitwrapper.get_revisions([old, 'test'])
+            if new in (revisions[:-1] if old != gitwrapper.zero else revisions):
+                allowed += 1
+    finally:
+        gitwrapper.close()
+    return allowed
+
+
+def plugin(repo, updates):
+    """Check the push with branch_flow, as the pre-receive hook does
+
+    :return: int, updates allowed
+    """
+    gitwrapper = hook_helper.GitWrapper(repo)
+    try:
+        context = push_context.PushContext(['hooks/pre-receive'], updates, gitwrapper, 'user0', set(), {}, None, 'bench.git')
+        rejected = branch_flow.Plugin({'flow': ['test', 'master']}, {}).check(context)
+    finally:
+        gitwrapper.close()
+    return len(updates) - len(rejected)
+
+
+def main(argv):
+    """Run the benchmark
+
+    :arg argv: list, command line arguments
+    """
+    parser = argparse.ArgumentParser(description="Benchmark hook checks against refs pushed")
+    parser.add_argument('--refs', default='10,100,1000', help="comma separated numbers of refs")
+    parser.add_argument('--commits', type=int, default=1000, help="commits in the repo")
+    args = parser.parse_args(argv[1:])
+    ref_counts = [int(refs) for refs in args.refs.split(',')]
+    # the plugin logs every ref
+    logging.getLogger().setLevel(logging.WARNING)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        repo = os.path.join(temp_dir, 'bench.git')
+        oids = build_repo(repo, max([args.commits] + [refs + 2 for refs in ref_counts]))
+        # the first check writes the commit-graph
+        plugin(repo, references(oids, 1, 'update'))
+        print("{:>8} {:>7} {:>7} {:>9} {:>9}".format('mode', 'kind', 'refs', 'seconds', 'refs/s'))
+        for mode, function in [('rev-list', per_ref), ('plugin', plugin)]:
+            for kind in ['create', 'update']:
+                for refs in ref_counts:
+                    updates = references(oids, refs, kind)
+                    start = time.monotonic()
+                    allowed = function(repo, updates)
+                    duration = time.monotonic() - start
+                    if allowed != refs:
+                        sys.exit("{} {} {}: allowed {} refs, expected {}".format(mode, kind, refs, allowed, refs))
+                    print("{:>8} {:>7} {:>7} {:>9.3f} {:>9.1f}".format(mode, kind, refs, duration, refs / duration))
+
+
+
+if __name__ == '__main__':
+    main(sys.argv)
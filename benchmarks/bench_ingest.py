@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""Benchmark push (request body) ingest through CGIStream
+
+Streams synthetic push data into a stand-in cgi that discards it, reporting
+MB/s for each size with copying through Python and with zero-copy splice().
+
+Usage: bench_ingest.py [--sizes 10M,1G,5G] [--buffer-size 1048576] [--modes copy,splice]
+"""
+
+
+import os
+import sys
+import time
+import socket
+import argparse
+import tempfile
+import threading
+sys.path.append(os.path.realpath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')))
+import githttp
+
+
+
+FAKE_CGI = """#!/bin/sh
+printf 'Content-Type: text/plain\\r\\n\\r\\n'
+exec wc -c
+"""
+
+UNITS = {
+    'K': 1024,
+    'M': 1024 ** 2,
+    'G': 1024 ** 3,
+}
+
+
+
+def parse_size(size):
+    """Convert size with optional K/M/G suffix to bytes
+
+    :arg size: str, eg. 10M
+    :return: int, bytes
+    """
+    size = size.strip().upper()
+    if size[-1] in UNITS:
+        return int(size[:-1]) * UNITS[size[-1]]
+    return int(size)
+
+
+class ZeroStream(object):
+    """File-like stream of zeros without allocating the whole size
+    """
+    def __init__(self, size):
+        self.remaining = size
+        self._chunk = bytes(githttp.CGI_BUFFER_SIZE)
+
+    def read(self, size):
+        """Read up to size bytes
+        """
+        size = min(size, self.remaining)
+        if len(self._chunk) < size:
+            self._chunk = bytes(size)
+        self.remaining -= size
+        return self._chunk[:size]
+
+
+def send_zeros(sock, size):
+    """Write size zeros to a socket then close it (run in thread)
+    """
+    chunk = bytes(1048576)
+    while size > 0:
+        sent = sock.send(chunk[:min(size, len(chunk))])
+        size -= sent
+    sock.close()
+
+
+def run(bin_path, size, buffer_size, mode):
+    """Time one ingest
+
+    :return: tuple of seconds, bytes counted by the cgi
+    """
+    writer = None
+    splice_fd = None
+    stream = ZeroStream(size)
+    if mode == 'splice':
+        reader, sender = socket.socketpair()
+        writer = threading.Thread(target=send_zeros, args=(sender, size))
+        splice_fd = reader.fileno()
+    start = time.monotonic()
+    if writer is not None:
+        writer.start()
+    cgi = githttp.CGIStream(
+        bin_path, {'PATH': os.environ.get('PATH', '/usr/bin:/bin')}, stream,
+        buffer_size=buffer_size, splice_fd=splice_fd, splice_length=size
+    )
+    _, _, _, body = cgi.read_header()
+    counted = b''.join(cgi.iter_body(body))
+    duration = time.monotonic() - start
+    cgi.close()
+    if writer is not None:
+        writer.join()
+        reader.close()
+    return duration, int(counted.strip())
+
+
+def main(argv):
+    """Run the benchmark
+
+    :arg argv: list, command line arguments
+    """
+    parser = argparse.ArgumentParser(description="Benchmark push ingest through CGIStream")
+    parser.add_argument('--sizes', default='10M,1G,5G', help="comma separated sizes, K/M/G suffixes")
+    parser.add_argument('--buffer-size', type=int, default=1048576, help="buffer size to use")
+    parser.add_argument('--modes', default='copy,splice', help="comma separated: copy, splice")
+    args = parser.parse_args(argv[1:])
+    with tempfile.TemporaryDirectory() as temp_dir:
+        bin_path = os.path.join(temp_dir, 'fake-cgi')
+        with open(bin_path, 'wt') as f_cgi:
+            f_cgi.write(FAKE_CGI)
+        os.chmod(bin_path, 0o755)
+        print("{:>8} {:>7} {:>10} {:>9} {:>10}".format('mode', 'size', 'buffer', 'seconds', 'MB/s'))
+        for mode in args.modes.split(','):
+            for size in args.sizes.split(','):
+                size_bytes = parse_size(size)
+                duration, counted = run(bin_path, size_bytes, args.buffer_size, mode)
+                if counted != size_bytes:
+                    sys.exit("{} {}: cgi received {} bytes, expected {}".format(mode, size, counted, size_bytes))
+                print("{:>8} {:>7} {:>10} {:>9.3f} {:>10.1f}".format(
+                    mode, size, args.buffer_size, duration, size_bytes / duration / UNITS['M']
+                ))
+
+
+
+if __name__ == '__main__':
+    main(sys.argv)
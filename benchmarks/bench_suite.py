@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+"""Microbenchmarks for git4nginx hot paths, with baseline comparison
+
+Runs offline against generated configs and synthetic repos (fixed seeds and
+commit dates so every run measures the same work). Each result is the best
+time per operation over several repeats.
+
+Usage: bench_suite.py [--filter name] [--quick] [--save results.json]
+                      [--baseline baseline.json | --no-compare] [--tolerance 0.25]
+
+Results are compared with the reference baseline committed alongside
+(baseline.json) or the one given with --baseline: benchmarks slower than the
+baseline by more than the tolerance are reported and the exit status is 1.
+Timings only compare on the same machine, so the reference baseline is a
+guide elsewhere - save a baseline locally before making changes:
+    bench_suite.py --save /tmp/before.json --no-compare
+    ... changes ...
+    bench_suite.py --baseline /tmp/before.json
+Refresh the reference baseline (same machine as before) after intended
+changes in performance with:
+    bench_suite.py --save benchmarks/baseline.json --no-compare
+"""
+
+
+import os
+import io
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import platform
+import tempfile
+import contextlib
+import subprocess
+sys.path.append(os.path.realpath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')))
+sys.path.append(os.path.realpath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'hooks', 'pre_receive_plugins')))
+import githttp
+import hook_helper
+from hook_helper import push_context
+import branch_flow
+import branch_protect
+
+
+
+SEED = 2019
+REFERENCE_BASELINE = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'baseline.json')
+USERS = ['user{}'.format(number) for number in range(200)]
+GROUPS = ['group{}'.format(number) for number in range(50)]
+CGI_HEADER = (
+    b'Status: 200 OK\r\n'
+    b'Expires: Fri, 01 Jan 1980 00:00:00 GMT\r\n'
+    b'Pragma: no-cache\r\n'
+    b'Cache-Control: no-cache, max-age=0, must-revalidate\r\n'
+    b'Content-Type: application/x-git-upload-pack-result'
+)
+GIT_ENV = dict(
+    os.environ,
+    GIT_AUTHOR_NAME='Bench', GIT_AUTHOR_EMAIL='bench@example.com',
+    GIT_COMMITTER_NAME='Bench', GIT_COMMITTER_EMAIL='bench@example.com',
+)
+
+
+
+def generate_authorisation(rand, project_groups, projects):
+    """Authorisation config for a tree of repos
+
+    :arg rand: random.Random
+    :arg project_groups: int, number of project groups
+    :arg projects: int, projects in each group
+    :return: dict
+    """
+    authorisation = {}
+    for group_number in range(project_groups):
+        node = {'.read_groups': rand.sample(GROUPS, 2)}
+        for project_number in range(projects):
+            node['project{}.git'.format(project_number)] = {
+                '.write_users': rand.sample(USERS, 3),
+                '.write_groups': rand.sample(GROUPS, 1),
+            }
+        authorisation['group{}'.format(group_number)] = node
+    return authorisation
+
+
+def build_repo(repo, commits):
+    """Bare repo with a linear history, a branch for each commit plus dev/test/master
+
+    :arg repo: str, path for the repo
+    :arg commits: int, length of history
+    """
+    subprocess.check_call(['git', 'init', '-q', '--bare', repo])
+    stream = io.BytesIO()
+    for number in range(commits):
+        stream.write('commit refs/heads/b{}\nmark :{}\ncommitter Bench <bench@example.com> {} +0000\ndata 0\n'.format(
+            number, number + 1, 1500000000 + number
+        ).encode('ascii'))
+        if number:
+            stream.write('from :{}\n'.format(number).encode('ascii'))
+        stream.write(b'\n')
+    for branch in ['dev', 'test', 'master']:
+        stream.write('reset refs/heads/{}\nfrom :{}\n\n'.format(branch, commits).encode('ascii'))
+    subprocess.run(['git', '--git-dir', repo, 'fast-import', '--quiet'], input=stream.getvalue(), env=GIT_ENV, check=True)
+
+
+
+class Suite(object):
+    """Benchmarks with their shared fixtures
+    """
+    def __init__(self, temp_dir, quick=False):
+        """Setup
+
+        :arg temp_dir: str, scratch directory
+        :arg quick: bool, fewer repeats (for checking the suite runs)
+        """
+        self.temp_dir = temp_dir
+        self.repeat = 2 if quick else 5
+        self.rand = random.Random(SEED)
+        self.authorisation = generate_authorisation(self.rand, 100, 50)
+        self.repos = [
+            ('group{}'.format(self.rand.randrange(100)), 'project{}.git'.format(self.rand.randrange(60)))
+            for _ in range(2000)
+        ]
+        self.requesters = [(self.rand.choice(USERS), self.rand.sample(GROUPS, 3)) for _ in range(50)]
+        self.config_path = os.path.join(temp_dir, 'config.yaml')
+        with open(self.config_path, 'wt') as f_config:
+            githttp.yaml.safe_dump({
+                'repo_root': temp_dir,
+                'authentication': {'plugin': 'htpasswd', 'plugin_config': {}},
+                'authorisation': self.authorisation,
+            }, f_config)
+        self.permission_index = githttp.PermissionIndex(self.authorisation)
+        self.repo = os.path.join(temp_dir, 'bench.git')
+        build_repo(self.repo, 2000)
+        self.gitwrapper = hook_helper.GitWrapper(self.repo)
+
+    def close(self):
+        """Stop git processes
+        """
+        self.gitwrapper.close()
+
+    def benchmarks(self):
+        """All benchmarks
+
+        :return: list of tuple name, function (returns number of operations done)
+        """
+        return [
+            ('config_parse', self.config_parse),
+            ('config_load_cached', self.config_load_cached),
+            ('permissions_walk', self.permissions_walk),
+            ('permission_index_build', self.permission_index_build),
+            ('permission_index_lookup', self.permission_index_lookup),
+            ('cgi_header_parse', self.cgi_header_parse),
+            ('hook_log_replay', self.hook_log_replay),
+            ('git_get_revisions', self.git_get_revisions),
+            ('plugin_branch_flow', self.plugin_branch_flow),
+            ('plugin_branch_protect', self.plugin_branch_protect),
+        ]
+
+    def run(self, function):
+        """Best time per operation over repeats
+
+        :arg function: callable, returns number of operations done
+        :return: float, seconds per operation
+        """
+        best = None
+        for _ in range(self.repeat):
+            start = time.perf_counter()
+            operations = function()
+            duration = (time.perf_counter() - start) / operations
+            best = duration if best is None else min(best, duration)
+        return best
+
+    def config_parse(self):
+        """Parse and compile a 5000 repo config (what a reload costs)
+        """
+        cache = githttp.ConfigCache()
+        cache.get(self.config_path)
+        return 1
+
+    def config_load_cached(self):
+        """load_config() per request with the config unchanged
+        """
+        os.environ['GIT4NGINX_CONFIG'] = self.config_path
+        for _ in range(1000):
+            githttp.load_config()
+        return 1000
+
+    def permissions_walk(self):
+        """Permissions.get_permission() walking the config
+        """
+        for (project_group, project), (username, groups) in zip(self.repos, self.requesters * 40):
+            githttp.Permissions(self.authorisation, username, groups).get_permission(project_group, project)
+        return len(self.repos)
+
+    def permission_index_build(self):
+        """Compile the authorisation config
+        """
+        githttp.PermissionIndex(self.authorisation)
+        return 1
+
+    def permission_index_lookup(self):
+        """PermissionIndex.get_permission() as used for requests (resolved repos cached)
+        """
+        for (project_group, project), (username, groups) in zip(self.repos, self.requesters * 40):
+            self.permission_index.get_permission(project_group, project, username, groups)
+        return len(self.repos)
+
+    def cgi_header_parse(self):
+        """Parse the header block from git-http-backend
+        """
+        for _ in range(10000):
+            githttp.parse_cgi_header(CGI_HEADER)
+        return 10000
+
+    def hook_log_replay(self):
+        """Re-log hook records passed back over the HookLog pipe (per record)
+        """
+        records = 20000
+        line = (json.dumps({
+            'created': 1500000000.0, 'level': 'INFO', 'hook': 'pre-receive',
+            'message': 'non-restricted branch, allowed to write to: dev',
+            'filename': 'branch_protect.py', 'lineno': 59,
+        }) + '\n').encode('utf-8')
+        handlers, level, propagate = githttp.app.logger.handlers, githttp.app.logger.level, githttp.app.logger.propagate
+        githttp.app.logger.handlers = [logging.NullHandler()]
+        githttp.app.logger.setLevel(logging.DEBUG)
+        githttp.app.logger.propagate = False
+        try:
+            with githttp.HookLog() as hook_log:
+                data = line * 1000
+                for _ in range(records // 1000):
+                    os.write(hook_log.write_fd, data)
+        finally:
+            githttp.app.logger.handlers, githttp.app.logger.propagate = handlers, propagate
+            githttp.app.logger.setLevel(level)
+        return records
+
+    def git_get_revisions(self):
+        """GitWrapper.get_revisions() over 2000 commits
+        """
+        for _ in range(10):
+            self.gitwrapper.get_revisions([self.gitwrapper.zero, 'master'])
+        return 10
+
+    def plugin(self, plugin, plugin_config, revisions):
+        """Run a pre-receive plugin quietly, with a new push context (as for each push)
+
+        :return: int, 1 operation
+        """
+        context = push_context.PushContext(
+            ['hooks/pre-receive'], revisions, self.gitwrapper,
+            'user0', set(['group0']), {}, 'group0', 'project0.git'
+        )
+        with contextlib.redirect_stdout(io.StringIO()):
+            plugin.Plugin(plugin_config, {}).check(context)
+        return 1
+
+    def plugin_branch_flow(self):
+        """branch_flow promoting 100 refs (commits deep in history) to test
+        """
+        revisions = [
+            ['refs/heads/b{}'.format(number), 'refs/heads/b{}'.format(number + 10), 'refs/heads/test']
+            for number in range(0, 2000, 20)
+        ]
+        resolved = self.gitwrapper.resolve_revisions(set(name for revision in revisions for name in revision[:2]))
+        revisions = [[resolved[revision[0]], resolved[revision[1]], revision[2]] for revision in revisions]
+        return self.plugin(branch_flow, {'flow': ['dev', 'test', 'master']}, revisions)
+
+    def plugin_branch_protect(self):
+        """branch_protect checking 1000 refs
+        """
+        revisions = [[self.gitwrapper.zero, '1' * 40, 'refs/heads/b{}'.format(number)] for number in range(1000)]
+        branches = {'b{}'.format(number): {'.write_groups': ['group0']} for number in range(0, 1000, 2)}
+        return self.plugin(branch_protect, {'branches': branches}, revisions)
+
+
+
+def compare(results, baseline, tolerance):
+    """Print results against baseline
+
+    :arg results: dict, name: seconds per operation
+    :arg baseline: dict, name: seconds per operation
+    :arg tolerance: float, fraction slower allowed
+    :return: list of str, names of benchmarks that regressed
+    """
+    regressed = []
+    print("{:<26} {:>12} {:>12} {:>8}".format('benchmark', 'baseline', 'current', 'change'))
+    for name, seconds in results.items():
+        if name not in baseline:
+            print("{:<26} {:>12} {:>12.3e} {:>8}".format(name, '-', seconds, 'new'))
+            continue
+        change = seconds / baseline[name] - 1
+        flag = ''
+        if change > tolerance:
+            regressed.append(name)
+            flag = ' REGRESSED'
+        print("{:<26} {:>12.3e} {:>12.3e} {:>+7.1%}{}".format(name, baseline[name], seconds, change, flag))
+    return regressed
+
+
+def main(argv):
+    """Run the benchmarks
+
+    :arg argv: list, command line arguments
+    """
+    parser = argparse.ArgumentParser(description="Microbenchmarks for git4nginx hot paths")
+    parser.add_argument('--filter', help="only run benchmarks with names containing this")
+    parser.add_argument('--quick', action='store_true', help="fewer repeats")
+    parser.add_argument('--save', help="write results to this JSON file")
+    parser.add_argument('--baseline', default=REFERENCE_BASELINE, help="compare against results saved with --save, default the reference baseline")
+    parser.add_argument('--no-compare', action='store_true', help="only print results")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="fraction slower than baseline allowed, default 0.25")
+    args = parser.parse_args(argv[1:])
+    baseline = None
+    if not args.no_compare:
+        with open(args.baseline, 'rt') as f_baseline:
+            baseline = json.load(f_baseline)
+    # plugins and githttp log every operation
+    githttp.app.logger.setLevel(logging.CRITICAL)
+    logging.getLogger().setLevel(logging.CRITICAL)
+    results = {}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        suite = Suite(temp_dir, args.quick)
+        try:
+            for name, function in suite.benchmarks():
+                if args.filter and args.filter not in name:
+                    continue
+                # warm up (caches, commit-graph, cat-file processes)
+                function()
+                results[name] = suite.run(function)
+                if baseline is None:
+                    print("{:<26} {:>12.3e} s/op".format(name, results[name]))
+        finally:
+            suite.close()
+    if args.save:
+        with open(args.save, 'wt') as f_results:
+            json.dump({
+                'python': platform.python_version(),
+                'git': subprocess.check_output(['git', '--version']).decode('ascii').strip(),
+                'machine': platform.machine(),
+                'results': results,
+            }, f_results, indent=2, sort_keys=True)
+    if baseline is not None:
+        print("baseline: {} (python {}, {}, {})".format(args.baseline, baseline.get('python'), baseline.get('git'), baseline.get('machine')))
+        regressed = compare(results, baseline['results'], args.tolerance)
+        if regressed:
+            sys.exit("Regressed: {}".format(', '.join(regressed)))
+
+
+
+if __name__ == '__main__':
+    main(sys.argv)
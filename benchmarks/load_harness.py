@@ -0,0 +1,478 @@
+#!/usr/bin/env python3
+"""Load harness - CI fleet style clone/fetch/push load against githttp.app
+
+Generates bare repos under a temporary repo_root, serves githttp.app from
+pre-forked worker processes (like uWSGI processes=N) on loopback and drives
+it with concurrent real git clients. Nothing outside this machine is used.
+
+Reports throughput, latency percentiles per git operation (client side) and
+per request type (server side), peak RSS per worker and the processes each
+worker spawned. Extra config (eg. pack_cache, native_refs, cgi tuning) can
+be layered on to compare changes under the same load, eg:
+    load_harness.py --workers 4 --clients 32 --duration 60 --mix clone=6,fetch=3,push=1
+    load_harness.py ... --extra-config pack_cache.yaml --json after.json
+
+Usage: load_harness.py [--repos 2] [--commits 200] [--refs 50] [--file-size 64K]
+                       [--workers 4] [--clients 16] [--duration 30]
+                       [--mix clone=6,fetch=3,push=1] [--hooks]
+                       [--extra-config file.yaml] [--json results.json]
+"""
+
+
+import os
+import sys
+import json
+import time
+import random
+import signal
+import shutil
+import argparse
+import resource
+import tempfile
+import threading
+import logging
+import subprocess
+import collections
+# keep request logging out of the way of the report, before githttp sets up logging
+os.environ.setdefault('GIT4NGINX_LOG_LEVEL', 'WARNING')
+sys.path.append(os.path.realpath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')))
+import yaml
+import werkzeug.serving
+import githttp
+import bench_ingest
+
+
+
+USER = 'load'
+SEED = 2019
+HOOKS_DIR = os.path.realpath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'hooks'))
+GIT_ENV = dict(
+    os.environ,
+    GIT_AUTHOR_NAME='Load', GIT_AUTHOR_EMAIL='load@example.com',
+    GIT_COMMITTER_NAME='Load', GIT_COMMITTER_EMAIL='load@example.com',
+    GIT_TERMINAL_PROMPT='0',
+)
+
+
+
+def build_repo(repo, rand, commits, refs, files, file_size):
+    """Bare repo with history, branches and tags
+
+    :arg repo: str, path for the repo
+    :arg rand: random.Random, content source (seeded for reproducible repos)
+    :arg commits: int, history depth
+    :arg refs: int, number of branches and tags
+    :arg files: int, files in the tree
+    :arg file_size: int, bytes in each file version
+    """
+    subprocess.check_call(['git', 'init', '-q', '--bare', repo])
+    subprocess.check_call(['git', '--git-dir', repo, 'config', 'http.receivepack', 'true'])
+    process = subprocess.Popen(['git', '--git-dir', repo, 'fast-import', '--quiet'], stdin=subprocess.PIPE, env=GIT_ENV)
+    for number in range(commits):
+        process.stdin.write('commit refs/heads/master\nmark :{}\ncommitter Load <load@example.com> {} +0000\ndata 0\n'.format(
+            number + 1, 1500000000 + number * 60
+        ).encode('ascii'))
+        if number:
+            process.stdin.write('from :{}\n'.format(number).encode('ascii'))
+        # first commit adds all files, then each commit changes one
+        for file_number in range(files) if number == 0 else [rand.randrange(files)]:
+            content = rand.getrandbits(file_size * 8).to_bytes(file_size, 'little')
+            process.stdin.write('M 100644 inline file{}\ndata {}\n'.format(file_number, len(content)).encode('ascii'))
+            process.stdin.write(content + b'\n')
+        process.stdin.write(b'\n')
+    for number in range(refs):
+        kind = 'heads/branch' if number % 2 else 'tags/v'
+        process.stdin.write('reset refs/{}{}\nfrom :{}\n\n'.format(kind, number, rand.randint(1, commits)).encode('ascii'))
+    process.stdin.close()
+    if process.wait():
+        raise RuntimeError("fast-import failed for {}".format(repo))
+    subprocess.check_call(['git', '--git-dir', repo, 'repack', '-q', '-a', '-d'])
+
+
+def write_config(path, repo_root, hooks, extra_config):
+    """Config for the app under test
+
+    :arg path: str, config file to write
+    :arg repo_root: str
+    :arg hooks: bool, enable a pre-receive plugin
+    :arg extra_config: str|None, yaml file merged over the generated config
+    """
+    config = {
+        'repo_root': repo_root,
+        'bin_path': os.path.join(subprocess.check_output(['git', '--exec-path']).decode('utf-8').strip(), 'git-http-backend'),
+        'authentication': {'plugin': 'lookup_groups', 'plugin_config': {'users': {USER: {'groups': ['load_group']}}}},
+        'authorisation': {'load': {'.write_groups': ['load_group']}},
+        'hooks': {'.branch_protect': {'branches': {'master': {'.write_groups': ['load_group']}}}} if hooks else {},
+    }
+    if extra_config is not None:
+        with open(extra_config, 'rt') as f_extra:
+            config.update(yaml.safe_load(f_extra) or {})
+    with open(path, 'wt') as f_config:
+        yaml.safe_dump(config, f_config)
+
+
+
+def request_type(environ):
+    """Label for a request
+
+    :arg environ: dict, WSGI environment
+    :return: str
+    """
+    path = environ.get('PATH_INFO', '')
+    for service in ['git-upload-pack', 'git-receive-pack']:
+        if path.endswith('/' + service):
+            return service
+        if path.endswith('/info/refs') and service in environ.get('QUERY_STRING', ''):
+            return 'refs ' + service
+    return 'other'
+
+
+class Worker(object):
+    """Serve the app in a forked worker process, recording what it does
+    """
+    def __init__(self, server, stats_dir):
+        """Setup
+
+        :arg server: werkzeug.serving.BaseWSGIServer, listening server shared by workers
+        :arg stats_dir: str, where to write stats on exit
+        """
+        self.server = server
+        self.stats_dir = stats_dir
+        self.requests = collections.defaultdict(list)
+        self.errors = collections.Counter()
+        self.bytes_out = 0
+        self.spawns = collections.Counter()
+        server.app = self.app
+
+    def app(self, environ, start_response):
+        """WSGI middleware - upstream authentication (as nginx would) and timing
+        """
+        environ['REMOTE_USER'] = USER
+        kind = request_type(environ)
+        start = time.monotonic()
+        status = []
+        def capture_status(status_line, headers, exc_info=None):
+            status.append(status_line)
+            return start_response(status_line, headers, exc_info)
+        body = githttp.app(environ, capture_status)
+        try:
+            for data in body:
+                self.bytes_out += len(data)
+                yield data
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+            self.requests[kind].append(time.monotonic() - start)
+            if not status or not status[0].startswith('2'):
+                self.errors[kind] += 1
+
+    def audit(self, event, args):
+        """Count processes spawned (audit hook)
+        """
+        if event == 'subprocess.Popen':
+            self.spawns[os.path.basename(str(args[0]))] += 1
+
+    def run(self):
+        """Serve until interrupted then save stats (does not return)
+        """
+        sys.addaudithook(self.audit)
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+        try:
+            self.server.serve_forever()
+        finally:
+            stats = {
+                'pid': os.getpid(),
+                'requests': self.requests,
+                'errors': self.errors,
+                'bytes_out': self.bytes_out,
+                'spawns': self.spawns,
+                # KiB on Linux
+                'max_rss_kib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                'max_child_rss_kib': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+            }
+            with open(os.path.join(self.stats_dir, '{}.json'.format(os.getpid())), 'wt') as f_stats:
+                json.dump(stats, f_stats)
+            os._exit(0)     # pylint: disable=protected-access
+
+
+
+class Client(object):
+    """A CI runner doing a mix of clone, fetch and push
+    """
+    def __init__(self, number, work_dir, urls, mix, file_size):
+        """Setup
+
+        :arg number: int, client number (seeds choices)
+        :arg work_dir: str, scratch directory for this client
+        :arg urls: list of str, repo URLs
+        :arg mix: list of operation names, weighted by repetition
+        :arg file_size: int, bytes pushed in each commit
+        """
+        self.rand = random.Random(SEED + number)
+        self.number = number
+        self.work_dir = work_dir
+        self.urls = urls
+        self.mix = mix
+        self.file_size = file_size
+        self.clones = {}
+        self.latencies = collections.defaultdict(list)
+        self.errors = collections.Counter()
+
+    def git(self, args, cwd=None, stdin=None):
+        """Run git, raising on failure
+
+        :return: str, stdout
+        """
+        return subprocess.run(
+            ['git'] + args, cwd=cwd, env=GIT_ENV, input=stdin,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True
+        ).stdout.decode('utf-8').strip()
+
+    def clone(self, url):
+        """Fresh clone as a CI job would, then throw it away
+        """
+        path = os.path.join(self.work_dir, 'clone')
+        try:
+            self.git(['clone', '-q', '--no-checkout', url, path])
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+
+    def persistent(self, url):
+        """Clone kept for fetch and push (set up untimed)
+
+        :return: str, path
+        """
+        if url not in self.clones:
+            path = os.path.join(self.work_dir, 'repo{}'.format(len(self.clones)))
+            self.git(['clone', '-q', '--bare', url, path])
+            self.git(['config', 'remote.origin.fetch', '+refs/heads/*:refs/remotes/origin/*'], cwd=path)
+            self.clones[url] = path
+        return self.clones[url]
+
+    def fetch(self, url):
+        """Fetch into a long-lived clone
+        """
+        self.git(['fetch', '-q', 'origin'], cwd=self.persistent(url))
+
+    def push(self, url):
+        """Push a new commit with a new file version to this client's branch
+        """
+        path = self.persistent(url)
+        blob = self.git(['hash-object', '-w', '--stdin'], path, self.rand.getrandbits(self.file_size * 8).to_bytes(self.file_size, 'little'))
+        tree = self.git(['mktree'], path, '100644 blob {}\tload{}\n'.format(blob, self.number).encode('utf-8'))
+        commit = self.git(['commit-tree', '-p', 'HEAD', '-m', 'load', tree], path)
+        self.git(['push', '-q', '--force', 'origin', '{}:refs/heads/load/client{}'.format(commit, self.number)], path)
+
+    def run(self, deadline):
+        """Run operations until the deadline
+
+        :arg deadline: float, time.monotonic() to stop at
+        """
+        while time.monotonic() < deadline:
+            operation = self.rand.choice(self.mix)
+            url = self.rand.choice(self.urls)
+            start = time.monotonic()
+            try:
+                if operation != 'clone':
+                    # setup is not part of the timing
+                    self.persistent(url)
+                    start = time.monotonic()
+                getattr(self, operation)(url)
+            except subprocess.CalledProcessError as exc:
+                self.errors[operation] += 1
+                sys.stderr.write("client{} {} failed: {}\n".format(self.number, operation, exc.stderr.decode('utf-8', 'replace').strip()))
+                continue
+            self.latencies[operation].append(time.monotonic() - start)
+
+
+
+def percentile(values, fraction):
+    """Nearest rank percentile
+
+    :arg values: sorted list
+    :arg fraction: float, eg. 0.95
+    :return: float
+    """
+    return values[min(len(values) - 1, int(fraction * len(values)))] if values else 0.0
+
+
+def latency_table(title, latencies, errors, duration):
+    """Print latency percentiles for each kind
+
+    :return: dict, kind: summary
+    """
+    summary = {}
+    print("\n{:<24} {:>7} {:>7} {:>8} {:>8} {:>8} {:>8}".format(title, 'count', 'errors', 'per sec', 'p50', 'p95', 'p99'))
+    for kind in sorted(set(latencies) | set(errors)):
+        values = sorted(latencies.get(kind, []))
+        summary[kind] = {
+            'count': len(values),
+            'errors': errors.get(kind, 0),
+            'per_second': len(values) / duration,
+            'p50': percentile(values, 0.5),
+            'p95': percentile(values, 0.95),
+            'p99': percentile(values, 0.99),
+        }
+        print("{:<24} {:>7} {:>7} {:>8.2f} {:>8.3f} {:>8.3f} {:>8.3f}".format(
+            kind, len(values), errors.get(kind, 0), len(values) / duration,
+            summary[kind]['p50'], summary[kind]['p95'], summary[kind]['p99']
+        ))
+    return summary
+
+
+def parse_mix(mix):
+    """Operations weighted by repetition
+
+    :arg mix: str, eg. clone=6,fetch=3,push=1
+    :return: list of str
+    """
+    operations = []
+    for part in mix.split(','):
+        name, weight = part.split('=')
+        if name not in ['clone', 'fetch', 'push']:
+            raise ValueError("Unknown operation: {}".format(name))
+        operations += [name] * int(weight)
+    return operations
+
+
+def system_forks():
+    """Processes created on this machine since boot (Linux)
+
+    :return: int|None
+    """
+    try:
+        with open('/proc/stat', 'rt') as f_stat:
+            for line in f_stat:
+                if line.startswith('processes '):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def main(argv):
+    """Run the harness
+
+    :arg argv: list, command line arguments
+    """
+    parser = argparse.ArgumentParser(description="CI fleet style load against githttp.app")
+    parser.add_argument('--repos', type=int, default=2, help="repos to generate")
+    parser.add_argument('--commits', type=int, default=200, help="history depth of each repo")
+    parser.add_argument('--refs', type=int, default=50, help="branches and tags in each repo")
+    parser.add_argument('--files', type=int, default=20, help="files in each repo")
+    parser.add_argument('--file-size', default='64K', help="size of each file version, K/M suffixes")
+    parser.add_argument('--workers', type=int, default=4, help="server worker processes")
+    parser.add_argument('--clients', type=int, default=16, help="concurrent git clients")
+    parser.add_argument('--duration', type=float, default=30, help="seconds of load")
+    parser.add_argument('--mix', default='clone=6,fetch=3,push=1', help="weighted operations")
+    parser.add_argument('--hooks', action='store_true', help="run the pre-receive hook (branch_protect) on pushes")
+    parser.add_argument('--extra-config', help="yaml merged over the generated config (eg. pack_cache)")
+    parser.add_argument('--json', help="also write results to this file")
+    args = parser.parse_args(argv[1:])
+    mix = parse_mix(args.mix)
+    file_size = bench_ingest.parse_size(args.file_size)
+    temp_dir = tempfile.mkdtemp(prefix='git4nginx-load-')
+    workers = []
+    try:
+        repo_root = os.path.join(temp_dir, 'repos')
+        rand = random.Random(SEED)
+        print("Generating {} repos ({} commits, {} refs)...".format(args.repos, args.commits, args.refs))
+        for number in range(args.repos):
+            repo = os.path.join(repo_root, 'load', 'repo{}.git'.format(number))
+            build_repo(repo, rand, args.commits, args.refs, args.files, file_size)
+            if args.hooks:
+                subprocess.check_call(['sh', os.path.join(HOOKS_DIR, 'setup.sh')], cwd=repo, stdout=subprocess.DEVNULL)
+        config_path = os.path.join(temp_dir, 'config.yaml')
+        write_config(config_path, repo_root, args.hooks, args.extra_config)
+        os.environ['GIT4NGINX_CONFIG'] = config_path
+        stats_dir = os.path.join(temp_dir, 'stats')
+        os.mkdir(stats_dir)
+
+        # pre-fork workers sharing the listening socket
+        server = werkzeug.serving.BaseWSGIServer('127.0.0.1', 0, githttp.app)
+        server.socket.listen(128)
+        for _ in range(args.workers):
+            pid = os.fork()
+            if pid == 0:
+                Worker(server, stats_dir).run()
+            workers.append(pid)
+        server.socket.close()
+        urls = ['http://127.0.0.1:{}/load/repo{}.git'.format(server.server_port, number) for number in range(args.repos)]
+
+        print("Running {} clients against {} workers for {:.0f}s ({})...".format(args.clients, args.workers, args.duration, args.mix))
+        clients = [
+            Client(number, os.path.join(temp_dir, 'client{}'.format(number)), urls, mix, file_size)
+            for number in range(args.clients)
+        ]
+        for client in clients:
+            os.mkdir(client.work_dir)
+        forks_start = system_forks()
+        start = time.monotonic()
+        threads = [threading.Thread(target=client.run, args=(start + args.duration, )) for client in clients]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        duration = time.monotonic() - start
+        forks = system_forks()
+
+        # stop workers, collecting their stats
+        for pid in workers:
+            os.kill(pid, signal.SIGINT)
+        for pid in workers:
+            os.waitpid(pid, 0)
+        workers = []
+        worker_stats = []
+        for name in sorted(os.listdir(stats_dir)):
+            with open(os.path.join(stats_dir, name), 'rt') as f_stats:
+                worker_stats.append(json.load(f_stats))
+    finally:
+        for pid in workers:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    # report
+    operations = collections.defaultdict(list)
+    operation_errors = collections.Counter()
+    for client in clients:
+        for operation, values in client.latencies.items():
+            operations[operation] += values
+        operation_errors.update(client.errors)
+    requests = collections.defaultdict(list)
+    request_errors = collections.Counter()
+    spawns = collections.Counter()
+    for stats in worker_stats:
+        for kind, values in stats['requests'].items():
+            requests[kind] += values
+        request_errors.update(stats['errors'])
+        spawns.update(stats['spawns'])
+    results = {
+        'duration': duration,
+        'operations': latency_table('git operation (client)', operations, operation_errors, duration),
+        'requests': latency_table('request (server)', requests, request_errors, duration),
+        'bytes_out_per_second': sum(stats['bytes_out'] for stats in worker_stats) / duration,
+        'workers': [
+            {name: stats[name] for name in ['pid', 'max_rss_kib', 'max_child_rss_kib', 'spawns']}
+            for stats in worker_stats
+        ],
+        'spawns': spawns,
+        'system_forks': forks - forks_start if forks is not None and forks_start is not None else None,
+    }
+    print("\nthroughput: {:.2f} MiB/s served".format(results['bytes_out_per_second'] / 1048576))
+    print("\n{:<10} {:>10} {:>14} {:>8}".format('worker', 'peak RSS', 'peak child RSS', 'spawns'))
+    for worker in results['workers']:
+        print("{:<10} {:>7.1f}MiB {:>11.1f}MiB {:>8}".format(
+            worker['pid'], worker['max_rss_kib'] / 1024, worker['max_child_rss_kib'] / 1024, sum(worker['spawns'].values())
+        ))
+    print("\nspawned by workers: {}".format(', '.join('{} {}'.format(name, count) for name, count in sorted(spawns.items()))))
+    if results['system_forks'] is not None:
+        print("processes created on this machine (including clients): {}".format(results['system_forks']))
+    if args.json:
+        with open(args.json, 'wt') as f_results:
+            json.dump(results, f_results, indent=2, sort_keys=True)
+
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,260 @@
+"""Pre-generated clone bundles for repos
+
+git4nginx tools for using git via http(s) with Nginx
+Copyright (C) 2019  Glen Pitt-Pladdy
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+Bundles (git bundle) of branches and tags are written per repo under path
+by maintenance passes: a full bundle, then incremental bundles of what was
+pushed since, until max_incremental is reached and a new full bundle
+replaces them. A repo is due after push_threshold pushes, or any push once
+interval has passed since its last bundle.
+
+Clients fetch them as a bundle list (git-config format, see
+https://git-scm.com/docs/bundle-uri) with:
+    git clone --bundle-uri=https://server/project_group/project.git/bundles/list https://server/project_group/project.git
+and only the difference from the bundles is fetched from git-http-backend.
+Servers running git 2.40+ also advertise the list over protocol v2.
+"""
+
+import os
+import time
+import json
+import glob
+import logging
+import subprocess
+
+
+MANIFEST = 'manifest.json'
+# superseded bundles are kept this long for clients that already have the list
+GRACE_SECONDS = 3600
+
+
+
+class BundleStore(object):
+    """Bundles of all repos, stored below path
+    """
+    def __init__(self, path, push_threshold=10, interval=86400, max_incremental=4):
+        """Setup
+
+        :arg path: str, directory for bundles
+        :arg push_threshold: int, pushes before new bundles are written
+        :arg interval: float, seconds after which any push makes new bundles due
+        :arg max_incremental: int, incremental bundles before a new full bundle
+        """
+        self.path = path
+        self.push_threshold = push_threshold
+        self.interval = interval
+        self.max_incremental = max_incremental
+        # repo: (manifest stat, manifest)
+        self._manifests = {}
+
+    def repo_dir(self, repo):
+        """Directory of bundles for a repo
+
+        :arg repo: str, repo path relative to repo_root
+        :return: str
+        """
+        return os.path.join(self.path, repo)
+
+    def manifest(self, repo):
+        """Bundles available for a repo, oldest first
+
+        :arg repo: str, repo path relative to repo_root
+        :return: list of dict, id, file, creation_token, created, heads and size
+        """
+        path = os.path.join(self.repo_dir(repo), MANIFEST)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return []
+        signature = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        cached = self._manifests.get(repo)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        with open(path, 'rt') as f_manifest:
+            manifest = json.load(f_manifest)
+        self._manifests[repo] = (signature, manifest)
+        return manifest
+
+    def _write_manifest(self, repo, manifest):
+        """Replace the manifest atomically
+
+        :arg repo: str, repo path relative to repo_root
+        :arg manifest: list of dict
+        """
+        path = os.path.join(self.repo_dir(repo), MANIFEST)
+        with open(path + '.tmp', 'wt') as f_manifest:
+            json.dump(manifest, f_manifest, sort_keys=True)
+        os.rename(path + '.tmp', path)
+
+    def due(self, repo, pushes, now):
+        """New bundles are needed
+
+        :arg repo: str, repo path relative to repo_root
+        :arg pushes: int, pushes since the last bundle was written
+        :arg now: float, time.time()
+        :return: bool
+        """
+        manifest = self.manifest(repo)
+        if not manifest:
+            return True
+        if pushes >= self.push_threshold:
+            return True
+        return pushes > 0 and now - manifest[-1]['created'] >= self.interval
+
+    def generate(self, repo, repo_path, run):
+        """Write a full or incremental bundle
+
+        :arg repo: str, repo path relative to repo_root
+        :arg repo_path: str, path to repo
+        :arg run: callable, runs git arguments in the repo, returns a task result dict
+        :return: dict, task result with status ok, failed or unchanged
+        """
+        repo_dir = self.repo_dir(repo)
+        os.makedirs(repo_dir, exist_ok=True)
+        manifest = self.manifest(repo)
+        full = not manifest or len(manifest) > self.max_incremental
+        # creation tokens must increase, clients use them to order bundles
+        token = max(int(time.time()), manifest[-1]['creation_token'] + 1 if manifest else 0)
+        bundle_id = '{}-{}'.format('full' if full else 'incr', token)
+        temp_path = os.path.join(repo_dir, bundle_id + '.tmp')
+        command = ['bundle', 'create', '--quiet', temp_path, '--branches', '--tags']
+        if not full:
+            # everything reachable from the refs in existing bundles is excluded
+            command += ['--not'] + sorted(set(
+                sha for bundle in manifest for sha in bundle['heads'].values()
+            ))
+        result = run(repo_path, command)
+        if result['status'] != 'ok':
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            if 'empty bundle' in (result['error'] or ''):
+                # nothing since the last bundle (or nothing at all)
+                result.update(status='unchanged', error=None)
+            return result
+        # only reads the bundle header, not worth pacing like the bundle itself
+        try:
+            output = subprocess.run(
+                ['git', 'bundle', 'list-heads', temp_path], cwd=repo_path,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True
+            ).stdout
+        except subprocess.CalledProcessError as exc:
+            os.unlink(temp_path)
+            result.update(status='failed', error=exc.stderr.decode('utf-8', 'replace').strip()[-1000:] or str(exc))
+            return result
+        heads = {}
+        for line in output.decode('utf-8').splitlines():
+            sha, ref = line.split(' ', 1)
+            heads[ref] = sha
+        os.rename(temp_path, os.path.join(repo_dir, bundle_id + '.bundle'))
+        entry = {
+            'id': bundle_id,
+            'file': bundle_id + '.bundle',
+            'creation_token': token,
+            'created': time.time(),
+            'heads': heads,
+            'size': os.path.getsize(os.path.join(repo_dir, bundle_id + '.bundle')),
+        }
+        if full:
+            # grace period for superseded bundles starts now
+            for bundle in manifest:
+                os.utime(os.path.join(repo_dir, bundle['file']))
+        manifest = [entry] if full else manifest + [entry]
+        self._write_manifest(repo, manifest)
+        self.prune(repo)
+        logging.info("Wrote bundle %s for: %s", bundle_id, repo)
+        return result
+
+    def prune(self, repo):
+        """Remove bundles no longer in the manifest once clients are done with them
+
+        :arg repo: str, repo path relative to repo_root
+        """
+        current = set(bundle['file'] for bundle in self.manifest(repo))
+        for path in glob.glob(os.path.join(self.repo_dir(repo), '*.bundle')):
+            if os.path.basename(path) not in current and time.time() - os.path.getmtime(path) > GRACE_SECONDS:
+                os.unlink(path)
+
+    def bundle_path(self, repo, name):
+        """Path of a bundle in the manifest
+
+        :arg repo: str, repo path relative to repo_root
+        :arg name: str, bundle file name requested
+        :return: str|None, None if not a current bundle
+        """
+        if name not in [bundle['file'] for bundle in self.manifest(repo)]:
+            return None
+        return os.path.join(self.repo_dir(repo), name)
+
+    def bundle_list(self, repo, base_url):
+        """Bundle list for clients (--bundle-uri)
+
+        :arg repo: str, repo path relative to repo_root
+        :arg base_url: str, URL bundles are downloaded from (ending /)
+        :return: str, git-config format
+        """
+        lines = ['[bundle]', '\tversion = 1', '\tmode = all', '\theuristic = creationToken']
+        for bundle in self.manifest(repo):
+            lines += [
+                '[bundle "{}"]'.format(bundle['id']),
+                '\turi = {}{}'.format(base_url, bundle['file']),
+                '\tcreationToken = {}'.format(bundle['creation_token']),
+            ]
+        return '\n'.join(lines) + '\n'
+
+    def config_env(self, repo, base_url, env):
+        """Add config for upload-pack to advertise the bundles (protocol v2 bundle-uri)
+
+        :arg repo: str, repo path relative to repo_root
+        :arg base_url: str, URL bundles are downloaded from (ending /)
+        :arg env: dict, environment to add GIT_CONFIG_* entries to
+        """
+        manifest = self.manifest(repo)
+        if not manifest:
+            return
+        items = [
+            ('uploadpack.advertiseBundleURIs', 'true'),
+            ('bundle.version', '1'),
+            ('bundle.mode', 'all'),
+            ('bundle.heuristic', 'creationToken'),
+        ]
+        for bundle in manifest:
+            items += [
+                ('bundle.{}.uri'.format(bundle['id']), base_url + bundle['file']),
+                ('bundle.{}.creationToken'.format(bundle['id']), str(bundle['creation_token'])),
+            ]
+        count = int(env.get('GIT_CONFIG_COUNT', 0))
+        for number, (key, value) in enumerate(items, count):
+            env['GIT_CONFIG_KEY_{}'.format(number)] = key
+            env['GIT_CONFIG_VALUE_{}'.format(number)] = value
+        env['GIT_CONFIG_COUNT'] = str(count + len(items))
+
+
+
+def from_config(config):
+    """BundleStore for the app config
+
+    :arg config: dict, app config
+    :return: BundleStore
+    """
+    bundles_config = config['bundles']
+    return BundleStore(
+        bundles_config['path'],
+        bundles_config.get('push_threshold', 10),
+        bundles_config.get('interval', 86400),
+        bundles_config.get('max_incremental', 4)
+    )
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""Compile the config snapshot used by hooks
+
+git4nginx tools for using git via http(s) with Nginx
+Copyright (C) 2019  Glen Pitt-Pladdy
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+Hooks compile the snapshot themselves when the config changes, provided
+they can write next to it. Run this after deploying config (eg. from config
+management) to have it compiled with the repos under repo_root up front:
+    compile_config.py /path/to/config.yaml
+    GIT4NGINX_CONFIG=/path/to/config.yaml compile_config.py
+See hook_helper/config_snapshot.py for details.
+"""
+
+import os
+import sys
+import logging
+import argparse
+import hook_helper
+from hook_helper import config_snapshot
+
+
+
+def main(argv):
+    """Main entry point
+
+    :arg argv: list, command line arguments
+    """
+    parser = argparse.ArgumentParser(description="Compile git4nginx config snapshot for hooks")
+    parser.add_argument('config', nargs='?', default=os.environ.get('GIT4NGINX_CONFIG'), help="config (default GIT4NGINX_CONFIG)")
+    args = parser.parse_args(argv[1:])
+    logging.basicConfig(
+        format='%(asctime)s - %(levelname)s %(message)s (%(filename)s:%(lineno)d)',
+        level=getattr(logging, os.environ.get('GIT4NGINX_LOG_LEVEL', 'INFO')),
+    )
+    if args.config is None:
+        sys.exit("Require config argument or environment variable to be set: GIT4NGINX_CONFIG")
+    os.environ['GIT4NGINX_CONFIG'] = args.config
+    signature = config_snapshot.source_signature(args.config)
+    config = hook_helper.load_config(use_snapshot=False)
+    try:
+        path = config_snapshot.compile_config(args.config, config, signature)
+    except (OSError, ValueError) as exc:
+        sys.exit("Unable to compile config snapshot: {}".format(exc))
+    print("Compiled {} for {} repos".format(path, len(config_snapshot.load_snapshot(args.config).repo_hooks)))
+
+
+
+if __name__ == '__main__':
+    main(sys.argv)
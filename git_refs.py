@@ -0,0 +1,538 @@
+"""Native ref advertisement - serve ref lists without spawning git
+
+git4nginx tools for using git via http(s) with Nginx
+Copyright (C) 2019  Glen Pitt-Pladdy
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+Refs are read directly from packed-refs and loose refs and cached per repo
+until the ref files change. The capabilities advertised (which depend on
+git version and repo config) are learnt from git-http-backend, and the
+native output is checked against git-http-backend before it is used.
+"""
+
+import os
+import re
+import zlib
+import hashlib
+import time
+import logging
+import threading
+import subprocess
+import collections
+
+
+FLUSH = b'0000'
+DELIM = b'0001'
+OID_RE = re.compile(r'^[0-9a-f]{40}$')
+# mtimes this close to when refs were read may not show a following change
+RACY_NS = 2000000000
+# headers git-http-backend sends with ref advertisements and results
+NO_CACHE_HEADERS = [
+    ['Expires', 'Fri, 01 Jan 1980 00:00:00 GMT'],
+    ['Pragma', 'no-cache'],
+    ['Cache-Control', 'no-cache, max-age=0, must-revalidate'],
+]
+
+
+
+def pkt_line(data):
+    """Encode data as a pkt-line
+
+    :arg data: bytes|str, payload
+    :return: bytes
+    """
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return '{:04x}'.format(len(data) + 4).encode('ascii') + data
+
+
+def read_pkt_lines(stream, limit=65536):
+    """Read pkt-lines up to and including a flush packet
+
+    :arg stream: stream to read from
+    :arg limit: int, maximum bytes to read
+    :return: tuple of:
+        packets, list of bytes|None - None for special (flush/delim) packets
+        raw, bytes - all data read
+    :raises ValueError: on malformed or oversize data, raw data read so far is in args[1]
+    """
+    packets = []
+    raw = b''
+    while True:
+        header = stream.read(4)
+        raw += header
+        if len(header) != 4 or not re.match(rb'^[0-9a-f]{4}$', header):
+            raise ValueError("Malformed pkt-line", raw)
+        length = int(header, 16)
+        if length < 4:
+            packets.append(None)
+            if header == FLUSH:
+                return packets, raw
+            continue
+        if len(raw) + length - 4 > limit:
+            raise ValueError("pkt-lines exceed {} bytes".format(limit), raw)
+        data = stream.read(length - 4)
+        raw += data
+        if len(data) != length - 4:
+            raise ValueError("Truncated pkt-line", raw)
+        packets.append(data)
+
+
+def read_object_header(git_dir, oid, size=4096):
+    """Read the start of a loose object
+
+    :arg git_dir: str, repo path
+    :arg oid: str, object id
+    :arg size: int, maximum bytes of object to return
+    :return: tuple of type (str), content start (bytes) or None if not a loose object
+    """
+    path = os.path.join(git_dir, 'objects', oid[:2], oid[2:])
+    try:
+        with open(path, 'rb') as f_object:
+            decompressor = zlib.decompressobj()
+            data = b''
+            while b'\0' not in data and len(data) < size:
+                compressed = f_object.read(1024)
+                if not compressed:
+                    break
+                data += decompressor.decompress(compressed, size)
+    except FileNotFoundError:
+        return None
+    if b'\0' not in data:
+        return None
+    header, content = data.split(b'\0', 1)
+    return header.split(b' ', 1)[0].decode('ascii'), content
+
+
+
+class RefSnapshot(object):
+    """Refs of a repo read directly from HEAD, packed-refs and loose refs
+    """
+    def __init__(self, git_dir):
+        """Read refs
+
+        :arg git_dir: str, path to (bare) repo
+        """
+        self.git_dir = git_dir
+        self.signature = {}
+        self.racy = False
+        self.head_target = None
+        self.head_oid = None
+        # name: [oid, peeled oid|None, symref target|None]
+        self.refs = {}
+        self._peel_known = set()
+        self._v0 = {}
+        self._fingerprint = None
+        start_ns = time.time_ns()
+        self._read_head()
+        self._read_packed()
+        self._read_loose(os.path.join(git_dir, 'refs'), 'refs/')
+        self._resolve_symrefs()
+        self._peel()
+        self.names = sorted(self.refs, key=lambda name: name.encode('utf-8'))
+        self.racy = any(
+            signature is not None and signature[-1] > start_ns - RACY_NS
+            for signature in self.signature.values()
+        )
+
+    def _stat(self, path):
+        """Record file/directory state for detecting change
+
+        :arg path: str, path to stat
+        :return: bool, True if path exists
+        """
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            self.signature[path] = None
+            return False
+        self.signature[path] = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        return True
+
+    def _read_head(self):
+        """Read HEAD - normally a symref
+        """
+        path = os.path.join(self.git_dir, 'HEAD')
+        self._stat(path)
+        with open(path, 'rt') as f_head:
+            head = f_head.read().strip()
+        if head.startswith('ref: '):
+            self.head_target = head[5:]
+        elif OID_RE.match(head):
+            self.head_oid = head
+
+    def _read_packed(self):
+        """Read packed-refs including peeled values
+        """
+        path = os.path.join(self.git_dir, 'packed-refs')
+        if not self._stat(path):
+            return
+        traits = []
+        last = None
+        with open(path, 'rt') as f_packed:
+            for line in f_packed:
+                line = line.rstrip('\n')
+                if line.startswith('# pack-refs with:'):
+                    traits = line.split(':', 1)[1].split()
+                elif line.startswith('^'):
+                    if last is not None:
+                        self.refs[last][1] = line[1:]
+                elif line and not line.startswith('#'):
+                    oid, last = line.split(' ', 1)
+                    self.refs[last] = [oid, None, None]
+                    # peeled values are only complete with the right traits
+                    if 'fully-peeled' in traits or ('peeled' in traits and last.startswith('refs/tags/')):
+                        self._peel_known.add(last)
+
+    def _read_loose(self, path, prefix):
+        """Read loose refs (recursively), these take precedence over packed-refs
+
+        :arg path: str, directory to read
+        :arg prefix: str, ref name prefix for directory
+        """
+        if not self._stat(path):
+            return
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    self._read_loose(entry.path, prefix + entry.name + '/')
+                    continue
+                if entry.name.endswith('.lock'):
+                    continue
+                try:
+                    with open(entry.path, 'rt') as f_ref:
+                        value = f_ref.read().strip()
+                except FileNotFoundError:
+                    # deleted while we were looking - will be seen as a change
+                    continue
+                name = prefix + entry.name
+                self._peel_known.discard(name)
+                if value.startswith('ref: '):
+                    self.refs[name] = [None, None, value[5:]]
+                elif OID_RE.match(value):
+                    self.refs[name] = [value, None, None]
+
+    def _resolve(self, name, depth=0):
+        """Fully resolve a ref
+
+        :arg name: str, ref name
+        :return: tuple of oid (str|None), final ref name (str|None)
+        """
+        if name not in self.refs or depth > 5:
+            return None, None
+        oid, _, target = self.refs[name]
+        if target is None:
+            return oid, name
+        return self._resolve(target, depth + 1)
+
+    def _resolve_symrefs(self):
+        """Resolve symrefs (HEAD and any in refs/), dropping dangling ones
+        """
+        for name, ref in list(self.refs.items()):
+            if ref[2] is None:
+                continue
+            oid, target = self._resolve(name)
+            if oid is None:
+                del self.refs[name]
+                continue
+            ref[0] = oid
+            ref[2] = target
+            if target in self._peel_known:
+                ref[1] = self.refs[target][1]
+                self._peel_known.add(name)
+        if self.head_target is not None:
+            self.head_oid, target = self._resolve(self.head_target)
+            if target is not None:
+                self.head_target = target
+
+    def _peel(self):
+        """Work out peeled values not known from packed-refs
+        """
+        unknown = [name for name in self.refs if name not in self._peel_known]
+        fallback = []
+        for name in unknown:
+            oid = self.refs[name][0]
+            peeled = None
+            for _ in range(10):
+                header = read_object_header(self.git_dir, oid)
+                if header is None:
+                    # packed object - ask git
+                    fallback.append(name)
+                    break
+                if header[0] != 'tag':
+                    self.refs[name][1] = peeled
+                    break
+                match = re.match(rb'^object ([0-9a-f]{40})\n', header[1])
+                if match is None:
+                    fallback.append(name)
+                    break
+                oid = peeled = match.group(1).decode('ascii')
+        if fallback:
+            output = subprocess.check_output([
+                'git', '--git-dir={}'.format(self.git_dir),
+                'for-each-ref', '--format=%(refname) %(*objectname)',
+            ] + fallback)
+            for line in output.decode('utf-8').splitlines():
+                name, _, peeled = line.partition(' ')
+                if name in self.refs:
+                    self.refs[name][1] = peeled or None
+
+    def is_current(self):
+        """Check if anything refs are read from has changed
+
+        :return: bool, True if snapshot is still valid
+        """
+        if self.racy:
+            return False
+        for path, signature in self.signature.items():
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                if signature is not None:
+                    return False
+                continue
+            if signature != (stat.st_ino, stat.st_size, stat.st_mtime_ns):
+                return False
+        return True
+
+    def fingerprint(self):
+        """Identify the ref state
+
+        :return: str, changes whenever any ref changes
+        """
+        if self._fingerprint is None:
+            digest = hashlib.sha1('HEAD {} {}\n'.format(self.head_oid, self.head_target).encode('utf-8'))
+            for name in self.names:
+                digest.update('{} {}\n'.format(self.refs[name][0], name).encode('utf-8'))
+            self._fingerprint = digest.hexdigest()
+        return self._fingerprint
+
+    def advertisement_v0(self, capabilities):
+        """Build upload-pack ref advertisement (protocol v0) as git-http-backend
+
+        :arg capabilities: tuple of capabilities before and after symref, (list, list)
+        :return: bytes, response body
+        """
+        if capabilities in self._v0:
+            return self._v0[capabilities]
+        symref = []
+        if self.head_target is not None and self.head_oid is not None:
+            symref = ['symref=HEAD:{}'.format(self.head_target)]
+        caps = ' '.join(list(capabilities[0]) + symref + list(capabilities[1]))
+        lines = []
+        if self.head_oid is not None:
+            lines.append([self.head_oid, 'HEAD', self._peel_of(self.head_oid)])
+        lines += [[self.refs[name][0], name, self.refs[name][1]] for name in self.names]
+        body = [pkt_line('# service=git-upload-pack\n'), FLUSH]
+        for oid, name, peeled in lines:
+            if caps is not None:
+                body.append(pkt_line('{} {}\0{}\n'.format(oid, name, caps)))
+                caps = None
+            else:
+                body.append(pkt_line('{} {}\n'.format(oid, name)))
+            if peeled is not None:
+                body.append(pkt_line('{} {}^{{}}\n'.format(peeled, name)))
+        body.append(FLUSH)
+        self._v0[capabilities] = b''.join(body)
+        return self._v0[capabilities]
+
+    def _peel_of(self, oid):
+        """Peeled value for HEAD from the ref it points at
+
+        :arg oid: str, object id
+        :return: str|None, peeled object id
+        """
+        if self.head_target in self.refs:
+            return self.refs[self.head_target][1]
+        for name in self.names:
+            if self.refs[name][0] == oid:
+                return self.refs[name][1]
+        return None
+
+    def ls_refs(self, arguments):
+        """Protocol v2 ls-refs command response as git upload-pack
+
+        :arg arguments: list of str, arguments from the request (peel, symrefs, unborn, ref-prefix)
+        :return: bytes, response body
+        """
+        peel = 'peel' in arguments
+        symrefs = 'symrefs' in arguments
+        unborn = 'unborn' in arguments
+        prefixes = [argument[11:] for argument in arguments if argument.startswith('ref-prefix ')]
+        lines = []
+        if self.head_oid is not None:
+            lines.append(['HEAD', self.head_oid, self._peel_of(self.head_oid), self.head_target])
+        elif unborn and symrefs and self.head_target is not None:
+            lines.append(['HEAD', None, None, self.head_target])
+        lines += [[name] + self.refs[name] for name in self.names]
+        body = []
+        for name, oid, peeled, target in lines:
+            if prefixes and not name.startswith(tuple(prefixes)):
+                continue
+            line = '{} {}'.format(oid if oid is not None else 'unborn', name)
+            if symrefs and target is not None:
+                line += ' symref-target:{}'.format(target)
+            if peel and peeled is not None:
+                line += ' peeled:{}'.format(peeled)
+            body.append(pkt_line(line + '\n'))
+        body.append(FLUSH)
+        return b''.join(body)
+
+
+
+class RefCache(object):
+    """Per-worker cache of ref snapshots and the capabilities of each repo
+
+    Before native output is used for a repo it is checked byte for byte
+    against git-http-backend. This is repeated whenever the repo config
+    changes or the repo gets its first refs (empty repos advertise no
+    capabilities), and native output is not used if there is any difference.
+    Repos with hidden refs (uploadpack.hideRefs or transfer.hideRefs in any
+    git config) are always left to git-http-backend as refs created later
+    may need hiding.
+    """
+    def __init__(self, bin_path, max_repos=1024):
+        """Setup
+
+        :arg bin_path: str, path to git-http-backend
+        :arg max_repos: int, maximum repos to cache
+        """
+        self.bin_path = bin_path
+        self.max_repos = max_repos
+        self.snapshots = collections.OrderedDict()
+        # git_dir: ((config signature, has refs), capabilities|None)
+        self.probes = {}
+        self._lock = threading.Lock()
+
+    def snapshot(self, git_dir):
+        """Current refs for a repo
+
+        :arg git_dir: str, path to repo
+        :return: RefSnapshot
+        """
+        with self._lock:
+            snapshot = self.snapshots.get(git_dir)
+            if snapshot is not None:
+                self.snapshots.move_to_end(git_dir)
+        if snapshot is not None and snapshot.is_current():
+            return snapshot
+        snapshot = RefSnapshot(git_dir)
+        with self._lock:
+            self.snapshots[git_dir] = snapshot
+            while len(self.snapshots) > self.max_repos:
+                self.snapshots.popitem(last=False)
+        return snapshot
+
+    def _backend(self, git_dir, method, query, body=b''):
+        """Run git-http-backend directly for a repo
+
+        :return: bytes, response body
+        """
+        cgienv = {
+            'PATH': os.environ.get('PATH', '/usr/bin:/bin'),
+            'GIT_PROJECT_ROOT': os.path.dirname(git_dir),
+            'GIT_HTTP_EXPORT_ALL': '',
+            'REQUEST_METHOD': method,
+            'PATH_INFO': '/' + os.path.basename(git_dir) + ('/info/refs' if method == 'GET' else '/git-upload-pack'),
+            'QUERY_STRING': query,
+        }
+        if method == 'POST':
+            cgienv['CONTENT_TYPE'] = 'application/x-git-upload-pack-request'
+            cgienv['CONTENT_LENGTH'] = str(len(body))
+            cgienv['HTTP_GIT_PROTOCOL'] = 'version=2'
+        output = subprocess.run(
+            [self.bin_path],
+            input=body, env=cgienv,
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            check=True
+        ).stdout
+        return output.split(b'\r\n\r\n', 1)[1]
+
+    def _probe(self, git_dir):
+        """Learn capabilities from git-http-backend and check native output matches
+
+        :arg git_dir: str, path to repo
+        :return: tuple of capabilities before and after symref, None if native output can't be used
+        :raises RuntimeError: if refs are changing too fast to check
+        """
+        hidden = subprocess.run(
+            ['git', '--git-dir={}'.format(git_dir), 'config', '--get-regexp', r'^(uploadpack|transfer)\.hiderefs$'],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=False
+        )
+        if hidden.returncode == 0:
+            logging.info("Hidden refs configured, native ref advertisement not used for: %s", git_dir)
+            return None
+        for _ in range(3):
+            before = self.snapshot(git_dir)
+            backend_v0 = self._backend(git_dir, 'GET', 'service=git-upload-pack')
+            arguments = ['peel', 'symrefs', 'unborn']
+            request = pkt_line('command=ls-refs\n') + DELIM + b''.join(pkt_line(argument + '\n') for argument in arguments) + FLUSH
+            backend_v2 = self._backend(git_dir, 'POST', '', request)
+            after = self.snapshot(git_dir)
+            if before is not after or not after.is_current():
+                # refs changed while checking - try again
+                continue
+            match = re.search(rb'\0([^\n]*)\n', backend_v0)
+            if match is None:
+                # no refs, so no capabilities advertised
+                capabilities = ((), ())
+            else:
+                tokens = match.group(1).decode('utf-8').split(' ')
+                position = len(tokens)
+                for index, token in enumerate(tokens):
+                    if token.startswith('symref=HEAD:'):
+                        position = index
+                    elif token.startswith('object-format=') and position == len(tokens):
+                        position = index
+                tokens = [token for token in tokens if not token.startswith('symref=HEAD:')]
+                capabilities = (tuple(tokens[:position]), tuple(tokens[position:]))
+            if after.advertisement_v0(capabilities) != backend_v0:
+                logging.warning("Native ref advertisement differs from git-http-backend, not used for: %s", git_dir)
+                return None
+            if after.ls_refs(arguments) != backend_v2:
+                logging.warning("Native ls-refs differs from git-http-backend, not used for: %s", git_dir)
+                return None
+            return capabilities
+        raise RuntimeError("Refs changing too fast to check native ref advertisement for: {}".format(git_dir))
+
+    def capabilities(self, git_dir):
+        """Capabilities for the repo if native output can be used
+
+        :arg git_dir: str, path to repo
+        :return: tuple of capabilities before and after symref, None if native output can't be used
+        """
+        try:
+            stat = os.stat(os.path.join(git_dir, 'config'))
+            config_signature = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        except FileNotFoundError:
+            config_signature = None
+        snapshot = self.snapshot(git_dir)
+        signature = (config_signature, snapshot.head_oid is not None or bool(snapshot.names))
+        probe = self.probes.get(git_dir)
+        if probe is not None and probe[0] == signature:
+            return probe[1]
+        try:
+            capabilities = self._probe(git_dir)
+        except RuntimeError as exc:
+            # try again next time
+            logging.info("%s", exc)
+            return None
+        except (subprocess.CalledProcessError, OSError, IndexError):
+            logging.error("Unable to check native ref advertisement for: %s", git_dir, exc_info=True)
+            capabilities = None
+        # failures are only retried when the config changes
+        self.probes[git_dir] = (signature, capabilities)
+        return capabilities
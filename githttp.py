@@ -21,15 +21,30 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import logging
 import re
-import tempfile
 import subprocess
-import imp
+import importlib.util
+import atexit
 import os
 import json
 import base64
+import fnmatch
 import yaml
 import select
+import errno
+import io
 import fcntl
+import contextlib
+import threading
+import time
+import werkzeug.exceptions
+import git_refs
+import pack_cache
+import metrics
+import admission
+import repo_registry
+import lfs
+import bundles
+import replication
 
 
 
@@ -78,6 +93,407 @@ def githandler(project, project_group=None, sub_path=None):
     :arg project_group: str|None, project group (directory) or None for top level
     :arg sub_path: str|None, any path elements below the repo requested
     """
+    start = time.monotonic()
+    config = load_config()
+    flask.g.metrics = get_metrics(config)
+    flask.g.metrics.observe('phase_seconds', time.monotonic() - start, phase='config_load')
+    flask.g.service = request_service(sub_path, flask.request.args)
+    project = validate_request(flask.request.method, project, project_group, sub_path, flask.request.args)
+    authenticated_user, groups, info, repo_path = authorise_request(
+        config, flask.request.method, project, project_group, sub_path, flask.request.args,
+        flask.request.remote_user, flask.request.headers.get('authorization')
+    )
+    project_root = None
+    if config.get('replication') and 'git-upload-pack' in [sub_path, flask.request.args.get('service')]:
+        project_root, repo_path = read_replica(config, project, project_group, authenticated_user, repo_path)
+
+    # serve refs without running git-http-backend where possible
+    stream = flask.request.stream if flask.request.method == 'POST' else None
+    if config.get('native_refs', False) and 'git-upload-pack' in [sub_path, flask.request.args.get('service')]:
+        response, stream = native_refs(config['bin_path'], repo_path, sub_path, stream)
+        if response is not None:
+            return response
+
+    # run the cgi-bin with wrapper with appropriate environment variables
+    extra_env = backend_env(config, authenticated_user, groups, info)
+    if project_root is not None:
+        extra_env['GIT_PROJECT_ROOT'] = project_root
+    if config.get('bundles') and config['bundles'].get('advertise', True) \
+            and 'git-upload-pack' in [sub_path, flask.request.args.get('service')]:
+        # protocol v2 bundle-uri, with git 2.40+
+        get_bundle_store(config['bundles']).config_env(
+            project if project_group is None else os.path.join(project_group, project),
+            repo_url(config['bundles'].get('base_url'), project[:-len('.git')], project_group, flask.request.environ) + 'bundles/',
+            extra_env
+        )
+    if flask.request.method == 'POST':
+        if sub_path in admission.SERVICES and config.get('admission'):
+            # slot is taken only when git-http-backend is about to run
+            flask.g.admission = (get_scheduler(config['admission']), repo_path, sub_path, authenticated_user)
+        cleanup = contextlib.ExitStack()
+        if sub_path == 'git-upload-pack' and config.get('pack_cache'):
+            return cached_upload_pack(config, repo_path, extra_env, stream, cleanup)
+        pass_fds = ()
+        if sub_path == 'git-receive-pack':
+            # hooks log back over a pipe while the response is streamed
+            hook_log = cleanup.enter_context(HookLog())
+            extra_env['GIT4NGINX_LOG_FD'] = str(hook_log.write_fd)
+            pass_fds = (hook_log.write_fd, )
+        return cgi_wrapper(config['bin_path'], extra_env, stream, cleanup, config.get('cgi'), pass_fds=pass_fds)
+    return cgi_wrapper(config['bin_path'], extra_env, cgi_config=config.get('cgi'))
+
+
+
+@app.after_request
+def record_request(response):
+    """Count requests handled by githandler and save metrics once the response is sent
+    """
+    collector = flask.g.get('metrics')
+    if collector is not None:
+        collector.inc('requests_total', service=flask.g.service, code=response.status_code)
+        response.call_on_close(collector.flush)
+    return response
+
+
+
+@app.route('/metrics')
+def metrics_handler():
+    """Metrics for all workers (Prometheus text format), if enabled
+    """
+    config = load_config()
+    collector = get_metrics(config)
+    if collector is metrics.NULL_METRICS:
+        flask.abort(404)
+    extra_counters = {}
+    if config.get('pack_cache'):
+        for name, value in get_pack_cache(config['pack_cache']).stats().items():
+            extra_counters['pack_cache_{}_total'.format(name)] = ("Pack cache {}".format(name.replace('_', ' ')), value)
+    return flask.Response(
+        collector.render(extra_counters),
+        200,
+        {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+    )
+
+
+
+# repos per page from /repos, default and maximum
+REPO_LIST_LIMIT = 100
+REPO_LIST_MAX = 1000
+
+@app.route('/repos')
+def repos_handler():
+    """Repos the user can read (JSON), if the repo registry is enabled
+
+    Query arguments (all optional):
+        group - only repos in this project group
+        after - name to continue from, "next" of the previous page
+        limit - repos per page
+    """
+    config = load_config()
+    if not config.get('repo_registry'):
+        flask.abort(404)
+    authenticated_user, groups, _ = authenticate_request(
+        config, flask.request.remote_user, flask.request.headers.get('authorization')
+    )
+    try:
+        limit = min(max(int(flask.request.args.get('limit', REPO_LIST_LIMIT)), 1), REPO_LIST_MAX)
+    except ValueError:
+        flask.abort(400)
+    only_group = flask.request.args.get('group')
+    try:
+        names = get_repo_registry(config).names(flask.request.args.get('after'))
+    except OSError as exc:
+        app.logger.critical("Configured repo_root can not be read: %s", exc)
+        flask.abort(500)
+    repos = []
+    next_name = None
+    for name, project_group, project in names:
+        if only_group is not None and project_group != only_group:
+            continue
+        permission = config_cache.permission_index.get_permission(project_group, project, authenticated_user, groups)
+        if not permission['read']:
+            continue
+        if len(repos) == limit:
+            next_name = repos[-1]['name']
+            break
+        repos.append({'name': name, 'project_group': project_group, 'project': project, 'write': permission['write']})
+    return flask.jsonify(repos=repos, next=next_name)
+
+
+
+# Git LFS (https://github.com/git-lfs/git-lfs/blob/main/docs/api/batch.md)
+# only metadata and uploads come through here, downloads are served by nginx
+@app.route('/<string:project>.git/info/lfs/objects/batch', methods=['POST'])
+@app.route('/<string:project_group>/<string:project>.git/info/lfs/objects/batch', methods=['POST'])
+def lfs_batch_handler(project, project_group=None):
+    """Git LFS batch API - where to transfer objects to/from
+
+    :arg project: str, project name with .git removed
+    :arg project_group: str|None, project group (directory) or None for top level
+    """
+    config = load_config()
+    request = flask.request.get_json(force=True, silent=True)
+    if not isinstance(request, dict) or request.get('operation') not in ['download', 'upload'] \
+            or not isinstance(request.get('objects'), list):
+        return lfs_error(422, "Invalid batch request")
+    if 'basic' not in request.get('transfers', ['basic']):
+        return lfs_error(422, "Only the basic transfer adapter is supported")
+    lfs_config, repo_path = lfs_authorise(config, project, project_group, request['operation'] == 'upload')
+    href = lfs_href(lfs_config, project, project_group, flask.request.environ)
+    headers = {}
+    if flask.request.headers.get('authorization'):
+        headers['Authorization'] = flask.request.headers['authorization']
+    try:
+        objects = lfs.batch_objects(
+            repo_path, request['operation'], request['objects'], href, headers, lfs_config.get('max_object_size')
+        )
+    except ValueError as exc:
+        return lfs_error(422, str(exc))
+    return lfs_response({'transfer': 'basic', 'objects': objects}, 200)
+
+
+@app.route('/<string:project>.git/info/lfs/objects/<string:oid>', methods=['GET', 'PUT'])
+@app.route('/<string:project_group>/<string:project>.git/info/lfs/objects/<string:oid>', methods=['GET', 'PUT'])
+def lfs_object_handler(project, oid, project_group=None):
+    """Git LFS object download (handed to nginx) or upload
+
+    :arg project: str, project name with .git removed
+    :arg oid: str, object SHA-256
+    :arg project_group: str|None, project group (directory) or None for top level
+    """
+    config = load_config()
+    if not lfs.OID_RE.match(oid):
+        return lfs_error(404, "Object does not exist")
+    is_write = flask.request.method == 'PUT'
+    lfs_config, repo_path = lfs_authorise(config, project, project_group, is_write)
+    if is_write:
+        size = flask.request.content_length
+        if size is None:
+            return lfs_error(411, "Content-Length required")
+        if lfs_config.get('max_object_size') is not None and size > lfs_config['max_object_size']:
+            return lfs_error(413, "Object larger than {} bytes".format(lfs_config['max_object_size']))
+        if lfs.object_size(repo_path, oid) is None:
+            try:
+                lfs.store_object(repo_path, oid, size, flask.request.stream, (config.get('cgi') or {}).get('buffer_size', lfs.CHUNK_SIZE))
+            except ValueError as exc:
+                app.logger.warning("LFS upload rejected for %s: %s", repo_path, exc)
+                return lfs_error(422, str(exc))
+        return flask.Response(b'', 200)
+    path = lfs.object_path(repo_path, oid)
+    if not os.path.isfile(path):
+        return lfs_error(404, "Object does not exist")
+    if lfs_config.get('accel_redirect'):
+        # nginx sends the file from an internal location mapped on to repo_root
+        response = flask.Response(b'', 200, {'Content-Type': 'application/octet-stream'})
+        response.headers['X-Accel-Redirect'] = lfs_config['accel_redirect'].rstrip('/') + '/' \
+            + os.path.relpath(path, config['repo_root'])
+        return response
+    # served by the app, for testing without nginx
+    return flask.send_file(path, mimetype='application/octet-stream')
+
+
+@app.route('/<string:project>.git/info/lfs/<path:sub_path>', methods=['GET', 'POST', 'PUT', 'DELETE'])
+@app.route('/<string:project_group>/<string:project>.git/info/lfs/<path:sub_path>', methods=['GET', 'POST', 'PUT', 'DELETE'])
+def lfs_unsupported_handler(project, sub_path, project_group=None):
+    """Other Git LFS APIs (eg. locking) - clients carry on without them
+    """
+    # pylint: disable=unused-argument
+    if get_lfs_config(load_config()) is None:
+        flask.abort(404)
+    return lfs_error(404, "Not supported")
+
+
+def lfs_authorise(config, project, project_group, is_write):
+    """Check LFS is enabled and the user has permission for the repo
+
+    :arg config: dict, app config
+    :arg project: str, project name with .git removed
+    :arg project_group: str|None, project group (directory) or None for top level
+    :arg is_write: bool, write access needed
+    :return: tuple of lfs config (dict), repo path
+    """
+    lfs_config = get_lfs_config(config)
+    if lfs_config is None:
+        flask.abort(404)
+    return lfs_config, static_authorise(config, 'git-lfs', project, project_group, 'info/lfs', is_write)
+
+
+def lfs_href(lfs_config, project, project_group, environ):
+    """Base URL objects are transferred with
+
+    :arg lfs_config: dict, lfs section of app config
+    :arg project: str, project name with .git removed
+    :arg project_group: str|None, project group (directory) or None for top level
+    :arg environ: dict, WSGI environ of the batch request
+    :return: str, URL ending /
+    """
+    return repo_url(lfs_config.get('base_url'), project, project_group, environ) + 'info/lfs/objects/'
+
+
+def get_lfs_config(config):
+    """LFS settings if enabled
+
+    :arg config: dict, app config
+    :return: dict|None, None if LFS is not enabled
+    """
+    lfs_config = config.get('lfs')
+    if not lfs_config:
+        return None
+    return lfs_config if isinstance(lfs_config, dict) else {}
+
+
+def lfs_response(body, code):
+    """JSON response in the Git LFS media type
+
+    :arg body: dict
+    :arg code: int, HTTP status
+    :return: flask.Response
+    """
+    return flask.Response(json.dumps(body), code, {'Content-Type': lfs.MEDIA_TYPE})
+
+
+def lfs_error(code, message):
+    """Git LFS error response
+
+    :arg code: int, HTTP status
+    :arg message: str
+    :return: flask.Response
+    """
+    return lfs_response({'message': message}, code)
+
+
+
+@app.route('/<string:project>.git/bundles/<string:name>')
+@app.route('/<string:project_group>/<string:project>.git/bundles/<string:name>')
+def bundle_handler(project, name, project_group=None):
+    """Clone bundles - the bundle list (git clone --bundle-uri) or a bundle (handed to nginx)
+
+    :arg project: str, project name with .git removed
+    :arg name: str, list or bundle file
+    :arg project_group: str|None, project group (directory) or None for top level
+    """
+    config = load_config()
+    if not config.get('bundles'):
+        flask.abort(404)
+    static_authorise(config, 'git-bundle', project, project_group, 'bundles', False)
+    store = get_bundle_store(config['bundles'])
+    repo = project + '.git' if project_group is None else os.path.join(project_group, project + '.git')
+    if name == 'list':
+        if not store.manifest(repo):
+            flask.abort(404)
+        body = store.bundle_list(
+            repo, repo_url(config['bundles'].get('base_url'), project, project_group, flask.request.environ) + 'bundles/'
+        )
+        return flask.Response(body, 200, {'Content-Type': 'text/plain; charset=utf-8'})
+    path = store.bundle_path(repo, name)
+    if path is None or not os.path.isfile(path):
+        flask.abort(404)
+    if config['bundles'].get('accel_redirect'):
+        # nginx sends the file from an internal location mapped on to the bundles path
+        response = flask.Response(b'', 200, {'Content-Type': 'application/octet-stream'})
+        response.headers['X-Accel-Redirect'] = config['bundles']['accel_redirect'].rstrip('/') + '/' \
+            + os.path.relpath(path, config['bundles']['path'])
+        return response
+    # served by the app, for testing without nginx
+    return flask.send_file(path, mimetype='application/octet-stream')
+
+
+def static_authorise(config, service, project, project_group, sub_path, is_write):
+    """Check permission for a request served outside git-http-backend
+
+    :arg config: dict, app config
+    :arg service: str, label for metrics
+    :arg project: str, project name with .git removed
+    :arg project_group: str|None, project group (directory) or None for top level
+    :arg sub_path: str, path below the repo, for logging
+    :arg is_write: bool, write access needed
+    :return: str, repo path
+    """
+    flask.g.metrics = get_metrics(config)
+    flask.g.service = service
+    if not re.match(r'^[\w\-]{3,64}$', project) or project_group is not None and not re.match(r'^[\w\-]{3,64}$', project_group):
+        app.logger.critical("Unexpected repo for %s: %s/%s", service, project_group, project)
+        flask.abort(400)
+    _, _, _, repo_path = authorise_request(
+        config, flask.request.method, project + '.git', project_group, sub_path, flask.request.args,
+        flask.request.remote_user, flask.request.headers.get('authorization'), is_write=is_write
+    )
+    return repo_path
+
+
+def repo_url(base_url, project, project_group, environ):
+    """URL of a repo as seen by clients
+
+    :arg base_url: str|None, configured URL repos are below, None to work out from the request
+    :arg project: str, project name with .git removed
+    :arg project_group: str|None, project group (directory) or None for top level
+    :arg environ: dict, WSGI environ
+    :return: str, URL ending .git/
+    """
+    repo = project + '.git/' if project_group is None else '{}/{}.git/'.format(project_group, project)
+    if base_url:
+        return '{}/{}'.format(base_url.rstrip('/'), repo)
+    # the URI the client used, before any rewrites in nginx
+    path = environ.get('REQUEST_URI', '').split('?')[0]
+    if '/' + repo not in path:
+        path = flask.request.script_root + flask.request.path
+    return flask.request.host_url.rstrip('/') + path[:path.index('/' + repo) + len(repo) + 1]
+
+
+
+bundle_stores = {}
+
+def get_bundle_store(bundles_config):
+    """Bundle store for this worker
+
+    :arg bundles_config: dict, bundles config
+    :return: bundles.BundleStore
+    """
+    if bundles_config['path'] not in bundle_stores:
+        bundle_stores[bundles_config['path']] = bundles.from_config({'bundles': bundles_config})
+    return bundle_stores[bundles_config['path']]
+
+
+
+metrics_collectors = {}
+
+def get_metrics(config):
+    """Metrics collector for this worker
+
+    :arg config: dict, app config
+    :return: metrics.Metrics, or metrics.NULL_METRICS if not enabled
+    """
+    if not config.get('metrics'):
+        return metrics.NULL_METRICS
+    path = config['metrics']['path']
+    if path not in metrics_collectors:
+        metrics_collectors[path] = metrics.Metrics(path)
+    return metrics_collectors[path]
+
+
+def request_service(sub_path, args):
+    """Service a request is for, used to label metrics
+
+    :arg sub_path: str|None, any path elements below the repo requested
+    :arg args: dict, query arguments
+    :return: str, git-upload-pack, git-receive-pack or other
+    """
+    for service in [sub_path, args.get('service')]:
+        if service in ['git-upload-pack', 'git-receive-pack']:
+            return service
+    return 'other'
+
+
+def validate_request(method, project, project_group, sub_path, args):
+    """Sanity check the request against what git clients use
+
+    :arg method: str, HTTP method
+    :arg project: str, project name with .git removed
+    :arg project_group: str|None, project group (directory) or None for top level
+    :arg sub_path: str|None, any path elements below the repo requested
+    :arg args: dict, query arguments
+    :return: str, project name with .git
+    """
     # sanity check inputs - limit these within known safe bounds
     if len(project) > 64:
         app.logger.error("Error: Project names are limited to 64 characters (before .git)")
@@ -90,75 +506,59 @@ def githandler(project, project_group=None, sub_path=None):
         if not re.match(r'^[\w\-]{3,64}$', project_group):
             app.logger.error("Error: Project Group names are limited 3-64 alphanumerics, underscore '_' and hyphon '-'")
     # sanity checking sub_path and query based on https://www.git-scm.com/docs/http-protocol
-    if flask.request.method == 'GET':
+    if method == 'GET':
         if sub_path == 'info/refs':
-            if len(flask.request.args) != 1 or 'service' not in flask.request.args:
-                app.logger.critical("Unexpected query for GET %s: %s", sub_path, str(flask.request.args))
+            if len(args) != 1 or 'service' not in args:
+                app.logger.critical("Unexpected query for GET %s: %s", sub_path, str(args))
                 flask.abort(400)
-            if flask.request.args['service'] not in ['git-upload-pack', 'git-receive-pack']:
-                app.logger.critical("Unexpected query for GET %s: %s", sub_path, str(flask.request.args))
+            if args['service'] not in ['git-upload-pack', 'git-receive-pack']:
+                app.logger.critical("Unexpected query for GET %s: %s", sub_path, str(args))
                 flask.abort(400)
         else:
             app.logger.critical("Unexpected sub_path for GET: %s", sub_path)
             flask.abort(400)
-    elif flask.request.method == 'POST':
+    elif method == 'POST':
         if sub_path not in ['git-receive-pack', 'git-upload-pack']:
             app.logger.critical("Unexpected sub_path for POST: %s", sub_path)
             flask.abort(400)
     else:
-        app.logger.critical("Unexpected HTTP METHOD: %s", flask.request.method)
+        app.logger.critical("Unexpected HTTP METHOD: %s", method)
         flask.abort(400)
+    return project
 
-    # load config
-    config = load_config()
-    # work out the type of operation
-    is_write = False if flask.request.args.get('service') != 'git-receive-pack' and sub_path != 'git-receive-pack' else True
 
-    # work out available authentication
-    username = flask.request.remote_user
-    password = None
-    if username is None:
-        # then we didn't get authentication from upstream so we do it ourselves
-        app.logger.info("Authentication no provided from upstream so performing headers...")
-        auth_header = flask.request.headers.get('authorization')
-        if auth_header is None:
-            app.logger.info("No authentication headers for Basic. Prompting client.")
-            flask.abort(401)
-        elif not auth_header.startswith('Basic '):
-            app.logger.error("Authentication header does not start \"Basic\"")
-            flask.abort(400)
-        else:
-            auth_info = base64.b64decode(auth_header[6:])
-            username, password = auth_info.decode('utf-8').split(':', 1)
-    # if we failed to get any user then we most likley have a configuration problem
-    if username is None:
-        app.logger.critical("No username can be determined for authentication. Configuration problem?")
-        flask.abort(500)
-    # authentication plugin
-    auth_plugin_name = config['authentication']['plugin']
-    app.logger.info("Loading authentication plugin: %s", auth_plugin_name)
-    auth_plugin_path = os.path.dirname(os.path.realpath(__file__))
-    auth_plugin_path = os.path.join(auth_plugin_path, 'authentication_plugins')
-    info = imp.find_module(auth_plugin_name, [auth_plugin_path])
-    auth_plugin = imp.load_module(auth_plugin_name, *info)
-    app.logger.info("Checking authentication with plugin...")
-    authenticated, groups, info = auth_plugin.authenticate(app.logger, config['authentication']['plugin_config'], username, password)
-    if authenticated:
-        authenticated_user = username
-        app.logger.info("Successful authentication for user: %s", authenticated_user)
-    else:
-        app.logger.warning("Authentication failed for user: %s", username)
-        flask.abort(401)
+def authorise_request(config, method, project, project_group, sub_path, args, username, auth_header, is_write=None):
+    """Authenticate the user and check they have permission for the repo
 
+    :arg config: dict, app config
+    :arg method: str, HTTP method
+    :arg project: str, project name with .git
+    :arg project_group: str|None, project group (directory) or None for top level
+    :arg sub_path: str|None, any path elements below the repo requested
+    :arg args: dict, query arguments
+    :arg username: str|None, user authenticated upstream (REMOTE_USER)
+    :arg auth_header: str|None, Authorization header
+    :arg is_write: bool|None, write access needed, None to work out from the git request
+    :return: tuple of:
+        authenticated user, str
+        groups, list - groups user has membership of
+        info, dict - additional info exposed to hooks
+        repo path, str
+    """
+    # work out the type of operation
+    if is_write is None:
+        is_write = False if args.get('service') != 'git-receive-pack' and sub_path != 'git-receive-pack' else True
+    authenticated_user, groups, info = authenticate_request(config, username, auth_header)
 
     # logging details for now
-    app.logger.info("handler: %s %s / %s / %s", flask.request.method, project_group, project, sub_path)
+    app.logger.info("handler: %s %s / %s / %s", method, project_group, project, sub_path)
     app.logger.info("        :: %s", authenticated_user)
     app.logger.info("        :: %s", groups)
     app.logger.info("        : write %s", is_write)
 
     # determine and log permission for this request
-    permission = Permissions(config['authorisation'], authenticated_user, groups).get_permission(project_group, project)
+    with get_metrics(config).time('phase_seconds', phase='authorisation'):
+        permission = config_cache.permission_index.get_permission(project_group, project, authenticated_user, groups)
     if permission['write'] and permission['read']:
         app.logger.info("User %s has permissions for read & write on: %s/%s", authenticated_user, project_group, project)
     elif permission['write']:
@@ -173,6 +573,16 @@ def githandler(project, project_group=None, sub_path=None):
         flask.abort(403)
 
     # sanity check repo exists
+    if config.get('repo_registry'):
+        try:
+            repo_path = get_repo_registry(config).lookup(project_group, project)
+        except OSError as exc:
+            app.logger.critical("Configured repo_root can not be read: %s", exc)
+            flask.abort(500)
+        if repo_path is None:
+            app.logger.warning("Requested repo does not exist: %s/%s", project_group, project)
+            flask.abort(404)
+        return authenticated_user, groups, info, repo_path
     repo_path = config['repo_root']
     if not os.path.isdir(repo_path):
         app.logger.critical("Configured repo_root does not exist: %s", repo_path)
@@ -183,8 +593,64 @@ def githandler(project, project_group=None, sub_path=None):
     if not os.path.isdir(repo_path):
         app.logger.warning("Requested repo does not exist: %s", repo_path)
         flask.abort(404)
+    return authenticated_user, groups, info, repo_path
 
-    # run the cgi-bin with wrapper with appropriate environment variables
+
+def authenticate_request(config, username, auth_header):
+    """Authenticate the user
+
+    :arg config: dict, app config
+    :arg username: str|None, user authenticated upstream (REMOTE_USER)
+    :arg auth_header: str|None, Authorization header
+    :return: tuple of:
+        authenticated user, str
+        groups, list - groups user has membership of
+        info, dict - additional info exposed to hooks
+    """
+    # work out available authentication
+    password = None
+    if username is None:
+        # then we didn't get authentication from upstream so we do it ourselves
+        app.logger.info("Authentication no provided from upstream so performing headers...")
+        if auth_header is None:
+            app.logger.info("No authentication headers for Basic. Prompting client.")
+            flask.abort(401)
+        elif not auth_header.startswith('Basic '):
+            app.logger.error("Authentication header does not start \"Basic\"")
+            flask.abort(400)
+        else:
+            auth_info = base64.b64decode(auth_header[6:])
+            username, password = auth_info.decode('utf-8').split(':', 1)
+    # if we failed to get any user then we most likley have a configuration problem
+    if username is None:
+        app.logger.critical("No username can be determined for authentication. Configuration problem?")
+        flask.abort(500)
+    # authentication plugin
+    auth_plugin = auth_plugins.get(config['authentication']['plugin'], config['authentication']['plugin_config'])
+    if auth_plugin is None:
+        flask.abort(500)
+    app.logger.info("Checking authentication with plugin...")
+    collector = get_metrics(config)
+    with collector.time('phase_seconds', phase='authentication'):
+        authenticated, groups, info = auth_plugin.authenticate(app.logger, config['authentication']['plugin_config'], username, password)
+    if authenticated:
+        authenticated_user = username
+        app.logger.info("Successful authentication for user: %s", authenticated_user)
+    else:
+        app.logger.warning("Authentication failed for user: %s", username)
+        flask.abort(401)
+    return authenticated_user, groups, info
+
+
+def backend_env(config, authenticated_user, groups, info):
+    """Environment for git-http-backend (and hooks) in addition to the request
+
+    :arg config: dict, app config
+    :arg authenticated_user: str
+    :arg groups: list, groups user has membership of
+    :arg info: dict, additional info exposed to hooks
+    :return: dict
+    """
     extra_env = {
         # config
         'GIT4NGINX_CONFIG': os.environ['GIT4NGINX_CONFIG'],
@@ -196,19 +662,326 @@ def githandler(project, project_group=None, sub_path=None):
         'GIT4NGINX_GROUPS': json.dumps(groups),
         'GIT4NGINX_INFO': json.dumps(info),
     }
-    if flask.request.method == 'POST':
-        with HookLogDir() as temp_log_dir:
-            extra_env['GIT4NGINX_LOG_DIR'] = temp_log_dir
-            response = cgi_wrapper(config['bin_path'], extra_env, flask.request.stream)
-        return response
-    return cgi_wrapper(config['bin_path'], extra_env)
+    if (config.get('hook_daemon') or {}).get('socket'):
+        # master hooks forward to the hook daemon if running
+        extra_env['GIT4NGINX_HOOK_SOCKET'] = config['hook_daemon']['socket']
+    return extra_env
+
+
+
+
+
+ref_caches = {}
+
+def get_ref_cache(bin_path):
+    """Ref cache for this worker
+
+    :arg bin_path: str, path to git-http-backend
+    :return: git_refs.RefCache
+    """
+    if bin_path not in ref_caches:
+        ref_caches[bin_path] = git_refs.RefCache(bin_path)
+    return ref_caches[bin_path]
+
+
+def native_refs(bin_path, repo_path, sub_path, stream=None):
+    """Serve upload-pack ref advertisement (protocol v0) and ls-refs (protocol v2) from cached refs
+
+    :arg bin_path: str, path to git-http-backend
+    :arg repo_path: str, path to repo
+    :arg sub_path: str, path requested below the repo
+    :arg stream: stream|None, request body
+    :return: tuple of:
+        response, flask.Response|None - None where git-http-backend must be used
+        stream, stream|None - request body for git-http-backend, as it may have been partly read
+    """
+    ref_cache = get_ref_cache(bin_path)
+    protocol = [
+        item for item in flask.request.environ.get('HTTP_GIT_PROTOCOL', '').split(':')
+        if item.startswith('version=')
+    ]
+    if sub_path == 'info/refs':
+        if protocol and protocol != ['version=0']:
+            return None, stream
+        content_type = 'application/x-git-upload-pack-advertisement'
+        capabilities = ref_cache.capabilities(repo_path)
+        if capabilities is None:
+            return None, stream
+        body = ref_cache.snapshot(repo_path).advertisement_v0(capabilities)
+    else:
+        if 'version=2' not in protocol or flask.request.headers.get('Content-Encoding'):
+            return None, stream
+        content_type = 'application/x-git-upload-pack-result'
+        # only ls-refs is handled, anything else goes to git-http-backend
+        try:
+            packets, raw = git_refs.read_pkt_lines(stream)
+        except ValueError as exc:
+            return None, PrefixedStream(exc.args[1], stream)
+        if packets[0] != b'command=ls-refs\n':
+            return None, PrefixedStream(raw, stream)
+        capabilities = ref_cache.capabilities(repo_path)
+        if capabilities is None:
+            return None, PrefixedStream(raw, stream)
+        arguments = [
+            packet.decode('utf-8').rstrip('\n')
+            for packet in packets[packets.index(None) + 1:-1]   # after delim (if present)
+        ]
+        body = ref_cache.snapshot(repo_path).ls_refs(arguments)
+    app.logger.info("Serving native refs for: %s", repo_path)
+    response = flask.Response(body, 200)
+    for name, value in git_refs.NO_CACHE_HEADERS:
+        response.headers[name] = value
+    response.headers['Content-Type'] = content_type
+    return response, stream
+
+
+
+pack_caches = {}
+
+def get_pack_cache(cache_config):
+    """Pack cache for this worker
+
+    :arg cache_config: dict, pack_cache config
+    :return: pack_cache.PackCache
+    """
+    if cache_config['path'] not in pack_caches:
+        pack_caches[cache_config['path']] = pack_cache.PackCache(
+            cache_config['path'],
+            cache_config['max_bytes'],
+            cache_config.get('max_request', 1048576)
+        )
+    return pack_caches[cache_config['path']]
+
+
+
+repo_registries = {}
+
+def get_repo_registry(config):
+    """Repo registry for this worker
+
+    :arg config: dict, app config (repo_registry may be true or a map of options)
+    :return: repo_registry.RepoRegistry
+    """
+    registry_config = config['repo_registry'] if isinstance(config['repo_registry'], dict) else {}
+    if config['repo_root'] not in repo_registries:
+        repo_registries[config['repo_root']] = repo_registry.RepoRegistry(
+            config['repo_root'],
+            registry_config.get('rescan_interval', 300),
+            registry_config.get('inotify', True)
+        )
+    return repo_registries[config['repo_root']]
+
+
+
+replicators = {}
+
+def get_replicator(config):
+    """Replicator for this worker
+
+    :arg config: dict, app config
+    :return: replication.Replicator
+    """
+    if config['replication']['path'] not in replicators:
+        replicators[config['replication']['path']] = replication.from_config(config)
+    return replicators[config['replication']['path']]
 
 
+def read_replica(config, project, project_group, user, repo_path):
+    """Where to serve a fetch from - a replica in step with the primary, else the primary
+
+    :arg config: dict, app config
+    :arg project: str, project name with .git
+    :arg project_group: str|None, project group (directory) or None for top level
+    :arg user: str, authenticated user
+    :arg repo_path: str, path to repo on the primary
+    :return: tuple of:
+        replica repo root, str|None - None for the primary
+        repo path, str
+    """
+    repo = project if project_group is None else os.path.join(project_group, project)
+    ref_cache = get_ref_cache(config['bin_path'])
+    with flask.g.metrics.time('phase_seconds', phase='replica_routing'):
+        replica = get_replicator(config).read_replica(repo, user, lambda path: ref_cache.snapshot(path).fingerprint())
+    flask.g.metrics.inc('replica_reads_total', replica='primary' if replica is None else replica[0])
+    if replica is None:
+        return None, repo_path
+    app.logger.info("Serving %s from replica %s", repo, replica[0])
+    return replica[1], os.path.join(replica[1], repo)
+
+
+
+schedulers = {}
+
+def get_scheduler(admission_config):
+    """Admission scheduler for this worker
+
+    :arg admission_config: dict, admission config
+    :return: admission.Scheduler
+    """
+    if admission_config['path'] not in schedulers:
+        schedulers[admission_config['path']] = admission.Scheduler(
+            admission_config['path'],
+            admission_config.get('limits'),
+            admission_config.get('repo_limits'),
+            admission_config.get('max_wait', 30.0),
+            admission_config.get('retry_after', 10)
+        )
+    return schedulers[admission_config['path']]
+
+
+def admit(cleanup):
+    """Wait for a slot to run git-http-backend when admission control applies
+
+    :arg cleanup: contextlib.ExitStack, releases the slot once the response is complete
+    :raises werkzeug.exceptions.ServiceUnavailable: if no slot is available in time
+    """
+    waiting = flask.g.get('admission')
+    if waiting is None:
+        return
+    scheduler, repo_path, service, user = waiting
+    with flask.g.get('metrics', metrics.NULL_METRICS).time('phase_seconds', phase='admission'):
+        request_id = scheduler.acquire(repo_path, service, user)
+    if request_id is None:
+        app.logger.warning("Too busy to run %s for %s on: %s", service, user, repo_path)
+        raise werkzeug.exceptions.ServiceUnavailable("Server busy, try again later", retry_after=scheduler.retry_after)
+    cleanup.callback(scheduler.release, request_id)
+
+
+def cached_upload_pack(config, repo_path, extra_env, stream, cleanup):
+    """Serve upload-pack from the pack cache, else run git-http-backend storing the response
+
+    :arg config: dict, app config
+    :arg repo_path: str, path to repo
+    :arg extra_env: dict, additional environment for the cgi
+    :arg stream: stream, request body
+    :arg cleanup: contextlib.ExitStack, closed once the response is complete
+    :return: flask response
+    """
+    cache_config = config['pack_cache']
+    cache = get_pack_cache(cache_config)
+    # request must be read to work out the key
+    if (flask.request.content_length or 0) > cache.max_request:
+        return cgi_wrapper(config['bin_path'], extra_env, stream, cleanup, config.get('cgi'))
+    body = b''
+    while len(body) <= cache.max_request:
+        data = stream.read(cache.max_request + 1 - len(body))
+        if not data:
+            break
+        body += data
+    if len(body) > cache.max_request:
+        return cgi_wrapper(config['bin_path'], extra_env, PrefixedStream(body, stream), cleanup, config.get('cgi'))
+    fingerprint = get_ref_cache(config['bin_path']).snapshot(repo_path).fingerprint()
+    key = pack_cache.request_key(
+        repo_path,
+        flask.request.environ.get('HTTP_GIT_PROTOCOL', ''),
+        body,
+        fingerprint,
+        flask.request.headers.get('Content-Encoding')
+    )
+    if key is None:
+        # not a final request producing a pack
+        return cgi_wrapper(config['bin_path'], extra_env, io.BytesIO(body), cleanup, config.get('cgi'))
+    writer = None
+    for _ in range(3):
+        entry = cache.open(key, fingerprint)
+        if entry is not None:
+            break
+        if not cache_config.get('coalesce', False):
+            writer = cache.writer(key, fingerprint)
+            break
+        # single-flight: lead, or follow an identical request already running
+        try:
+            writer = cache.writer(key, fingerprint, flight=True)
+            break
+        except FileExistsError:
+            pass
+        follower = cache.follow(key)
+        if follower is None:
+            # just finished - should now be cached
+            continue
+        metadata = follower.metadata()
+        if metadata is not None:
+            cleanup.close()
+            app.logger.info("Pack cache following: %s", key)
+            return cached_response(cache, metadata, follower.iter_body(), follower.close, coalesced=1)
+        # leader failed, retry (probably leading ourselves)
+        follower.close()
+    if entry is None:
+        app.logger.info("Pack cache miss: %s", key)
+        cache.count(misses=1)
+        return cgi_wrapper(config['bin_path'], extra_env, io.BytesIO(body), cleanup, config.get('cgi'), writer)
+    metadata, f_entry = entry
+    cleanup.close()
+    app.logger.info("Pack cache hit: %s", key)
+    return cached_response(cache, metadata, iter(lambda: f_entry.read(CGI_BUFFER_SIZE), b''), f_entry.close, hits=1)
+
+
+def cached_response(cache, metadata, body_iter, close, **counts):
+    """Response from the pack cache
+
+    :arg cache: pack_cache.PackCache
+    :arg metadata: dict, status and headers of the cached response
+    :arg body_iter: iterable of bytes, response body
+    :arg close: callable, called once the response is finished
+    :arg counts: int, counters to increment once the response is complete
+    :return: flask response
+    """
+    def generate():
+        """Stream the cached response
+        """
+        sent = 0
+        try:
+            for data in body_iter:
+                sent += len(data)
+                yield data
+        except RuntimeError as exc:
+            app.logger.error("Pack cache: %s", exc)
+            raise
+        finally:
+            close()
+        cache.count(bytes_saved=sent, **counts)
+    response = flask.Response(generate(), metadata['status'])
+    for header in metadata['headers']:
+        response.headers[header[0]] = header[1]
+    return response
+
+
+
+class PrefixedStream(object):
+    """Stream with data that has already been read put back in front
+    """
+    def __init__(self, prefix, stream):
+        """Setup
+
+        :arg prefix: bytes, data to return first
+        :arg stream: stream, to continue reading from
+        """
+        self.prefix = prefix
+        self.stream = stream
+
+    def read(self, size=-1):
+        """Read from prefix, then stream
+
+        :arg size: int, maximum bytes to read, -1 for all
+        :return: bytes
+        """
+        if not self.prefix:
+            return self.stream.read(size)
+        if size < 0:
+            data = self.prefix + self.stream.read()
+            self.prefix = b''
+            return data
+        data = self.prefix[:size]
+        self.prefix = self.prefix[size:]
+        return data
 
 
 
 class Permissions(object):
     """Calculate permissions
+
+    Walks the authorisation config on each call - PermissionIndex is used for
+    requests, this is kept as the reference for the inheritance rules.
     """
     def __init__(self, authorisation_config, username, groups):
         """Calculate permissions
@@ -272,185 +1045,768 @@ class Permissions(object):
 
 
 
+class PermissionIndex(object):
+    """Authorisation config compiled for fast lookup
+
+    Same rules as Permissions: grants at project group level are inherited by
+    the projects in it and the highest permission is given. In addition the
+    project group and project keys may be wildcard (fnmatch) patterns, and
+    grants from all matching keys are combined.
+
+    Each (project group, project) is resolved to sets of users and groups
+    once, then cached, so a lookup doesn't depend on the size of the config.
+    """
+    wildcard = re.compile(r'[\*\?\[]')
+    cache_size = 65536
+    grant_keys = ['.read_users', '.read_groups', '.write_users', '.write_groups']
+
+    def __init__(self, authorisation_config):
+        """Compile authorisation config
+
+        :arg authorisation_config: dict, authorisation section of config
+        :raises ValueError: on invalid config
+        """
+        self.groups = {}
+        self.group_patterns = []
+        for project_group, group_node in authorisation_config.items():
+            group_node = self._node(group_node, project_group)
+            projects = {}
+            project_patterns = []
+            for project, project_node in group_node.items():
+                if not isinstance(project, str) or project.startswith('.'):
+                    continue
+                grants = self._grants(self._node(project_node, project))
+                if self.wildcard.search(project):
+                    project_patterns.append((re.compile(fnmatch.translate(project)), grants))
+                else:
+                    projects[project] = grants
+            entry = (self._grants(group_node), projects, project_patterns)
+            if isinstance(project_group, str) and self.wildcard.search(project_group):
+                self.group_patterns.append((re.compile(fnmatch.translate(project_group)), entry))
+            else:
+                self.groups[project_group] = entry
+        self._resolved = {}
+
+    @staticmethod
+    def _node(node, name):
+        """Sanity check a node
+
+        :arg node: dict|None, node from config
+        :arg name: str|None, key of node for errors
+        :return: dict, node (empty if None)
+        """
+        if node is None:
+            return {}
+        if not isinstance(node, dict):
+            raise ValueError("Authorisation for '{}' is not a map".format(name))
+        return node
+
+    def _grants(self, node):
+        """Extract grants from a node
+
+        :arg node: dict, containing .read_users, .write_users, .read_groups, .write_groups
+        :return: tuple of frozensets in order of grant_keys
+        """
+        grants = []
+        for key in self.grant_keys:
+            values = node.get(key)
+            if values is None:
+                values = []
+            elif not isinstance(values, list):
+                raise ValueError("Authorisation '{}' is not a list".format(key))
+            grants.append(frozenset(values))
+        return tuple(grants)
+
+    def resolve(self, project_group, project):
+        """Combine all grants that apply to a project
+
+        :arg project_group: str|None, project group being requested
+        :arg project: str, project being requested
+        :return: tuple of frozensets in order of grant_keys
+        """
+        key = (project_group, project)
+        if key in self._resolved:
+            return self._resolved[key]
+        entries = []
+        if project_group in self.groups:
+            entries.append(self.groups[project_group])
+        if isinstance(project_group, str):
+            entries += [entry for pattern, entry in self.group_patterns if pattern.match(project_group)]
+        grants = [frozenset()] * len(self.grant_keys)
+        for group_grants, projects, project_patterns in entries:
+            matched = [group_grants]
+            if project in projects:
+                matched.append(projects[project])
+            matched += [project_grants for pattern, project_grants in project_patterns if pattern.match(project)]
+            for match in matched:
+                grants = [current | extra for current, extra in zip(grants, match)]
+        grants = tuple(grants)
+        if len(self._resolved) >= self.cache_size:
+            self._resolved.clear()
+        self._resolved[key] = grants
+        return grants
+
+    def get_permission(self, project_group, project, username, groups):
+        """Calculate permissions for a request
+
+        :arg project_group: str|None, project group being requested
+        :arg project: str, project being requested
+        :arg username: str, authenticated user
+        :arg groups: list, groups the user has membership of
+        :return: dict, containing read and write keys with bool values
+        """
+        read_users, read_groups, write_users, write_groups = self.resolve(project_group, project)
+        write = username in write_users or not write_groups.isdisjoint(groups)
+        return {
+            'read': write or username in read_users or not read_groups.isdisjoint(groups),
+            'write': write,
+        }
+
+
+
+class AuthPluginRegistry(object):
+    """Authentication plugins, imported once per worker
+
+    Plugins are modules in authentication_plugins/ providing:
+        authenticate(logger, auth_config, username, password)
+    and optionally, for keeping expensive resources between requests:
+        init(logger, auth_config) - called after loading or when auth_config changes
+        teardown(logger) - called before the plugin is replaced or the worker exits
+
+    The plugin is only imported again if the config names a different plugin
+    or the plugin file changes.
+    """
+    def __init__(self, plugin_dir):
+        """Setup - nothing loaded
+
+        :arg plugin_dir: str, directory containing plugins
+        """
+        self.plugin_dir = plugin_dir
+        self.plugin = None
+        self.plugin_config = None
+        self.signature = None
+        self._lock = threading.Lock()
+
+    def _teardown(self):
+        """Give the current plugin (if any) a chance to release resources
+        """
+        if self.plugin is not None and hasattr(self.plugin, 'teardown'):
+            try:
+                self.plugin.teardown(app.logger)
+            except Exception:   # pylint: disable=broad-except
+                app.logger.error("Exception in authentication plugin teardown", exc_info=True)
+        self.plugin_config = None
+
+    def _import(self, name, plugin_path):
+        """Import the plugin module from file
+
+        :arg name: str, plugin name
+        :arg plugin_path: str, path to plugin file
+        :return: module
+        """
+        spec = importlib.util.spec_from_file_location('authentication_plugins.' + name, plugin_path)
+        plugin = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(plugin)
+        return plugin
+
+    def get(self, name, plugin_config):
+        """Get the plugin, loading and initialising as needed
+
+        :arg name: str, plugin name (module in plugin_dir)
+        :arg plugin_config: any, config for plugin
+        :return: module|None, None on failure (logged)
+        """
+        if not re.match(r'^\w+$', name):
+            app.logger.critical("Invalid authentication plugin name: %s", name)
+            return None
+        plugin_path = os.path.join(self.plugin_dir, name + '.py')
+        try:
+            stat = os.stat(plugin_path)
+        except FileNotFoundError:
+            app.logger.critical("Authentication plugin not found: %s", plugin_path)
+            return None
+        signature = (name, stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            if signature == self.signature and plugin_config == self.plugin_config:
+                return self.plugin
+            torn_down = False
+            try:
+                if signature != self.signature:
+                    app.logger.info("Loading authentication plugin: %s", name)
+                    plugin = self._import(name, plugin_path)
+                    self._teardown()
+                    self.plugin = plugin
+                    self.signature = signature
+                else:
+                    self._teardown()
+                torn_down = True
+                if hasattr(self.plugin, 'init'):
+                    app.logger.info("Initialising authentication plugin: %s", name)
+                    self.plugin.init(app.logger, plugin_config)
+            except Exception:   # pylint: disable=broad-except
+                app.logger.critical("Exception loading authentication plugin: %s", name, exc_info=True)
+                if not torn_down:
+                    # new plugin failed to import, the old one is still set up
+                    self._teardown()
+                self.plugin = None
+                self.signature = None
+                return None
+            self.plugin_config = plugin_config
+            return self.plugin
+
+    def close(self):
+        """Teardown and forget the plugin (eg. worker exit)
+        """
+        with self._lock:
+            self._teardown()
+            self.plugin = None
+            self.signature = None
+
+auth_plugins = AuthPluginRegistry(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'authentication_plugins'))
+atexit.register(auth_plugins.close)
+
+
+
+class ConfigCache(object):
+    """Per-worker cache of the configuration
+
+    The file is only parsed again when its mtime, size or inode changes. If
+    the changed file can't be used then the last good configuration is kept.
+    Loads and failures are counted and reported to metrics (if enabled).
+    """
+    def __init__(self):
+        """Setup - nothing loaded
+        """
+        self.config = None
+        self.permission_index = None
+        self.config_path = None
+        self.signature = None
+        self.reloads = 0
+        self.errors = 0
+        self.loaded_at = None
+        # reloads, errors already passed to metrics
+        self._reported = (0, 0)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _parse(config_path):
+        """Read and sanity check the config file
+
+        :arg config_path: str, path to config file
+        :return: dict, config contents
+        :raises ValueError: on unusable config
+        """
+        try:
+            with open(config_path, 'rt') as f_conf:
+                config = yaml.safe_load(f_conf)
+        except yaml.YAMLError as exc:
+            raise ValueError("Configuration file yaml error:\n{}".format(exc))
+        # sanity check
+        if not isinstance(config, dict):
+            raise ValueError("Configuration file does not contain a map")
+        if 'authentication' not in config or not isinstance(config['authentication'], dict):
+            raise ValueError("Configuration file does not contain 'authentication' map")
+        if 'authorisation' not in config or not isinstance(config['authorisation'], dict):
+            raise ValueError("Configuration file does not contain 'authorisation' map")
+        return config
+
+    def get(self, config_path):
+        """Get the config, (re)loading if the file has changed
+
+        :arg config_path: str, path to config file
+        :return: dict|None, config contents, None if never successfully loaded
+        """
+        try:
+            stat = os.stat(config_path)
+        except FileNotFoundError:
+            app.logger.critical("Configuration file not found: %s", config_path)
+            return self.config
+        signature = (config_path, stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        if signature == self.signature:
+            return self.config
+        with self._lock:
+            if signature == self.signature:
+                # another thread got here first
+                return self.config
+            # recorded regardless of outcome so a broken file is only parsed once
+            self.signature = signature
+            try:
+                config = self._parse(config_path)
+                permission_index = PermissionIndex(config['authorisation'])
+            except (ValueError, OSError) as exc:
+                app.logger.critical("%s", exc)
+                self.errors += 1
+                if self.config is not None:
+                    app.logger.critical("Keeping last good configuration loaded at %s", time.ctime(self.loaded_at))
+                return self.config
+            self.config = config
+            self.permission_index = permission_index
+            self.config_path = config_path
+            self.reloads += 1
+            self.loaded_at = time.time()
+            app.logger.info("Loaded configuration (load %d): %s", self.reloads, config_path)
+        return self.config
+
+    def report(self, collector):
+        """Pass loads and failures since last reported to metrics
+
+        :arg collector: metrics.Metrics|metrics.NullMetrics
+        """
+        if self._reported == (self.reloads, self.errors):
+            return
+        with self._lock:
+            reloads, errors = self.reloads - self._reported[0], self.errors - self._reported[1]
+            self._reported = (self.reloads, self.errors)
+            loaded_at = self.loaded_at
+        if reloads:
+            collector.inc('config_reloads_total', reloads)
+            collector.set('config_loaded_timestamp_seconds', loaded_at)
+        if errors:
+            collector.inc('config_errors_total', errors)
+        # seen on scrape even if this worker handles no git requests
+        collector.flush()
+
+config_cache = ConfigCache()
+
+
+
 def load_config():
     """Load the config file specified in os environment GIT4NGINX_CONFIG
 
+    Parsed config is cached in config_cache until the file changes.
+
     :return: config contents (should be dict)
     """
     if 'GIT4NGINX_CONFIG' not in os.environ:
         app.logger.critical("Configuration file not configured: GIT4NGINX_CONFIG must be in OS environment")
         flask.abort(500)
-    try:
-        with open(os.environ['GIT4NGINX_CONFIG'], 'rt') as f_conf:
-            config = yaml.safe_load(f_conf)
-    except FileNotFoundError:
-        app.logger.critical("Configuration file not found: %s", os.environ['GIT4NGINX_CONFIG'])
-        flask.abort(500)
-    except yaml.parser.ParserError as exc:
-        app.logger.critical("Configuration file yaml error:\n%s", exc)
-        flask.abort(500)
-    # sanity check
-    if 'authentication' not in config or not isinstance(config['authentication'], dict):
-        app.logger.critical("Configuration file does not contain 'authentication' map")
-        flask.abort(500)
-    if 'authorisation' not in config or not isinstance(config['authorisation'], dict):
-        app.logger.critical("Configuration file does not contain 'authorisation' map")
+    config = config_cache.get(os.environ['GIT4NGINX_CONFIG'])
+    if config is None:
         flask.abort(500)
+    config_cache.report(get_metrics(config))
     return config
 
 
 
-class HookLogDir(object):
-    """Context for log directory for hooks to pass back logging
+class HookLog(object):
+    """Context for a pipe hooks pass structured logs back over
+
+    Hooks inherit the write end (GIT4NGINX_LOG_FD) and write JSON lines (see
+    hook_helper.setup_loggger) which are re-logged as they arrive, keeping
+    the level, time, location and any exception trace from the hook.
     """
-    level2int = {
-        'DEBUG': logging.DEBUG,
-        'INFO': logging.INFO,
-        'WARNING': logging.WARNING,
-        'ERROR': logging.ERROR,
-        'CRITICAL': logging.CRITICAL,
-    }
+    # wait this long for hooks to finish logging once the cgi is done
+    timeout = 5.0
+
     def __init__(self):
         """Setup
         """
-        self._path = None
+        self.read_fd = None
+        self.write_fd = None
+        self._reader = None
+
     def __enter__(self):
-        """Enter context - create temporary directory (and store)
+        """Enter context - create pipe and start reading it
+
+        :return: HookLog
         """
-        self._path = tempfile.mkdtemp()
-        return self._path
+        return self.open()
+
     def __exit__(self, exc_type, exc_value, traceback):
-        """Exit context - process logs in temporary directory, clean up
-        """
-        # re-log hook log lines
-        for log in sorted(os.listdir(self._path)):
-            app.logger.debug("start logfile: %s", log)
-            _, hook = log.split('_', 1)
-            log_path = os.path.join(self._path, log)
-            with open(log_path, 'rt') as f_log:
-                exception = False
-                for line in f_log:
-                    match = re.match(r'^(\d+\.\d+)\s+\[(\w+)\]\s+(\S.*)\s+\(([^\(\)]+)\)$', line.strip())
-                    if not match:
-                        if exception:
-                            # exception trace - just pass through until we get a line we recognise
-                            app.logger.error(line.rstrip())
-                        else:
-                            # can't figure out what this is
-                            app.logger.critical("%s - Can't parse hook log %s line: %s", hook, log, line)
-                        continue
-                    if match.group(2) not in self.level2int:
-                        app.logger.critical("%s - Don't have a log level match for %s in line: %s", hook, match.group(2), line)
-                        exception = False   # back to regular logging
-                        continue
-                    level = self.level2int[match.group(2)]
-                    app.logger.log(level, "%s - %s", hook, match.group(3))
-                    #if line.startswith('Exception in plugin: '):
-                    if re.match(r'^(\d+\.\d+)\s+\[(\w+)\]\s+Exception in plugin: ', line):
-                        # following is an exception
-                        exception = True
-            app.logger.debug("end logfile: %s", log)
-            os.unlink(log_path)
-        os.rmdir(self._path)
-
-
-
-def cgi_wrapper(bin_path, extra_env=None, stream=None):
+        """Exit context - wait for hooks to finish logging
+        """
+        self.close()
+
+    def open(self):
+        """Create pipe and start reading it
+
+        :return: HookLog
+        """
+        self.read_fd, self.write_fd = os.pipe()
+        self._reader = threading.Thread(target=self._read, name='hook-log', daemon=True)
+        self._reader.start()
+        return self
+
+    def close(self):
+        """Wait for hooks to finish logging (blocks for up to timeout)
+        """
+        # hooks (and anything they leave running) hold the other copies of the write end
+        os.close(self.write_fd)
+        self._reader.join(self.timeout)
+        if self._reader.is_alive():
+            app.logger.warning("Hook log still open after %.1f seconds, no longer waiting", self.timeout)
+
+    def _read(self):
+        """Re-log lines from the pipe until all writers have closed it (runs in thread)
+        """
+        with open(self.read_fd, 'rb') as f_log:
+            for line in f_log:
+                try:
+                    entry = json.loads(line.decode('utf-8'))
+                    level = logging.getLevelName(entry['level'])
+                    if not isinstance(level, int):
+                        raise ValueError("Unknown level: {}".format(entry['level']))
+                except (ValueError, KeyError, TypeError):
+                    app.logger.critical("Can't parse hook log line: %s", line)
+                    continue
+                if not app.logger.isEnabledFor(level):
+                    continue
+                record = app.logger.makeRecord(
+                    app.logger.name, level, entry.get('filename', '(unknown file)'), entry.get('lineno', 0),
+                    "%s - %s", (entry.get('hook'), entry.get('message')), None
+                )
+                record.created = entry.get('created', record.created)
+                record.msecs = (record.created - int(record.created)) * 1000
+                if entry.get('exc'):
+                    record.exc_text = entry['exc']
+                app.logger.handle(record)
+
+
+
+# default size of buffers used when streaming data through the cgi
+CGI_BUFFER_SIZE = 65536
+# limits to protect the worker against a misbehaving cgi
+CGI_HEADER_LIMIT = 65536
+CGI_STDERR_LIMIT = 65536
+
+
+
+def parse_cgi_header(header):
+    """Parse a cgi header block
+
+    :arg header: bytes, header block without the terminating blank line
+    :return: tuple of:
+        status code, int
+        reason, str|None - reason given with Status header if any
+        headers, list of [name, value]
+    """
+    status_code = 200
+    reason = None
+    headers = []
+    for line in header.decode('ascii', 'ignore').splitlines():
+        name, value = line.split(':', 1)
+        value = value.lstrip()
+        if name == 'Status':
+            status_parts = value.split(' ', 1)
+            status_code = int(status_parts.pop(0))
+            if status_parts:
+                reason = status_parts[0]
+        else:
+            headers.append([name, value])
+    return status_code, reason, headers
+
+
+
+class CGIStream(object):
+    """Run a cgi binary, streaming data through it in both directions
+
+    stdout is consumed in fixed size chunks so memory use is bounded by the
+    buffer size no matter how large the response (eg. pack) is.
+    """
+    def __init__(self, bin_path, cgienv, stream=None, buffer_size=CGI_BUFFER_SIZE, splice_fd=None, splice_length=None, pass_fds=()):
+        """Start the cgi
+
+        :arg bin_path: str, binary to execute
+        :arg cgienv: dict, environment for the cgi
+        :arg stream: stream|None, optional data stream to pass to cgi (stdin)
+        :arg buffer_size: int, size of chunks read/written
+        :arg splice_fd: int|None, optional file descriptor to splice() input from (zero-copy)
+            in preference to reading stream, which is used as fallback if splice is not possible
+        :arg splice_length: int|None, bytes of input to splice, required with splice_fd
+        :arg pass_fds: tuple, file descriptors the cgi (and so hooks) inherit
+        """
+        self.bin_path = bin_path
+        self.stream = stream
+        self.buffer_size = buffer_size
+        self.splice_fd = splice_fd if hasattr(os, 'splice') else None
+        self.splice_length = splice_length
+        self.splice_remaining = splice_length
+        self.stderr = b''
+        # request body bytes passed to the cgi
+        self.bytes_in = 0
+        self.proc = subprocess.Popen(
+            bin_path,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            stdin=subprocess.PIPE if stream is not None or self.splice_fd is not None else subprocess.DEVNULL,
+            env=cgienv,
+            pass_fds=pass_fds
+        )
+        for pipe in [self.proc.stdout, self.proc.stderr, self.proc.stdin]:
+            if pipe is not None:
+                os.set_blocking(pipe.fileno(), False)
+        for pipe in [self.proc.stdout, self.proc.stdin]:
+            if pipe is not None and buffer_size > CGI_BUFFER_SIZE and hasattr(fcntl, 'F_SETPIPE_SZ'):
+                # larger pipes mean fewer wakeups, limited by /proc/sys/fs/pipe-max-size
+                try:
+                    fcntl.fcntl(pipe.fileno(), fcntl.F_SETPIPE_SZ, buffer_size)
+                except OSError:
+                    app.logger.debug("Unable to increase pipe size to %d", buffer_size)
+        self._pending = b''
+        self._output = self._io()
+
+    def _read_stderr(self, fd):
+        """Read available stderr, keeping only the most recent data
+
+        :arg fd: int, stderr file descriptor
+        :return: bool, False on EOF
+        """
+        data = os.read(fd, self.buffer_size)
+        if not data:
+            return False
+        self.stderr = (self.stderr + data)[-CGI_STDERR_LIMIT:]
+        return True
+
+    def _splice_input(self, stdin_fd):
+        """Move input directly from splice_fd to stdin without copying through Python
+
+        :arg stdin_fd: int, cgi stdin file descriptor
+        :return: bool, False on end of input
+        """
+        if not self.splice_remaining:
+            return False
+        try:
+            moved = os.splice(self.splice_fd, stdin_fd, min(self.buffer_size, self.splice_remaining))
+        except BlockingIOError:
+            # non-blocking input with nothing available yet
+            select.select([self.splice_fd], [], [])
+            return True
+        except OSError as exc:
+            if exc.errno != errno.EINVAL or self.splice_remaining != self.splice_length:
+                raise
+            # file descriptors don't support splice - fall back to copying (nothing moved yet)
+            app.logger.info("splice() not supported for input, falling back to copying")
+            self.splice_fd = None
+            return True
+        if not moved:
+            app.logger.warning("Input ended with %d bytes outstanding", self.splice_remaining)
+            return False
+        self.splice_remaining -= moved
+        self.bytes_in += moved
+        return self.splice_remaining > 0
+
+    def _feed_input(self, stdin_fd):
+        """Write the next chunk of input to the cgi
+
+        :arg stdin_fd: int, cgi stdin file descriptor (writable)
+        :return: bool, False on end of input
+        """
+        if self.splice_fd is not None:
+            return self._splice_input(stdin_fd)
+        if not self._pending:
+            self._pending = memoryview(self.stream.read(self.buffer_size))
+            if not self._pending:
+                return False
+        written = os.write(stdin_fd, self._pending)
+        self._pending = self._pending[written:]
+        self.bytes_in += written
+        return True
+
+    def _io(self):
+        """Generator driving the cgi, feeding stdin and yielding stdout chunks as they arrive
+
+        Blocks in select() until there is something to do, no polling.
+        """
+        stdout_fd = self.proc.stdout.fileno()
+        stderr_fd = self.proc.stderr.fileno()
+        stdin_fd = self.proc.stdin.fileno() if self.proc.stdin is not None else None
+        readers = [stdout_fd, stderr_fd]
+        while stdout_fd in readers:
+            writers = [stdin_fd] if stdin_fd is not None else []
+            readable, writable, _ = select.select(readers, writers, [])
+            if writable:
+                try:
+                    if not self._feed_input(stdin_fd):
+                        # end of input
+                        self.proc.stdin.close()
+                        stdin_fd = None
+                except BrokenPipeError:
+                    # cgi stopped reading - nothing more we can do with the input
+                    app.logger.warning("%s stopped reading input", self.bin_path)
+                    self.proc.stdin.close()
+                    stdin_fd = None
+                    self._pending = b''
+            if stderr_fd in readable and not self._read_stderr(stderr_fd):
+                readers.remove(stderr_fd)
+            if stdout_fd in readable:
+                data = os.read(stdout_fd, self.buffer_size)
+                if not data:
+                    readers.remove(stdout_fd)
+                else:
+                    yield data
+        # stdout complete, mop up
+        if stdin_fd is not None:
+            self.proc.stdin.close()
+        if stderr_fd in readers:
+            os.set_blocking(stderr_fd, True)
+            while self._read_stderr(stderr_fd):
+                pass
+        self.proc.wait()
+
+    def read_header(self):
+        """Read and parse the cgi header block
+
+        :return: tuple of:
+            status code, int
+            reason, str|None - reason given with Status header if any
+            headers, list of [name, value]
+            body, bytes - any body data read along with the header
+        :raises RuntimeError: if the cgi fails to produce a header
+        """
+        header = b''
+        for data in self._output:
+            header += data
+            if b'\r\n\r\n' in header:
+                break
+            if len(header) > CGI_HEADER_LIMIT:
+                raise RuntimeError("No end of cgi header within {} bytes".format(CGI_HEADER_LIMIT))
+        if b'\r\n\r\n' not in header:
+            raise RuntimeError("cgi exited with status {} before completing header".format(self.proc.returncode))
+        header, body = header.split(b'\r\n\r\n', 1)
+        status_code, reason, headers = parse_cgi_header(header)
+        return status_code, reason, headers, body
+
+    def iter_body(self, body=b''):
+        """Yield the remaining body
+
+        :arg body: bytes, body data already read with the header
+        """
+        if body:
+            yield body
+        yield from self._output
+
+    def close(self):
+        """Stop the cgi (if still running) and check how it finished
+        """
+        self._output.close()
+        if self.proc.poll() is None:
+            app.logger.warning("Terminating incomplete %s", self.bin_path)
+            self.proc.kill()
+            self.proc.wait()
+        for pipe in [self.proc.stdout, self.proc.stderr, self.proc.stdin]:
+            if pipe is not None:
+                pipe.close()
+        if self.proc.returncode != 0:
+            app.logger.error("%s returned %s", self.bin_path, str(self.proc.returncode))
+            app.logger.debug("%s stderr:\n%s\n--- end stderr", self.bin_path, self.stderr)
+        elif self.stderr:
+            app.logger.debug("%s stderr:\n%s\n--- end stderr", self.bin_path, self.stderr)
+
+
+
+def request_input_fd():
+    """Find the file descriptor of the raw request body for zero-copy input
+
+    This is only correct where the server leaves the body unread on the
+    connection (eg. uwsgi without post-buffering) so must be explicitly enabled.
+
+    :return: tuple of:
+        file descriptor, int|None - None if not available
+        content length, int|None
+    """
+    environ = flask.request.environ
+    if 'chunked' in environ.get('HTTP_TRANSFER_ENCODING', '').lower():
+        return None, None
+    if isinstance(environ.get('wsgi.input'), io.BufferedIOBase):
+        # body may already be partly read into the buffer
+        return None, None
+    try:
+        length = int(environ.get('CONTENT_LENGTH', ''))
+        input_fd = environ['wsgi.input'].fileno()
+    except (KeyError, AttributeError, ValueError, OSError):
+        # includes io.UnsupportedOperation
+        return None, None
+    return input_fd, length
+
+
+
+def cgi_wrapper(bin_path, extra_env=None, stream=None, cleanup=None, cgi_config=None, tee=None, pass_fds=()):
     """Run cgi translating from flask environment
 
+    The response is streamed to the client as the cgi produces it.
+
     :arg bin_path: str, binary to execute
+    :arg extra_env: dict|None, additional environment for the cgi
     :arg stream: stream|None, optional data stream to pass to cgi (stdin) else will pass-through
+    :arg cleanup: contextlib.ExitStack|None, closed once the response is complete
+    :arg cgi_config: dict|None, optional tuning (buffer_size, splice)
+    :arg tee: pack_cache.PackCacheWriter|None, optionally also pass the response to this
+    :arg pass_fds: tuple, file descriptors the cgi inherits (eg. HookLog pipe)
     :return: flask response
     """
     # generate execution environment
     cgienv = {
         key: value
         for key, value in flask.request.environ.items()
-        if not key.startswith(('uwsgi.', 'werkzeug.', 'wsgi.'))
+        if not key.startswith(('uwsgi.', 'werkzeug.', 'wsgi.')) and isinstance(value, str)
     }
     cgienv['SERVER_SOFTWARE'] = 'git4nginx'
     cgienv['GATEWAY_INTERFACE'] = 'CGI/1.1'
     if extra_env is not None:
         cgienv.update(extra_env)
-    # execute TODO important - this will not handle large requests since everything is in memory. Needs tweaking to chunk data.
-    if flask.request.method == 'GET':
-        proc = subprocess.Popen(
-            bin_path,
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-            env=cgienv
-        )
-        stdout, stderr = proc.communicate()
-    elif flask.request.method in ['POST', 'PUT']:
-        proc = subprocess.Popen(
-            bin_path,
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-            stdin=subprocess.PIPE,
-            env=cgienv
+    if cleanup is None:
+        cleanup = contextlib.ExitStack()
+    if stream is None and flask.request.method in ['POST', 'PUT']:
+        stream = flask.request.stream
+    if cgi_config is None:
+        cgi_config = {}
+    splice_fd, splice_length = None, None
+    if stream is flask.request.stream and cgi_config.get('splice', False):
+        splice_fd, splice_length = request_input_fd()
+    collector = flask.g.get('metrics', metrics.NULL_METRICS)
+    service = flask.g.get('service', 'other')
+    # execute
+    # holds cgi once the body is complete
+    complete = []
+    # response body bytes sent
+    sent = [0]
+    if tee is not None:
+        # runs after cgi.close so the return code is known
+        cleanup.callback(lambda: tee.finish(bool(complete) and complete[0].proc.returncode == 0))
+    try:
+        admit(cleanup)
+        start = time.monotonic()
+        cgi = CGIStream(
+            bin_path, cgienv, stream,
+            buffer_size=cgi_config.get('buffer_size', CGI_BUFFER_SIZE),
+            splice_fd=splice_fd, splice_length=splice_length, pass_fds=pass_fds
         )
-        if stream is None:
-            stdout, stderr = proc.communicate(flask.request.stream.read())
-        else:
-            # make outputs non-blocking
-            fd = proc.stdout.fileno()
-            fl = fcntl.fcntl(fd, fcntl.F_GETFL)
-            fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
-            fd = proc.stderr.fileno()
-            fl = fcntl.fcntl(fd, fcntl.F_GETFL)
-            fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
-            # setup buffers
-            stdout = b''
-            stderr = b''
-            # send data (stdin) until complete
-            send_complete = False
-            while proc.poll() is None and not send_complete:
-                outputs, inputs, _ = select.select([proc.stdout, proc.stderr], [proc.stdin], [], 0.05)
-                for output in outputs:
-                    if output is proc.stdout:
-                        stdout += proc.stdout.read()
-                    elif output is proc.stderr:
-                        stderr += proc.stderr.read()
-                if inputs:
-                    data = stream.read(1024)
-                    if data:
-                        proc.stdin.write(data)
-                    else:
-                        proc.stdin.close()
-                        send_complete = True
-            # sending complete, mop up outputs
-            while proc.poll() is None:
-                outputs, _, _ = select.select([proc.stdout, proc.stderr], [], [], 0.05)
-                for output in outputs:
-                    if output is proc.stdout:
-                        stdout += proc.stdout.read()
-                    elif output is proc.stderr:
-                        stderr += proc.stderr.read()
-            # make sure nothing is left in buffers
-            stdout += proc.stdout.read()
-            stderr += proc.stderr.read()
-    if proc.returncode != 0:
-        app.logger.debug("%s returned %s", bin_path, str(proc.returncode))
-        app.logger.debug("%s stdout:\n%s\n--- end stderr", bin_path, stdout)
-        app.logger.debug("%s stderr:\n%s\n--- end stderr", bin_path, stderr)
-        flask.abort(500)
-    elif stderr:
-        app.logger.debug("%s stderr:\n%s\n--- end stderr", bin_path, stderr)
-    # split and handle header from cgi
-    header, body = tuple(stdout.split(b'\r\n\r\n', 1))
-    status_code = 200
-    headers = []
-    for line in header.decode('ascii', 'ignore').splitlines():
-        name, value = line.split(':', 1)
-        value = value.lstrip()
-        if name == 'Status':
-            status_parts = value.split(' ', 1)
-            status_code = int(status_parts.pop(0))
-            if status_parts:
-                body = status_parts[0]
-        else:
-            headers.append([name, value])
+        def record_backend():
+            """Record totals once the cgi has finished
+            """
+            collector.observe('phase_seconds', time.monotonic() - start, phase='backend_total')
+            collector.inc('bytes_in_total', cgi.bytes_in, service=service)
+            collector.inc('bytes_out_total', sent[0], service=service)
+        cleanup.callback(record_backend)
+        cleanup.callback(cgi.close)
+        try:
+            status_code, reason, headers, body = cgi.read_header()
+        except RuntimeError as exc:
+            app.logger.error("%s: %s", bin_path, exc)
+            flask.abort(500)
+        collector.observe('phase_seconds', time.monotonic() - start, phase='backend_first_byte')
+    except BaseException:
+        cleanup.close()
+        raise
+    if reason is not None:
+        # cgi supplied reason is used as the body
+        body_iter = iter([reason])
+    else:
+        body_iter = cgi.iter_body(body)
+        if tee is not None:
+            tee.start(status_code, headers)
+    def generate():
+        """Stream the body, cleaning up when complete (or client goes away)
+        """
+        with cleanup:
+            for data in body_iter:
+                if tee is not None:
+                    tee.write(data)
+                sent[0] += len(data)
+                yield data
+            complete.append(cgi)
     # prepare response
     response = flask.Response(
-        body,
+        flask.stream_with_context(generate()),
         status_code
     )
     for header in headers:
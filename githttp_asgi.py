@@ -0,0 +1,323 @@
+"""ASGI entry point for git via http(s)
+
+git4nginx tools for using git via http(s) with Nginx
+Copyright (C) 2019  Glen Pitt-Pladdy
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+Alternative to githttp.app where one process multiplexes many concurrent
+clients (eg. slow clones) rather than each occupying a worker. Routing,
+validation, authentication and authorisation are shared with githttp.app
+and git-http-backend is driven through non-blocking pipes with
+backpressure in both directions. eg:
+    GIT4NGINX_CONFIG=/path/to/config.yaml uvicorn githttp_asgi:app --uds /run/git4nginx.sock
+
+Authentication is always done here (Basic) as ASGI has no REMOTE_USER.
+native_refs, pack_cache, cgi splice, metrics, the /repos listing, Git LFS, clone bundles
+and reads from replicas are only available with githttp.app.
+"""
+
+import re
+import time
+import asyncio
+import functools
+import contextlib
+import urllib.parse
+import werkzeug.exceptions
+import werkzeug.datastructures
+import githttp
+import admission
+
+
+app_logger = githttp.app.logger
+ROUTE = re.compile(r'^/(?:(?P<project_group>[^/]+)/)?(?P<project>[^/]+)\.git(?:/(?P<sub_path>.+))?$')
+
+
+
+def cgi_environ(scope):
+    """Generate CGI environment for request
+
+    :arg scope: dict, ASGI connection scope
+    :return: dict
+    """
+    root_path = scope.get('root_path', '')
+    path = scope['path']
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path):]
+    cgienv = {
+        'SERVER_SOFTWARE': 'git4nginx',
+        'GATEWAY_INTERFACE': 'CGI/1.1',
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': root_path,
+        'PATH_INFO': path,
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_PROTOCOL': 'HTTP/{}'.format(scope.get('http_version', '1.1')),
+    }
+    if scope.get('server'):
+        cgienv['SERVER_NAME'], cgienv['SERVER_PORT'] = scope['server'][0], str(scope['server'][1])
+    if scope.get('client'):
+        cgienv['REMOTE_ADDR'], cgienv['REMOTE_PORT'] = scope['client'][0], str(scope['client'][1])
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        if name not in ['CONTENT_TYPE', 'CONTENT_LENGTH']:
+            name = 'HTTP_' + name
+        value = value.decode('latin-1')
+        cgienv[name] = cgienv[name] + ',' + value if name in cgienv else value
+    return cgienv
+
+
+
+async def send_error(send, error):
+    """Send response for an HTTP error (abort)
+
+    :arg send: ASGI send callable
+    :arg error: werkzeug.exceptions.HTTPException
+    """
+    headers = [[b'content-type', b'text/plain; charset=utf-8']]
+    if error.code == 401:
+        headers.append([b'www-authenticate', b'Basic realm="Authentication Required", charset="UTF-8"'])
+    if getattr(error, 'retry_after', None) is not None:
+        headers.append([b'retry-after', str(error.retry_after).encode('ascii')])
+    await send({'type': 'http.response.start', 'status': error.code, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': (error.description or '').encode('utf-8')})
+
+
+
+async def feed_input(receive, proc, disconnected):
+    """Pass the request body to the cgi, then watch for the client going away
+
+    Only receives more of the body once the cgi has taken the last of it.
+
+    :arg receive: ASGI receive callable
+    :arg proc: asyncio.subprocess.Process
+    :arg disconnected: asyncio.Event, set if the client goes away
+    """
+    try:
+        while proc.stdin is not None:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                disconnected.set()
+                return
+            try:
+                if message.get('body'):
+                    proc.stdin.write(message['body'])
+                    await proc.stdin.drain()
+                if not message.get('more_body', False):
+                    proc.stdin.close()
+                    break
+            except (BrokenPipeError, ConnectionResetError):
+                # cgi has stopped reading, it will report why
+                break
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                disconnected.set()
+                return
+    finally:
+        if disconnected.is_set() and proc.returncode is None:
+            app_logger.warning("Client went away, terminating %s", proc.pid)
+            proc.kill()
+
+
+
+async def read_stderr(proc):
+    """Collect (limited) stderr from the cgi
+
+    :arg proc: asyncio.subprocess.Process
+    :return: bytes
+    """
+    stderr = b''
+    while True:
+        data = await proc.stderr.read(githttp.CGI_STDERR_LIMIT)
+        if not data:
+            return stderr
+        if len(stderr) < githttp.CGI_STDERR_LIMIT:
+            stderr += data
+
+
+
+async def cgi_run(scope, receive, send, bin_path, extra_env, cgi_config=None, pass_fds=()):
+    """Run cgi, streaming the request body in and response out
+
+    :arg scope: dict, ASGI connection scope
+    :arg receive: ASGI receive callable
+    :arg send: ASGI send callable
+    :arg bin_path: str, binary to execute
+    :arg extra_env: dict, additional environment for the cgi
+    :arg cgi_config: dict|None, optional tuning (buffer_size)
+    :arg pass_fds: tuple, file descriptors the cgi inherits (eg. HookLog pipe)
+    """
+    cgienv = cgi_environ(scope)
+    cgienv.update(extra_env)
+    buffer_size = (cgi_config or {}).get('buffer_size', githttp.CGI_BUFFER_SIZE)
+    proc = await asyncio.create_subprocess_exec(
+        bin_path,
+        stdin=asyncio.subprocess.PIPE if scope['method'] == 'POST' else asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+        env=cgienv,
+        pass_fds=pass_fds,
+        limit=max(buffer_size, githttp.CGI_HEADER_LIMIT)
+    )
+    disconnected = asyncio.Event()
+    feeder = asyncio.ensure_future(feed_input(receive, proc, disconnected))
+    stderr_reader = asyncio.ensure_future(read_stderr(proc))
+    try:
+        try:
+            header = await proc.stdout.readuntil(b'\r\n\r\n')
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError) as exc:
+            app_logger.error("%s: failed to produce cgi header: %s", bin_path, exc)
+            raise werkzeug.exceptions.InternalServerError()
+        status_code, reason, headers = githttp.parse_cgi_header(header[:-4])
+        await send({
+            'type': 'http.response.start',
+            'status': status_code,
+            'headers': [[name.lower().encode('latin-1'), value.encode('latin-1')] for name, value in headers],
+        })
+        if reason is not None:
+            # cgi supplied reason is used as the body
+            body = reason.encode('utf-8')
+        else:
+            while not disconnected.is_set():
+                data = await proc.stdout.read(buffer_size)
+                if not data:
+                    break
+                await send({'type': 'http.response.body', 'body': data, 'more_body': True})
+            body = b''
+        # completing the response also ends the connection
+        feeder.cancel()
+        await send({'type': 'http.response.body', 'body': body})
+    finally:
+        if proc.returncode is None and not proc.stdout.at_eof():
+            app_logger.warning("Terminating incomplete %s", bin_path)
+            proc.kill()
+        await proc.wait()
+        feeder.cancel()
+        stderr = await stderr_reader
+        if proc.returncode != 0:
+            app_logger.error("%s returned %s", bin_path, str(proc.returncode))
+            app_logger.debug("%s stderr:\n%s\n--- end stderr", bin_path, stderr)
+        elif stderr:
+            app_logger.debug("%s stderr:\n%s\n--- end stderr", bin_path, stderr)
+
+
+
+def blocking(function, *args):
+    """Run a blocking call (eg. file locks, joining threads) in the default executor
+
+    The call completes even if the caller is cancelled (eg. the client goes away).
+
+    :arg function: callable
+    :return: asyncio.Future, of the result
+    """
+    return asyncio.shield(asyncio.get_running_loop().run_in_executor(None, functools.partial(function, *args)))
+
+
+
+async def admit(scheduler, repo_path, service, user):
+    """Wait for a slot to run git-http-backend without blocking other clients
+
+    :arg scheduler: admission.Scheduler
+    :arg repo_path: str, path to repo
+    :arg service: str, git-upload-pack or git-receive-pack
+    :arg user: str, authenticated user
+    :return: str, request id to release
+    :raises werkzeug.exceptions.ServiceUnavailable: if no slot is available in time
+    """
+    deadline = time.monotonic() + scheduler.max_wait
+    # scheduler state is shared with other processes under a file lock
+    request_id, granted = await blocking(scheduler.enqueue, repo_path, service, user)
+    try:
+        while granted is False:
+            await asyncio.sleep(admission.poll_delay())
+            granted = await blocking(scheduler.check, request_id, deadline)
+    except BaseException:
+        # includes cancellation when the client goes away
+        await blocking(scheduler.abandon, request_id)
+        raise
+    if not granted:
+        app_logger.warning("Too busy to run %s for %s on: %s", service, user, repo_path)
+        raise werkzeug.exceptions.ServiceUnavailable("Server busy, try again later", retry_after=scheduler.retry_after)
+    return request_id
+
+
+
+async def githandler(scope, receive, send):
+    """Main git http entry point
+
+    :arg scope: dict, ASGI connection scope
+    :arg receive: ASGI receive callable
+    :arg send: ASGI send callable
+    """
+    match = ROUTE.match(scope['path'][len(scope.get('root_path', '')):])
+    if not match:
+        raise werkzeug.exceptions.NotFound()
+    method = scope['method']
+    project_group, sub_path = match.group('project_group'), match.group('sub_path')
+    args = werkzeug.datastructures.MultiDict(urllib.parse.parse_qsl(scope.get('query_string', b'').decode('latin-1')))
+    headers = werkzeug.datastructures.Headers([
+        (name.decode('latin-1'), value.decode('latin-1'))
+        for name, value in scope.get('headers', [])
+    ])
+    project = githttp.validate_request(method, match.group('project'), project_group, sub_path, args)
+    config = githttp.load_config()
+    # plugins may block (eg. slow password hashes)
+    authenticated_user, groups, info, repo_path = await asyncio.get_running_loop().run_in_executor(
+        None,
+        functools.partial(
+            githttp.authorise_request,
+            config, method, project, project_group, sub_path, args,
+            None, headers.get('authorization')
+        )
+    )
+    extra_env = githttp.backend_env(config, authenticated_user, groups, info)
+    async with contextlib.AsyncExitStack() as cleanup:
+        if method == 'POST' and sub_path in admission.SERVICES and config.get('admission'):
+            scheduler = githttp.get_scheduler(config['admission'])
+            request_id = await admit(scheduler, repo_path, sub_path, authenticated_user)
+            cleanup.push_async_callback(blocking, scheduler.release, request_id)
+        pass_fds = ()
+        if sub_path == 'git-receive-pack':
+            # hooks log back over a pipe while the response is streamed, waiting
+            # for hooks to finish logging mustn't hold up other clients
+            hook_log = githttp.HookLog().open()
+            cleanup.push_async_callback(blocking, hook_log.close)
+            extra_env['GIT4NGINX_LOG_FD'] = str(hook_log.write_fd)
+            pass_fds = (hook_log.write_fd, )
+        await cgi_run(scope, receive, send, config['bin_path'], extra_env, config.get('cgi'), pass_fds)
+
+
+
+async def app(scope, receive, send):
+    """ASGI application
+
+    :arg scope: dict, ASGI connection scope
+    :arg receive: ASGI receive callable
+    :arg send: ASGI send callable
+    """
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                githttp.auth_plugins.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    if scope['type'] != 'http':
+        return
+    try:
+        await githandler(scope, receive, send)
+    except werkzeug.exceptions.HTTPException as error:
+        await send_error(send, error)
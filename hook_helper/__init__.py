@@ -19,28 +19,60 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 """
 
+import json
 import logging
 import os
-import time
 import sys
 import subprocess
-import yaml
+from hook_helper import reachability
+from hook_helper import config_snapshot
 
 
 
+class JSONLinesHandler(logging.Handler):
+    """Log handler writing records as JSON lines to the web app log pipe
+
+    Each record is a single write so records from hooks sharing the pipe
+    are not interleaved.
+    """
+    def __init__(self, fd):
+        """Setup
+
+        :arg fd: int, file descriptor to write to
+        """
+        super().__init__()
+        self.fd = fd
+        self.hook = sys.argv[0].split('/')[-1]
+
+    def emit(self, record):
+        """Write a record
+        """
+        try:
+            entry = {
+                'created': record.created,
+                'level': record.levelname,
+                'hook': self.hook,
+                'message': record.getMessage(),
+                'filename': record.filename,
+                'lineno': record.lineno,
+            }
+            if record.exc_info:
+                entry['exc'] = logging.Formatter().formatException(record.exc_info)
+            data = (json.dumps(entry) + '\n').encode('utf-8')
+            while data:
+                data = data[os.write(self.fd, data):]
+        except Exception:   # pylint: disable=broad-except
+            self.handleError(record)
+
+
 def setup_loggger():
-    """Prepare default logger
+    """Prepare default logger, sending logs to the web app over GIT4NGINX_LOG_FD
     """
     # sanity check
-    if 'GIT4NGINX_LOG_DIR' not in os.environ:
-        raise KeyError("Require environment variable to be set: GIT4NGINX_LOG_DIR")
-    if not os.path.isdir(os.environ['GIT4NGINX_LOG_DIR']):
-        raise FileNotFoundError("Log directory not found: {}".format(os.environ['GIT4NGINX_LOG_DIR']))
-    log_file = '{:.06f}_{}'.format(time.time(), sys.argv[0].split('/')[-1])
-    # create log file
+    if 'GIT4NGINX_LOG_FD' not in os.environ:
+        raise KeyError("Require environment variable to be set: GIT4NGINX_LOG_FD")
     logging.basicConfig(
-        filename=os.path.join(os.environ['GIT4NGINX_LOG_DIR'], log_file),
-        format='%(created)f [%(levelname)s] %(message)s (%(filename)s:%(lineno)d)',
+        handlers=[JSONLinesHandler(int(os.environ['GIT4NGINX_LOG_FD']))],
         level=logging.DEBUG,
     )
     logging.info("start log: %s", sys.argv[0])
@@ -57,16 +89,30 @@ def log_abort(message, exit_status=1):
         sys.exit(exit_status)
 
 
-def load_config():
+def load_config(use_snapshot=True):
     """Load the config file specified in uwsgi environment GIT4NGINX_CONFIG
 
-    :return: config contents (should be dict)
+    The compiled snapshot (see config_snapshot) is used if it is current,
+    else the YAML is parsed and the snapshot compiled for the next hook.
+
+    :arg use_snapshot: bool, False to always parse the YAML
+    :return: config_snapshot.Config, config contents
     """
     if 'GIT4NGINX_CONFIG' not in os.environ:
         raise KeyError("Require environment variable to be set: GIT4NGINX_CONFIG")
     config_path = os.environ['GIT4NGINX_CONFIG']
+    if use_snapshot:
+        try:
+            config = config_snapshot.load_snapshot(config_path)
+        except FileNotFoundError:
+            log_abort("Configuration file not found: {}".format(config_path))
+        if config is not None:
+            return config
+    # only needed when the snapshot is stale, importing is a good part of the cost
+    import yaml     # pylint: disable=import-outside-toplevel
     # read config
     try:
+        signature = config_snapshot.source_signature(config_path)
         with open(config_path, 'rt') as f_conf:
             config = yaml.safe_load(f_conf)
     except FileNotFoundError:
@@ -74,10 +120,34 @@ def load_config():
     except yaml.parser.ParserError as exc:
         log_abort("Configuration file yaml error:\n{}".format(exc))
     # sanity check config
+    if not isinstance(config, dict):
+        log_abort("Configuration file does not contain a mapping")
     for key in ['authentication', 'authorisation', 'hooks']:
         if key not in config or not isinstance(config[key], dict):
             log_abort("Configuration file does not contain valid '{}' configuration".format(key))
-    return config
+    if use_snapshot:
+        # scanning all of repo_root is left to compile_config.py
+        repo = config_snapshot.current_repo(config.get('repo_root', ''))
+        try:
+            config_snapshot.compile_config(config_path, config, signature, [] if repo is None else [repo])
+        except (OSError, ValueError) as exc:
+            logging.warning("Unable to compile config snapshot (run compile_config.py after config changes): %s", exc)
+    return config_snapshot.Config(config)
+
+
+
+def hook_configs(config, project_group, project):
+    """Effective hook plugin configs for a repo
+
+    :arg config: dict, config from load_config()
+    :arg project_group: str|None, project group or None for top level
+    :arg project: str, project with .git
+    :return: dict, plugin name: plugin config
+    """
+    repo_hooks = getattr(config, 'repo_hooks', {})
+    if (project_group, project) in repo_hooks:
+        return repo_hooks[(project_group, project)]
+    return config_snapshot.resolve_hooks(config['hooks'], project_group, project)
 
 
 
@@ -121,8 +191,14 @@ def repo_parts(repo_root, repo_dir=None):
 
 class GitWrapper(object):
     """Run git commands and process output for programatic use
+
+    Object lookups go through long-lived git cat-file processes and bulk
+    methods answer many queries at once, so share one instance between all
+    plugins in a hook run and close() it at the end.
     """
     zero = '0000000000000000000000000000000000000000'
+    # queries written to cat-file before reading replies, keeps pipes from filling
+    batch_size = 100
 
     def __init__(self, git_dir=None):
         if git_dir is None:
@@ -130,6 +206,134 @@ class GitWrapper(object):
             git_dir = os.getcwd()
         self.git_dir = os.path.realpath(git_dir)
         self.git_command = ['git', '--git-dir={}'.format(self.git_dir)]
+        # cat-file option: process
+        self._cat_file = {}
+        self._refs = None
+        self._reachability = None
+
+    def close(self):
+        """Stop persistent git processes
+        """
+        for process in self._cat_file.values():
+            process.stdin.close()
+            process.wait()
+            process.stdout.close()
+        self._cat_file = {}
+        if self._reachability is not None:
+            self._reachability.close()
+            self._reachability = None
+
+    def cat_file(self, objects, contents=False):
+        """Look up many objects through a persistent git cat-file
+
+        :arg objects: iterable of str, object names (any revision without whitespace)
+        :arg contents: bool, also return object contents (--batch) else only info (--batch-check)
+        :return: dict, object name: tuple of oid, type, size (, contents) or None if missing
+        """
+        option = '--batch' if contents else '--batch-check'
+        if option not in self._cat_file:
+            self._cat_file[option] = subprocess.Popen(
+                self.git_command + ['cat-file', option],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+            )
+        process = self._cat_file[option]
+        results = {}
+        names = []
+        for name in objects:
+            if not name or len(name.split()) != 1:
+                results[name] = None
+            elif name not in results:
+                results[name] = None
+                names.append(name)
+        for start in range(0, len(names), self.batch_size):
+            chunk = names[start:start + self.batch_size]
+            process.stdin.write(''.join(name + '\n' for name in chunk).encode('utf-8'))
+            process.stdin.flush()
+            for name in chunk:
+                header = process.stdout.readline().decode('utf-8').split()
+                if len(header) != 3:
+                    # "<name> missing" or "<name> ambiguous"
+                    continue
+                oid, object_type, size = header[0], header[1], int(header[2])
+                if contents:
+                    data = process.stdout.read(size)
+                    process.stdout.read(1)  # newline after contents
+                    results[name] = (oid, object_type, size, data)
+                else:
+                    results[name] = (oid, object_type, size)
+        return results
+
+    def resolve_revisions(self, revisions, object_type=None):
+        """Resolve many revisions to object ids in one go
+
+        :arg revisions: iterable of str, revisions (eg. branch names, refs, oids)
+        :arg object_type: str|None, peel to this type (eg. commit)
+        :return: dict, revision: oid or None if it doesn't exist
+        """
+        suffix = '^{{{}}}'.format(object_type) if object_type is not None else ''
+        revisions = list(revisions)
+        info = self.cat_file(revision + suffix for revision in revisions)
+        return {
+            revision: info[revision + suffix][0] if info[revision + suffix] is not None else None
+            for revision in revisions
+        }
+
+    def for_each_ref(self, prefixes=None):
+        """All refs (read once per instance)
+
+        :arg prefixes: list|None, only return refs starting with these
+        :return: dict, ref name: oid
+        """
+        if self._refs is None:
+            status, stdout, _ = self.git_run(['for-each-ref', '--format=%(objectname) %(refname)'])
+            if status:
+                return {}
+            self._refs = dict(
+                reversed(line.split(' ', 1))
+                for line in stdout.decode('utf-8').splitlines()
+            )
+        if prefixes is None:
+            return dict(self._refs)
+        prefixes = tuple(prefixes)
+        return {name: oid for name, oid in self._refs.items() if name.startswith(prefixes)}
+
+    @property
+    def reachability(self):
+        """Reachability index for the repo (created when first used)
+
+        :return: hook_helper.reachability.Reachability
+        """
+        if self._reachability is None:
+            self._reachability = reachability.Reachability(self)
+        return self._reachability
+
+    def are_ancestors(self, pairs):
+        """Check if many commits are reachable from others
+
+        Revisions are resolved together then history is walked at most once
+        for each distinct descendant, using commit-graph generation numbers
+        to stop as soon as it is below the ancestors asked about.
+
+        :arg pairs: iterable of (ancestor, descendant) revisions
+        :return: dict, (ancestor, descendant): bool
+        """
+        pairs = list(pairs)
+        commits = self.resolve_revisions(set(revision for pair in pairs for revision in pair), 'commit')
+        # descendant oid: ancestor oids to look for
+        wanted = {}
+        for ancestor, descendant in pairs:
+            if commits[ancestor] is not None and commits[descendant] is not None:
+                wanted.setdefault(commits[descendant], set()).add(commits[ancestor])
+        found = {
+            descendant: self.reachability.reachable(descendant, ancestors)
+            for descendant, ancestors in wanted.items()
+        }
+        results = {}
+        for ancestor, descendant in pairs:
+            ancestor_oid, descendant_oid = commits[ancestor], commits[descendant]
+            results[(ancestor, descendant)] = descendant_oid in found and ancestor_oid in found[descendant_oid]
+        return results
 
     def git_run(self, args, stdin='', repo_path=None):
         """General case git runner
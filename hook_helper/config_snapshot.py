@@ -0,0 +1,199 @@
+"""Compiled config snapshot for hooks
+
+git4nginx tools for using git via http(s) with Nginx
+Copyright (C) 2019  Glen Pitt-Pladdy
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+Hooks run as a new process for every push, so parsing the YAML config
+(and importing yaml) is a large part of their start up. The config is
+compiled to a marshal snapshot next to it (config.yaml -> config.yaml.snapshot)
+with the effective hook config of each repo under repo_root resolved, and
+loading that takes well under a millisecond.
+
+The snapshot records the size, mtime and inode of the YAML it was compiled
+from, and the snapshot format and Python versions. If any of those differ
+it is stale, the YAML is used, and the snapshot is compiled again (if the
+directory is writable) with only the repo the hook is running in resolved,
+other repos are resolved from the config as they are used. Compile with all
+repos under repo_root resolved, and where hooks can't write next to the
+config (eg. deployed by config management), with:
+    compile_config.py /path/to/config.yaml
+"""
+
+import os
+import sys
+import marshal
+import logging
+
+
+SNAPSHOT_VERSION = 1
+SUFFIX = '.snapshot'
+
+
+
+class Config(dict):
+    """Config contents, with hook config resolved per repo when from a snapshot
+    """
+    def __init__(self, config, repo_hooks=None):
+        """Setup
+
+        :arg config: dict, config contents
+        :arg repo_hooks: dict|None, (project group, project): {plugin: plugin config}
+        """
+        super().__init__(config)
+        self.repo_hooks = repo_hooks or {}
+
+
+def snapshot_path(config_path):
+    """Where the snapshot of a config is kept
+
+    :arg config_path: str, path to YAML config
+    :return: str
+    """
+    return config_path + SUFFIX
+
+
+def source_signature(config_path):
+    """Identify the YAML config contents
+
+    :arg config_path: str, path to YAML config
+    :return: tuple
+    :raises OSError: if the config can't be read
+    """
+    stat = os.stat(config_path)
+    return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+def resolve_hooks(hooks_config, project_group, project):
+    """Effective hook plugin configs for a repo, closest to the repo wins
+
+    :arg hooks_config: dict, hooks section of config
+    :arg project_group: str|None, project group or None for top level
+    :arg project: str, project with .git
+    :return: dict, plugin name: plugin config
+    """
+    levels = [hooks_config]
+    group_config = hooks_config.get(project_group)
+    if isinstance(group_config, dict):
+        levels.append(group_config)
+        if isinstance(group_config.get(project), dict):
+            levels.append(group_config[project])
+    resolved = {}
+    for level in levels:
+        for key, plugin_config in level.items():
+            if isinstance(key, str) and key.startswith('.'):
+                resolved[key[1:]] = plugin_config
+    return resolved
+
+
+def find_repos(repo_root):
+    """Repos at the top level or in a project group
+
+    :arg repo_root: str
+    :return: list of tuples (project group|None, project)
+    """
+    repos = []
+    try:
+        with os.scandir(repo_root) as top:
+            for entry in top:
+                if not entry.is_dir() or entry.name.startswith('.'):
+                    continue
+                if entry.name.endswith('.git'):
+                    repos.append((None, entry.name))
+                    continue
+                with os.scandir(entry.path) as group:
+                    repos += [(entry.name, sub.name) for sub in group if sub.name.endswith('.git') and sub.is_dir()]
+    except OSError as exc:
+        logging.warning("Can't list repos for config snapshot: %s", exc)
+    return repos
+
+
+def current_repo(repo_root, repo_dir=None):
+    """Repo a hook is running in, if it is one under repo_root
+
+    :arg repo_root: str
+    :arg repo_dir: str|None, default os.getcwd()
+    :return: tuple (project group|None, project)|None
+    """
+    try:
+        parts = os.path.relpath(os.path.realpath(repo_dir or os.getcwd()), os.path.realpath(repo_root)).split(os.sep)
+    except (OSError, ValueError):
+        return None
+    if parts[0] in ['.', '..'] or not parts[-1].endswith('.git') or len(parts) > 2:
+        return None
+    return (parts[0], parts[1]) if len(parts) == 2 else (None, parts[0])
+
+
+def compile_config(config_path, config, signature, repos=None):
+    """Write the snapshot of a config
+
+    :arg config_path: str, path to YAML config
+    :arg config: dict, config parsed from the YAML
+    :arg signature: tuple, source_signature() of the YAML config was parsed from
+    :arg repos: list|None, (project group, project) to resolve hook config of, default all under repo_root
+    :return: str, path to snapshot
+    :raises ValueError: if the config contains values that can't be stored
+    :raises OSError: if the snapshot can't be written
+    """
+    path = snapshot_path(config_path)
+    temp_path = '{}.{}.tmp'.format(path, os.getpid())
+    # readable by no more than the YAML (it may hold secrets), never umask-default
+    mode = os.stat(config_path).st_mode & 0o777
+    # before any scanning, so an unwritable directory costs nothing more
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    try:
+        with os.fdopen(fd, 'wb') as f_snapshot:
+            os.fchmod(f_snapshot.fileno(), mode)
+            if repos is None:
+                repos = find_repos(config.get('repo_root', ''))
+            repo_hooks = {
+                repo: resolve_hooks(config['hooks'], *repo)
+                for repo in repos
+            } if isinstance(config.get('hooks'), dict) else {}
+            f_snapshot.write(marshal.dumps({
+                'version': SNAPSHOT_VERSION,
+                'python': tuple(sys.version_info[:2]),
+                'source': signature,
+                'config': dict(config),
+                'repo_hooks': repo_hooks,
+            }))
+        os.rename(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+    return path
+
+
+def load_snapshot(config_path):
+    """Config from the snapshot if it is current
+
+    :arg config_path: str, path to YAML config
+    :return: Config|None, None if there is no current snapshot
+    :raises OSError: if the YAML config can't be read
+    """
+    signature = source_signature(config_path)
+    try:
+        with open(snapshot_path(config_path), 'rb') as f_snapshot:
+            snapshot = marshal.loads(f_snapshot.read())
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, EOFError, TypeError) as exc:
+        logging.warning("Ignoring unreadable config snapshot: %s", exc)
+        return None
+    if not isinstance(snapshot, dict) or snapshot.get('version') != SNAPSHOT_VERSION \
+            or snapshot.get('python') != tuple(sys.version_info[:2]) or snapshot.get('source') != signature:
+        return None
+    return Config(snapshot['config'], snapshot['repo_hooks'])
@@ -0,0 +1,197 @@
+"""Push context shared by hook plugins (plugin API v2)
+
+git4nginx tools for using git via http(s) with Nginx
+Copyright (C) 2019  Glen Pitt-Pladdy
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+The master hook builds one PushContext per hook run and passes it to
+every v2 plugin. Ref updates are parsed once, and the facts plugins ask
+about (commits the refs point at, whether updates are fast-forwards,
+commits new to the repo, ancestry) are each worked out for all refs in
+one batched git query the first time any plugin asks, then shared. A
+push of 1000 refs costs the same few git queries however many plugins
+look at it.
+"""
+
+import logging
+
+
+ZERO = '0000000000000000000000000000000000000000'
+
+
+
+class RefUpdate(object):
+    """One ref updated by the push
+    """
+    def __init__(self, old, new, ref):
+        """Setup
+
+        :arg old: str, oid before (zeros if created)
+        :arg new: str, oid after (zeros if deleted)
+        :arg ref: str, full ref name
+        """
+        self.old = old
+        self.new = new
+        self.ref = ref
+        if ref.startswith('refs/heads/'):
+            self.kind = 'branch'
+            self.name = ref[len('refs/heads/'):]
+        elif ref.startswith('refs/tags/'):
+            self.kind = 'tag'
+            self.name = ref[len('refs/tags/'):]
+        else:
+            self.kind = 'other'
+            self.name = ref
+        # filled in by PushContext when first needed
+        self.old_commit = None
+        self.new_commit = None
+        self.fast_forward = None
+
+    @property
+    def is_create(self):
+        """Ref did not exist before
+
+        :return: bool
+        """
+        return self.old == ZERO
+
+    @property
+    def is_delete(self):
+        """Ref is being deleted
+
+        :return: bool
+        """
+        return self.new == ZERO
+
+    def __repr__(self):
+        return 'RefUpdate({!r}, {!r}, {!r})'.format(self.old, self.new, self.ref)
+
+
+
+class PushContext(object):
+    """Everything about a push that plugins need, worked out once for all refs
+    """
+    def __init__(self, argv, references, gitwrapper, username, groups, user_info, project_group, project):
+        """Setup
+
+        :arg argv: list, arguments passed to hook
+        :arg references: list, of [old, new, ref] from stdin
+        :arg gitwrapper: hook_helper.GitWrapper, shared by all plugins
+        :arg username: str, user pushing
+        :arg groups: set, groups of the user
+        :arg user_info: set, additional info about the user
+        :arg project_group: str|None, project group or None for top level
+        :arg project: str, project with .git
+        """
+        self.argv = argv
+        self.gitwrapper = gitwrapper
+        self.username = username
+        self.groups = groups
+        self.user_info = user_info
+        self.project_group = project_group
+        self.project = project
+        self.updates = []
+        for reference in references:
+            if len(reference) != 3:
+                logging.warning("Ignoring malformed ref update: %s", ' '.join(reference))
+                continue
+            self.updates.append(RefUpdate(*reference))
+        self.by_ref = {update.ref: update for update in self.updates}
+        self._commits_resolved = False
+        self._fast_forwards_known = False
+        self._new_commits = None
+        # (ancestor, descendant): bool
+        self._ancestry = {}
+
+    def branches(self):
+        """Branch updates
+
+        :return: list of RefUpdate
+        """
+        return [update for update in self.updates if update.kind == 'branch']
+
+    def tags(self):
+        """Tag updates
+
+        :return: list of RefUpdate
+        """
+        return [update for update in self.updates if update.kind == 'tag']
+
+    def resolve_commits(self):
+        """Fill in the commits each update points at before and after (tags peeled)
+
+        :return: list of RefUpdate
+        """
+        if not self._commits_resolved:
+            oids = set(oid for update in self.updates for oid in (update.old, update.new) if oid != ZERO)
+            commits = self.gitwrapper.resolve_revisions(oids, 'commit')
+            for update in self.updates:
+                update.old_commit = commits.get(update.old)
+                update.new_commit = commits.get(update.new)
+            self._commits_resolved = True
+        return self.updates
+
+    def fast_forwards(self):
+        """Fill in whether each update of an existing ref is a fast-forward
+
+        Creates and deletes are left as None.
+
+        :return: list of RefUpdate
+        """
+        if not self._fast_forwards_known:
+            self.resolve_commits()
+            pairs = [
+                (update.old_commit, update.new_commit) for update in self.updates
+                if update.old_commit is not None and update.new_commit is not None
+            ]
+            known = self.are_ancestors(pairs)
+            for update in self.updates:
+                if not update.is_create and not update.is_delete:
+                    update.fast_forward = known.get((update.old_commit, update.new_commit), False)
+            self._fast_forwards_known = True
+        return self.updates
+
+    @property
+    def new_commits(self):
+        """Commits the push adds to the repo (not reachable from any existing ref)
+
+        :return: set of str, commit oids
+        """
+        if self._new_commits is None:
+            self.resolve_commits()
+            tips = sorted(set(update.new_commit for update in self.updates if update.new_commit is not None))
+            self._new_commits = set()
+            if tips:
+                # refs are not updated until pre-receive passes, so --all is the repo before the push
+                status, stdout, stderr = self.gitwrapper.git_run(
+                    ['rev-list', '--stdin', '--not', '--all'], ''.join(tip + '\n' for tip in tips).encode('ascii')
+                )
+                if status:
+                    raise RuntimeError("rev-list failed: {}".format(stderr.decode('utf-8', 'replace').strip()))
+                self._new_commits = set(stdout.decode('ascii').split())
+        return self._new_commits
+
+    def are_ancestors(self, pairs):
+        """Check if many commits are reachable from others, remembering answers for other plugins
+
+        :arg pairs: iterable of (ancestor, descendant) revisions
+        :return: dict, (ancestor, descendant): bool
+        """
+        pairs = list(pairs)
+        unknown = [pair for pair in pairs if pair not in self._ancestry]
+        if unknown:
+            self._ancestry.update(self.gitwrapper.are_ancestors(unknown))
+        return {pair: self._ancestry[pair] for pair in pairs}
@@ -0,0 +1,300 @@
+"""Commit reachability for hooks using commit-graph generation numbers
+
+git4nginx tools for using git via http(s) with Nginx
+Copyright (C) 2019  Glen Pitt-Pladdy
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+The repo commit-graph (objects/info/commit-graph) is read directly. A
+commit can only reach commits with a lower generation (topological level)
+so walks from a descendant stop as soon as they are below the ancestors
+looked for, which for typical pushes (ancestor near the tip) means only a
+few commits are visited however long the history. Commits newer than the
+commit-graph (eg. the ones being pushed) are read through cat-file until
+the walk reaches the commit-graph.
+"""
+
+import os
+import mmap
+import struct
+import logging
+import subprocess
+
+
+# commit-graph file format (Documentation/technical/commit-graph-format.txt)
+SIGNATURE = b'CGPH'
+HASH_LENGTHS = {1: 20, 2: 32}
+PARENT_NONE = 0x70000000
+PARENT_EXTRA = 0x80000000
+GENERATION_MAX = 0x3FFFFFFF
+# environment that points git at the push quarantine
+QUARANTINE_ENV = ('GIT_OBJECT_DIRECTORY', 'GIT_ALTERNATE_OBJECT_DIRECTORIES', 'GIT_QUARANTINE_PATH')
+
+
+
+class CommitGraph(object):
+    """Read only access to a (single file) commit-graph
+
+    Commits are referred to by their position in the file.
+    """
+    def __init__(self, path):
+        """Setup
+
+        :arg path: str, commit-graph file
+        """
+        with open(path, 'rb') as f_graph:
+            self.data = mmap.mmap(f_graph.fileno(), 0, access=mmap.ACCESS_READ)
+        signature, version, hash_version, chunk_count, base_count = struct.unpack_from('>4sBBBB', self.data, 0)
+        if signature != SIGNATURE or version != 1 or hash_version not in HASH_LENGTHS:
+            raise ValueError("Unsupported commit-graph: {}".format(path))
+        if base_count:
+            raise ValueError("Split commit-graph not supported: {}".format(path))
+        self.hash_length = HASH_LENGTHS[hash_version]
+        chunks = {}
+        for index in range(chunk_count):
+            chunk_id, offset = struct.unpack_from('>4sQ', self.data, 8 + 12 * index)
+            chunks[chunk_id] = offset
+        for chunk_id in [b'OIDF', b'OIDL', b'CDAT']:
+            if chunk_id not in chunks:
+                raise ValueError("Missing {} chunk in commit-graph: {}".format(chunk_id.decode('ascii'), path))
+        self.fanout = struct.unpack_from('>256I', self.data, chunks[b'OIDF'])
+        self.count = self.fanout[255]
+        self.oid_offset = chunks[b'OIDL']
+        self.data_offset = chunks[b'CDAT']
+        self.data_size = self.hash_length + 16
+        self.edge_offset = chunks.get(b'EDGE')
+
+    def close(self):
+        """Release the file
+        """
+        self.data.close()
+
+    def oid(self, position):
+        """Object id of a commit
+
+        :arg position: int
+        :return: str, hex oid
+        """
+        start = self.oid_offset + position * self.hash_length
+        return self.data[start:start + self.hash_length].hex()
+
+    def position(self, oid):
+        """Find a commit
+
+        :arg oid: str, hex oid
+        :return: int|None, position or None if not in the commit-graph
+        """
+        try:
+            target = bytes.fromhex(oid)
+        except ValueError:
+            return None
+        if len(target) != self.hash_length:
+            return None
+        low = self.fanout[target[0] - 1] if target[0] else 0
+        high = self.fanout[target[0]]
+        while low < high:
+            middle = (low + high) // 2
+            start = self.oid_offset + middle * self.hash_length
+            current = self.data[start:start + self.hash_length]
+            if current == target:
+                return middle
+            if current < target:
+                low = middle + 1
+            else:
+                high = middle
+        return None
+
+    def commit(self, position):
+        """Parents and generation of a commit
+
+        :arg position: int
+        :return: tuple of list of parent positions, int generation (0 if not computed)
+        """
+        start = self.data_offset + position * self.data_size + self.hash_length
+        parent1, parent2, generation = struct.unpack_from('>III', self.data, start)
+        parents = []
+        if parent1 != PARENT_NONE:
+            parents.append(parent1)
+        if parent2 & PARENT_EXTRA and self.edge_offset is not None:
+            # octopus merge, remaining parents are listed in EDGE
+            edge = self.edge_offset + 4 * (parent2 & ~PARENT_EXTRA)
+            while True:
+                (parent, ) = struct.unpack_from('>I', self.data, edge)
+                parents.append(parent & ~PARENT_EXTRA)
+                if parent & PARENT_EXTRA:
+                    break
+                edge += 4
+        elif parent2 != PARENT_NONE:
+            parents.append(parent2)
+        return parents, generation >> 2
+
+
+
+class Reachability(object):
+    """Answer which commits are reachable from others
+
+    Results are remembered (they can never change for given commits) so
+    repeated questions in a hook run are answered without walking again.
+    Long walks (ancestors deep in history) are handed to git which walks
+    much faster than Python.
+    """
+    # commits visited before asking git instead
+    walk_limit = 10000
+
+    def __init__(self, gitwrapper, write_graph=True):
+        """Setup
+
+        :arg gitwrapper: hook_helper.GitWrapper, repo to work on
+        :arg write_graph: bool, write the commit-graph if the repo has none
+        """
+        self.gitwrapper = gitwrapper
+        self.graph = None
+        # (ancestor oid, descendant oid): bool
+        self.memo = {}
+        path = os.path.join(gitwrapper.git_dir, 'objects', 'info', 'commit-graph')
+        if not os.path.exists(path) and write_graph and not os.path.exists(path + 's'):
+            self.write_graph()
+        if os.path.exists(path):
+            try:
+                self.graph = CommitGraph(path)
+            except (OSError, ValueError) as exc:
+                logging.warning("Not using commit-graph: %s", exc)
+        else:
+            logging.info("No commit-graph, walking history with cat-file")
+
+    def write_graph(self):
+        """Write the commit-graph for the repo (outside of any push quarantine)
+        """
+        env = {name: value for name, value in os.environ.items() if name not in QUARANTINE_ENV}
+        process = subprocess.run(
+            self.gitwrapper.git_command + ['commit-graph', 'write', '--reachable', '--no-progress'],
+            env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=False
+        )
+        if process.returncode:
+            logging.warning("Unable to write commit-graph: %s", process.stderr.decode('utf-8', 'replace').strip())
+        else:
+            logging.info("Wrote commit-graph for %s", self.gitwrapper.git_dir)
+
+    def close(self):
+        """Release the commit-graph
+        """
+        if self.graph is not None:
+            self.graph.close()
+            self.graph = None
+
+    def reachable(self, descendant, ancestors):
+        """Find which commits are reachable from another
+
+        :arg descendant: str, commit oid to walk from
+        :arg ancestors: iterable of str, commit oids to look for
+        :return: set, the ancestors that are reachable (a commit reaches itself)
+        """
+        found = set()
+        remaining = set()
+        for ancestor in ancestors:
+            if ancestor == descendant or self.memo.get((ancestor, descendant)):
+                found.add(ancestor)
+            elif (ancestor, descendant) not in self.memo:
+                remaining.add(ancestor)
+        if remaining:
+            walked = self._walk(descendant, remaining)
+            for ancestor in remaining:
+                self.memo[(ancestor, descendant)] = ancestor in walked
+            found |= walked
+        return found
+
+    def _node(self, oid):
+        """Walk node for a commit - position if in commit-graph else oid
+        """
+        if self.graph is not None:
+            position = self.graph.position(oid)
+            if position is not None:
+                return position
+        return oid
+
+    def _walk(self, descendant, ancestors):
+        """Walk history from descendant, pruning by generation
+
+        :arg descendant: str, commit oid
+        :arg ancestors: set, commit oids to look for
+        :return: set, the ancestors found
+        """
+        # positions (int) for commits in commit-graph, oids (str) for others
+        targets = {self._node(ancestor): ancestor for ancestor in ancestors}
+        found = set()
+        visited = set()
+        stack = [self._node(descendant)]
+        min_generation = self._min_generation(targets)
+        while stack and targets:
+            if len(visited) >= self.walk_limit:
+                found |= set(ancestor for ancestor in targets.values() if self._git_is_ancestor(ancestor, descendant))
+                break
+            node = stack.pop()
+            if node in visited:
+                continue
+            visited.add(node)
+            if node in targets:
+                found.add(targets.pop(node))
+                min_generation = self._min_generation(targets)
+                # may also reach other targets so continue with parents
+            if isinstance(node, int):
+                parents, generation = self.graph.commit(node)
+                if min_generation is None or (generation and (generation < min_generation or generation == min_generation != GENERATION_MAX)):
+                    # can't reach any of the remaining targets
+                    continue
+                stack.extend(parent for parent in parents if parent not in visited)
+            else:
+                stack.extend(
+                    parent for parent in map(self._node, self._parents(node))
+                    if parent not in visited
+                )
+        return found
+
+    def _git_is_ancestor(self, ancestor, descendant):
+        """Ask git if a commit is reachable from another
+
+        :arg ancestor: str, commit oid
+        :arg descendant: str, commit oid
+        :return: bool
+        """
+        status, _, _ = self.gitwrapper.git_run(['merge-base', '--is-ancestor', ancestor, descendant])
+        return status == 0
+
+    def _min_generation(self, targets):
+        """Lowest generation a commit must be above to reach any target
+
+        :arg targets: dict, walk nodes still being looked for
+        :return: int|None, 0 if unknown (no pruning), None if no target is in commit-graph
+        """
+        # targets outside commit-graph can only be reached through commits outside it
+        generations = [self.graph.commit(node)[1] for node in targets if isinstance(node, int)]
+        return min(generations) if generations else None
+
+    def _parents(self, oid):
+        """Read parents of a commit outside the commit-graph
+
+        :arg oid: str
+        :return: list of str, parent oids
+        """
+        info = self.gitwrapper.cat_file([oid], contents=True)[oid]
+        if info is None or info[1] != 'commit':
+            return []
+        parents = []
+        for line in info[3].split(b'\n'):
+            if not line:
+                break
+            if line.startswith(b'parent '):
+                parents.append(line[7:].decode('ascii'))
+        return parents
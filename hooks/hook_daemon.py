@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+"""Hook daemon - keeps config and plugins loaded so hooks start quickly
+
+git4nginx tools for using git via http(s) with Nginx
+Copyright (C) 2019  Glen Pitt-Pladdy
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+Run as the same user as git-http-backend with the same config, eg:
+    GIT4NGINX_CONFIG=/path/to/config.yaml hooks/hook_daemon.py
+
+Master hooks forward their arguments, stdin and environment over the socket
+(hook_daemon: socket in config) and the daemon forks a child, already
+holding the config and plugins, to run the hook exactly as the master hook
+would. Messages are marshal data prefixed with a 4 byte big-endian length
+(the master hook only has builtin modules loaded when forwarding). The
+request is a dict of argv, cwd, stdin and env, sent with the hook log pipe
+(GIT4NGINX_LOG_FD) as ancillary data, then output and the exit status are
+relayed back as tuples:
+    ('stdout', text), ('stderr', text) then ('exit', status)
+If the daemon is not running the master hooks run everything themselves.
+"""
+
+
+import os
+import sys
+import struct
+import marshal
+import socket
+import logging
+import argparse
+import socketserver
+import master_pre_receive
+hook_helper = master_pre_receive.hook_helper
+
+
+# hooks that can be run
+HOOKS = {
+    'pre-receive': master_pre_receive,
+    # master_post_receive.py links to master_pre_receive.py
+    'post-receive': master_pre_receive,
+}
+
+
+
+def send_message(wfile, name, value):
+    """Send a length prefixed marshal message to the master hook
+
+    :arg wfile: file, socket to write to
+    :arg name: str, message type (stdout, stderr, exit)
+    :arg value: str|int
+    """
+    data = marshal.dumps((name, value))
+    wfile.write(len(data).to_bytes(4, 'big') + data)
+
+
+
+class MessageStream(object):
+    """File-like object relaying writes to the hook as messages
+    """
+    def __init__(self, wfile, name):
+        """Setup
+
+        :arg wfile: file, socket to write to
+        :arg name: str, stream name (stdout, stderr)
+        """
+        self.wfile = wfile
+        self.name = name
+
+    def write(self, text):
+        """Send text to the hook
+
+        :arg text: str
+        :return: int, characters written
+        """
+        if text:
+            send_message(self.wfile, self.name, text)
+        return len(text)
+
+    def flush(self):
+        """Send anything pending
+        """
+        self.wfile.flush()
+
+
+
+class HookHandler(socketserver.StreamRequestHandler):
+    """Run a hook (in a forked child)
+    """
+    def handle(self):
+        """Become the hook process and run it
+        """
+        # only the user we run as (ie. git-http-backend) may run hooks
+        uid = struct.unpack('3i', self.request.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i')))[1]
+        if uid != os.getuid():
+            logging.error("Rejecting hook request from uid %d", uid)
+            return
+        # hook log pipe (if any) comes with the start of the request
+        header, fds, _, _ = socket.recv_fds(self.request, 4, 1)
+        header += self.rfile.read(4 - len(header))
+        request = marshal.loads(self.rfile.read(int.from_bytes(header, 'big')))
+        hook_name = request['argv'][0].split('/')[-1]
+        os.environ.clear()
+        os.environ.update(self.server.environ)
+        os.environ.update(request['env'])
+        os.environ.pop('GIT4NGINX_LOG_FD', None)
+        if fds:
+            os.environ['GIT4NGINX_LOG_FD'] = str(fds[0])
+        os.chdir(request['cwd'])
+        sys.argv = request['argv']
+        sys.stdout = MessageStream(self.wfile, 'stdout')
+        sys.stderr = MessageStream(self.wfile, 'stderr')
+        status = 0
+        try:
+            if hook_name not in HOOKS:
+                raise RuntimeError("Hook not supported by daemon: {}".format(hook_name))
+            # log to the hook log pipe for githttp
+            logging.root.handlers = []
+            hook_helper.setup_loggger()
+            logging.info("Running in hook daemon: %d", os.getpid())
+            config = self.server.config
+            if config is None or os.environ.get('GIT4NGINX_CONFIG') != self.server.config_path:
+                config = hook_helper.load_config()
+            references = [line.strip().split(' ') for line in request['stdin'].splitlines()]
+            HOOKS[hook_name].run(request['argv'], references, config)
+        except SystemExit as exc:
+            if isinstance(exc.code, str):
+                sys.stderr.write(exc.code + '\n')
+                status = 1
+            else:
+                status = exc.code or 0
+        except Exception as exc:     # pylint: disable=broad-except
+            logging.error("Exception in hook daemon: %s", exc.__class__.__name__, exc_info=True)
+            sys.stderr.write("Hook failed\n")
+            status = 1
+        send_message(self.wfile, 'exit', status)
+
+
+
+class HookServer(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+    """Fork a child for each hook, from a parent with config and plugins loaded
+    """
+    def __init__(self, socket_path, config_path):
+        """Setup
+
+        :arg socket_path: str, path to listen on
+        :arg config_path: str, config the daemon serves
+        """
+        self.config_path = config_path
+        self.config = None
+        self.config_signature = None
+        # environment for hooks, less anything that comes with requests
+        self.environ = {
+            name: value for name, value in os.environ.items()
+            if not name.startswith(master_pre_receive.FORWARD_ENV)
+        }
+        self.refresh()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        umask = os.umask(0o077)
+        try:
+            super().__init__(socket_path, HookHandler)
+        finally:
+            os.umask(umask)
+
+    def refresh(self):
+        """Reload config and plugins if changed
+        """
+        try:
+            stat = os.stat(self.config_path)
+            signature = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        except OSError as exc:
+            logging.error("Unable to stat config: %s", exc)
+            signature = None
+        if signature != self.config_signature:
+            try:
+                self.config = hook_helper.load_config()
+                logging.info("Loaded config: %s", self.config_path)
+            except SystemExit:
+                logging.error("Keeping previous config")
+            self.config_signature = signature
+        for hook_name, hook in HOOKS.items():
+            plugin_dir = hook.plugin_dir_for(hook_name)
+            for plugin_file in sorted(os.listdir(plugin_dir)):
+                plugin_name, ext = os.path.splitext(plugin_file)
+                if ext != '.py':
+                    continue
+                try:
+                    hook.load_plugin(plugin_dir, plugin_name)
+                except Exception:   # pylint: disable=broad-except
+                    # hooks will report this when they try to use it
+                    logging.error("Unable to load plugin: %s", plugin_file, exc_info=True)
+
+    def process_request(self, request, client_address):
+        """Refresh in the parent so each child starts with current config and plugins
+        """
+        self.refresh()
+        super().process_request(request, client_address)
+
+
+
+def main(argv):
+    """Main entry point for daemon
+
+    :argv: list, arguments passed to daemon
+    """
+    parser = argparse.ArgumentParser(description="git4nginx hook daemon")
+    parser.add_argument('--socket', help="Socket to listen on, default from config (hook_daemon: socket)")
+    args = parser.parse_args(argv[1:])
+    logging.basicConfig(
+        format='%(asctime)s - %(levelname)s %(message)s (%(filename)s:%(lineno)d)',
+        level=getattr(logging, os.environ.get('GIT4NGINX_LOG_LEVEL', 'INFO')),
+    )
+    if 'GIT4NGINX_CONFIG' not in os.environ:
+        sys.exit("Require environment variable to be set: GIT4NGINX_CONFIG")
+    config_path = os.environ['GIT4NGINX_CONFIG']
+    socket_path = args.socket
+    if socket_path is None:
+        socket_path = (hook_helper.load_config().get('hook_daemon') or {}).get('socket')
+    if socket_path is None:
+        sys.exit("No socket configured (hook_daemon: socket) or given (--socket)")
+    server = HookServer(socket_path, config_path)
+    logging.info("Listening on: %s", socket_path)
+    try:
+        server.serve_forever()
+    finally:
+        os.unlink(socket_path)
+
+
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1 @@
+master_pre_receive.py
\ No newline at end of file
@@ -18,19 +18,146 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 
+Also the master post-receive hook (master_post_receive.py links here),
+plugins are run from the directory named after the hook invoked.
+
+Plugins are classes named Plugin in the plugin module:
+    v1 - Plugin(username, groups, user_info, plugin_config, config, inputs,
+         project_group, project, gitwrapper).run() examines inputs[1] (the
+         [old, new, ref] lists) itself and aborts (sys.exit) to reject
+    v2 - api_version = 2 on the class, Plugin(plugin_config, config).check(context)
+         is given a hook_helper.push_context.PushContext shared by all plugins
+         and returns {ref: reason} for refs it rejects (empty to accept all)
+Rejections from v2 plugins are collected and reported together, then the
+push is rejected.
 """
 
 
 import os
 import sys
-import logging
+import marshal
+import _socket
+# environment passed to the hook daemon
+FORWARD_ENV = ('GIT4NGINX_', 'GIT_', 'REMOTE_USER')
+
+
+
+def recv_message(client):
+    """Receive a length prefixed marshal message from the hook daemon
+
+    :arg client: socket
+    :return: tuple of name, value
+    :raises EOFError: if the connection closes first
+    """
+    data = b''
+    size = 4
+    while len(data) < size:
+        chunk = client.recv(size - len(data))
+        if not chunk:
+            raise EOFError("Connection closed")
+        data += chunk
+        if size == 4 and len(data) == 4:
+            size += int.from_bytes(data, 'big')
+    return marshal.loads(data[4:])
+
+
+def forward(socket_path, argv):
+    """Run the hook in the hook daemon (hook_daemon.py) which has everything loaded already
+
+    Deliberately only uses builtin modules so this costs as little as possible.
+
+    :arg socket_path: str, path to hook daemon socket
+    :arg argv: list, arguments passed to hook
+    :return: int|None, exit status for hook or None if the daemon is not available
+    """
+    client = _socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+    except OSError:
+        client.close()
+        return None
+    request = marshal.dumps({
+        'argv': argv,
+        'cwd': os.getcwd(),
+        'stdin': sys.stdin.read(),
+        'env': {name: value for name, value in os.environ.items() if name.startswith(FORWARD_ENV)},
+    })
+    request = len(request).to_bytes(4, 'big') + request
+    # the daemon logs over our log pipe, passed with the request
+    ancillary = []
+    if os.environ.get('GIT4NGINX_LOG_FD'):
+        ancillary.append((
+            _socket.SOL_SOCKET, _socket.SCM_RIGHTS,
+            int(os.environ['GIT4NGINX_LOG_FD']).to_bytes(4, sys.byteorder, signed=True)
+        ))
+    try:
+        sent = client.sendmsg([request], ancillary)
+        client.sendall(request[sent:])
+        # relay messages until we get the verdict
+        while True:
+            name, value = recv_message(client)
+            if name == 'exit':
+                return value
+            stream = sys.stderr if name == 'stderr' else sys.stdout
+            stream.write(value)
+            stream.flush()
+    except (OSError, EOFError, ValueError):
+        sys.stderr.write("Hook daemon failed to complete hook\n")
+        return 1
+    finally:
+        client.close()
+
+
+if __name__ == '__main__' and os.environ.get('GIT4NGINX_HOOK_SOCKET'):
+    STATUS = forward(os.environ['GIT4NGINX_HOOK_SOCKET'], sys.argv)
+    if STATUS is not None:
+        sys.exit(STATUS)
+
+
+# pylint: disable=wrong-import-position
 import json
-import imp
+import logging
+import importlib.util
 # custom helper needs us to find the path first
 sys.path.append(os.path.realpath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')))
 import hook_helper
+from hook_helper import push_context
+import metrics
+# pylint: enable=wrong-import-position
 
 
+# path: (mtime, module) - plugins stay loaded in the hook daemon
+_plugins = {}
+
+def load_plugin(plugin_dir, plugin_name):
+    """Load a plugin, reusing the previously loaded module if unchanged
+
+    :arg plugin_dir: str, directory of plugins for hook
+    :arg plugin_name: str, name of plugin (file without .py)
+    :return: module
+    """
+    plugin_path = os.path.join(plugin_dir, plugin_name + '.py')
+    mtime = os.stat(plugin_path).st_mtime_ns
+    plugin_key = os.path.join(plugin_dir, plugin_name)
+    if plugin_key in _plugins and _plugins[plugin_key][0] == mtime:
+        return _plugins[plugin_key][1]
+    # named by directory, so pre and post receive plugins of the same name don't clash
+    spec = importlib.util.spec_from_file_location(os.path.basename(plugin_dir) + '.' + plugin_name, plugin_path)
+    plugin = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(plugin)
+    _plugins[plugin_key] = (mtime, plugin)
+    return plugin
+
+
+def plugin_dir_for(hook_name):
+    """Directory of plugins for a hook
+
+    :arg hook_name: str, eg. pre-receive
+    :return: str
+    """
+    master_hook_dir = os.path.dirname(os.path.realpath(__file__))
+    return os.path.join(master_hook_dir, hook_name.replace('-', '_') + '_plugins')
+
 
 def main(argv):
     """Main entry point for hook
@@ -39,12 +166,20 @@ def main(argv):
     """
     hook_helper.setup_loggger()
     config = hook_helper.load_config()
-    hook_name = argv[0].split('/')[-1]
-    master_hook_dir = os.path.dirname(os.path.realpath(__file__))
-    plugin_dir = hook_name.replace('-', '_') + '_plugins'
-    plugin_dir = os.path.join(master_hook_dir, plugin_dir)
     # get the references list from stdin
     references = [line.strip().split(' ') for line in sys.stdin]
+    run(argv, references, config)
+
+
+def run(argv, references, config):
+    """Run the enabled plugins for the hook
+
+    :arg argv: list, arguments passed to hook
+    :arg references: list, of [old, new, ref] from stdin
+    :arg config: dict, git4nginx config
+    """
+    hook_name = argv[0].split('/')[-1]
+    plugin_dir = plugin_dir_for(hook_name)
     # prepare plugin info
     if 'REMOTE_USER' not in os.environ:
         hook_helper.log_abort("No REMOTE_USER in environment")  # TODO more serious
@@ -58,53 +193,70 @@ def main(argv):
     inputs = [argv, references]
     gitwrapper = hook_helper.GitWrapper()
     project_group, project = hook_helper.repo_parts(config['repo_root'])
-    # process each plugin that is enabled
-    for plugin_file in sorted(os.listdir(plugin_dir)):
-        logging.debug(plugin_file)
-        plugin_name, ext = os.path.splitext(plugin_file)
-        if ext != '.py':
-            continue
-        # calculate specific project config
-        plugin_config_key = '.' + plugin_name
-        plugin_config = None
-        if plugin_config_key in config['hooks']:
-            # global - all projects
-            plugin_config = config['hooks'][plugin_config_key]
-        if project_group in config['hooks']:
-            if plugin_config_key in config['hooks'][project_group]:
-                # project group - all projects in group
-                plugin_config = config['hooks'][project_group][plugin_config_key]
-            if project in config['hooks'][project_group]:
-                if plugin_config_key in config['hooks'][project_group][project]:
-                    # project specific config
-                    plugin_config = config['hooks'][project_group][project][plugin_config_key]
-        if plugin_config is None:
-            # plugin not configured
-            continue
-        if 'enable' in plugin_config and not plugin_config['enable']:
-            # plugin disabled
-            continue
-        # load and run the plugin
-        logging.info("Loading plugin: %s", plugin_name)
-        # catch any exceptions for the plugin
-        try:
-            info = imp.find_module(plugin_name, [plugin_dir])
-            plugin = imp.load_module(plugin_name, *info)
-            logging.info("Executing plugin: %s", plugin_name)
-            plugin_obj = plugin.Plugin(
-                username,
-                groups,
-                user_info,
-                plugin_config,
-                config,
-                inputs,
-                project_group, project,
-                gitwrapper
-            )
-            plugin_obj.run()
-        except Exception as exc:
-            logging.error("Exception in plugin: %s", exc.__class__.__name__, exc_info=True)
-            sys.exit("Hook failed")
+    collector = metrics.Metrics(config['metrics']['path']) if config.get('metrics') else metrics.NULL_METRICS
+    # global -> project group -> project, closest to the repo wins
+    plugin_configs = hook_helper.hook_configs(config, project_group, project)
+    # shared by v2 plugins, built when the first one runs
+    context = None
+    # (ref, plugin, reason) from v2 plugins
+    rejected = []
+    try:
+        # process each plugin that is enabled
+        for plugin_file in sorted(os.listdir(plugin_dir)):
+            logging.debug(plugin_file)
+            plugin_name, ext = os.path.splitext(plugin_file)
+            if ext != '.py':
+                continue
+            plugin_config = plugin_configs.get(plugin_name)
+            if plugin_config is None:
+                # plugin not configured
+                continue
+            if 'enable' in plugin_config and not plugin_config['enable']:
+                # plugin disabled
+                continue
+            # load and run the plugin
+            logging.info("Loading plugin: %s", plugin_name)
+            # catch any exceptions for the plugin
+            try:
+                plugin = load_plugin(plugin_dir, plugin_name)
+                logging.info("Executing plugin: %s", plugin_name)
+                if getattr(plugin.Plugin, 'api_version', 1) >= 2:
+                    if context is None:
+                        context = push_context.PushContext(
+                            argv, references, gitwrapper, username, groups, user_info, project_group, project
+                        )
+                    plugin_obj = plugin.Plugin(plugin_config, config)
+                    with collector.time('hook_plugin_seconds', hook=hook_name, plugin=plugin_name):
+                        verdicts = plugin_obj.check(context) or {}
+                    for ref, reason in sorted(verdicts.items()):
+                        logging.warning("Plugin %s rejected %s: %s", plugin_name, ref, reason)
+                        rejected.append((ref, plugin_name, reason))
+                    continue
+                plugin_obj = plugin.Plugin(
+                    username,
+                    groups,
+                    user_info,
+                    plugin_config,
+                    config,
+                    inputs,
+                    project_group, project,
+                    gitwrapper
+                )
+                with collector.time('hook_plugin_seconds', hook=hook_name, plugin=plugin_name):
+                    plugin_obj.run()
+            except Exception as exc:
+                logging.error("Exception in plugin: %s", exc.__class__.__name__, exc_info=True)
+                sys.exit("Hook failed")
+        if rejected:
+            for ref, plugin_name, reason in rejected:
+                print("{} ({}): {}".format(ref, plugin_name, reason))
+            hook_helper.log_abort("Push rejected: {}".format('; '.join(
+                '{}: {}'.format(ref, reason) for ref, _, reason in rejected
+            )))
+    finally:
+        # git processes shared by plugins
+        gitwrapper.close()
+        collector.flush()
 
 
 
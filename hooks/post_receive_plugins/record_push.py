@@ -0,0 +1,54 @@
+"""Hook plugin - record pushes for background repo maintenance
+
+git4nginx tools for using git via http(s) with Nginx
+Copyright (C) 2019  Glen Pitt-Pladdy
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+"""
+
+
+import os
+import logging
+import maintenance
+
+
+class Plugin(object):
+    run_hooks = [
+        'post-receive',
+    ]
+    def __init__(self, username, groups, user_info, plugin_config, config, inputs, project_group, project, gitwrapper):
+        """Common setup for plugin
+        """
+        self.username = username
+        self.groups = groups
+        self.user_info = user_info
+        self.plugin_config = plugin_config
+        self.config = config
+        self.argv = inputs[0]
+        self.revisions = inputs[1]
+        self.project_group = project_group
+        self.project = project
+        self.gitwrapper = gitwrapper
+
+    def run(self):
+        """Execute the plugin - count the push, maintenance.py does the work later
+        """
+        if not self.config.get('maintenance'):
+            logging.warning("record_push enabled but maintenance is not configured")
+            return
+        repo = self.project if self.project_group is None else os.path.join(self.project_group, self.project)
+        maintenance.from_config(self.config).record_push(repo, len(self.revisions))
+        logging.info("Recorded push to %s for maintenance", repo)
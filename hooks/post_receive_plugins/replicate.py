@@ -0,0 +1,57 @@
+"""Hook plugin - mirror pushes to replicas
+
+git4nginx tools for using git via http(s) with Nginx
+Copyright (C) 2019  Glen Pitt-Pladdy
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+"""
+
+
+import os
+import logging
+import replication
+
+
+class Plugin(object):
+    run_hooks = [
+        'post-receive',
+    ]
+    def __init__(self, username, groups, user_info, plugin_config, config, inputs, project_group, project, gitwrapper):
+        """Common setup for plugin
+        """
+        self.username = username
+        self.groups = groups
+        self.user_info = user_info
+        self.plugin_config = plugin_config
+        self.config = config
+        self.argv = inputs[0]
+        self.revisions = inputs[1]
+        self.project_group = project_group
+        self.project = project
+        self.gitwrapper = gitwrapper
+
+    def run(self):
+        """Execute the plugin - record the push, a background process mirrors the repo to replicas
+        """
+        if not self.config.get('replication'):
+            logging.warning("replicate enabled but replication is not configured")
+            return
+        repo = self.project if self.project_group is None else os.path.join(self.project_group, self.project)
+        replicator = replication.from_config(self.config)
+        replicator.record_push(repo, self.username)
+        # failures are recorded for replication.py status, replication.py sync catches up
+        replication.start_replicate(repo)
+        logging.info("Replicating %s in the background", repo)
@@ -21,61 +21,89 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 
 import logging
-import hook_helper
 
 
 class Plugin(object):
+    api_version = 2
     run_hooks = [
         'pre-receive',
     ]
-    def __init__(self, username, groups, user_info, plugin_config, config, inputs, project_group, project, gitwrapper):
+    def __init__(self, plugin_config, config):
         """Common setup for plugin
         """
-        self.username = username
-        self.groups = groups
-        self.user_info = user_info
         self.plugin_config = plugin_config
         self.config = config
-        self.argv = inputs[0]
-        self.revisions = inputs[1]
-        self.project_group = project_group
-        self.project = project
-        self.gitwrapper = gitwrapper
 
-    def run(self):
+    def check(self, context):
         """Execute the plugin - ensure revisions are in the upstream branch
-        """
-        for rev in self.revisions:
-            head = rev[2]
-            if not head.startswith('refs/heads/'):
-                hook_helper.log_abort("Unexpected refernce: {}".format(head))
-            branch = head.split('/')[-1]
-            commit_from = rev[0]
-            commit_to = rev[1]
 
+        The branch name within the flow is the last part of the ref (eg.
+        release/master is master). Every ref is checked, a push including an
+        unrestricted branch does not skip checks of the other refs.
+
+        An existing branch may only move to a commit in the upstream branch
+        that is not reachable from the parent of its current commit (as from
+        rev-list old^..upstream), and the upstream branch must not be
+        reachable from that parent. A new branch may point at any commit in
+        the upstream branch. All refs are answered by one batched ancestry
+        check, without walking history per ref.
+
+        Before, the last (oldest dated) commit of rev-list old^..upstream was
+        also refused. That is the current commit (so no change) unless the
+        upstream branch merged in commits older than it, in which case one of
+        those was arbitrarily refused and now isn't.
+
+        :arg context: hook_helper.push_context.PushContext
+        :return: dict, ref: reason for refs rejected
+        """
+        rejected = {}
+        checks = []
+        for update in context.updates:
+            if update.kind != 'branch':
+                rejected[update.ref] = "Unexpected reference: {}".format(update.ref)
+                continue
+            branch = update.ref.split('/')[-1]
             if branch not in self.plugin_config['flow']:
                 # assume feature branch (not in restricted flow branches)
-                logging.info("non-restricted branch, allowed to go into %s", branch)
-                return
+                logging.info("non-restricted branch, allowed to go into %s", update.ref)
+                continue
             flow_step = self.plugin_config['flow'].index(branch)
             if flow_step == 0:
                 # starting step - good
-                logging.info("starting branch, allowed to go into %s", branch)
-                return
+                logging.info("starting branch, allowed to go into %s", update.ref)
+                continue
 
             # find what we're comparing to (prior branch in sequence)
-            upstream_branch = self.plugin_config['flow'][flow_step - 1]
-
-            # check for revision in upstream
-            upstream_revisions = self.gitwrapper.get_revisions([commit_from, upstream_branch])
-            if not upstream_revisions:
-                message = "Upstream branch ({}) does not contain from revision for target ({}): {}".format(upstream_branch, branch, commit_from)
-                print(message)
-                hook_helper.log_abort(message)
-            to_range = upstream_revisions if commit_from == self.gitwrapper.zero else upstream_revisions[:-1]
-            if commit_to not in to_range:
-                message = "Upstream branch ({}) does not contain to revision for target ({}): {}".format(upstream_branch, branch, commit_to)
-                print(message)
-                hook_helper.log_abort(message)
-            # revisions are in upstream branch so we seem to be good
-            logging.info("%s..%s found in %s, allowed to go into %s", commit_from, commit_to, upstream_branch, branch)
+            checks.append((update, branch, self.plugin_config['flow'][flow_step - 1]))
+
+        # everything needed for all refs, asked at once
+        pairs = []
+        for update, _, upstream_branch in checks:
+            pairs.append((update.new, upstream_branch))
+            if not update.is_create:
+                pairs += [(update.new, update.old + '^'), (upstream_branch, update.old + '^')]
+        ancestry = context.are_ancestors(pairs)
+        exists = context.gitwrapper.resolve_revisions(
+            set(upstream_branch for _, _, upstream_branch in checks)
+            | set(update.old + '^' for update, _, _ in checks if not update.is_create),
+            'commit'
+        )
+        for update, branch, upstream_branch in checks:
+            in_upstream = ancestry[(update.new, upstream_branch)]
+            if update.is_create:
+                from_ok = exists[upstream_branch] is not None
+                to_ok = in_upstream
+            else:
+                parent = update.old + '^'
+                # a root commit has no parent, upstream already merged into it leaves nothing to move to
+                from_ok = exists[upstream_branch] is not None and exists[parent] is not None \
+                    and not ancestry[(upstream_branch, parent)]
+                to_ok = in_upstream and not ancestry[(update.new, parent)] and update.new != update.old
+            if not from_ok:
+                rejected[update.ref] = "Upstream branch ({}) does not contain from revision for target ({}): {}".format(upstream_branch, branch, update.old)
+            elif not to_ok:
+                rejected[update.ref] = "Upstream branch ({}) does not contain to revision for target ({}): {}".format(upstream_branch, branch, update.new)
+            else:
+                # revisions are in upstream branch so we seem to be good
+                logging.info("%s..%s found in %s, allowed to go into %s", update.old, update.new, upstream_branch, update.ref)
+        return rejected
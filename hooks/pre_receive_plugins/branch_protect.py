@@ -25,50 +25,44 @@ import hook_helper
 
 
 class Plugin(object):
+    api_version = 2
     run_hooks = [
         'pre-receive',
     ]
-    def __init__(self, username, groups, user_info, plugin_config, config, inputs, project_group, project, gitwrapper):
+    def __init__(self, plugin_config, config):
         """Common setup for plugin
         """
-        self.username = username
-        self.groups = groups
-        self.user_info = user_info
         self.plugin_config = plugin_config
         self.config = config
-        self.argv = inputs[0]
-        self.revisions = inputs[1]
-        self.project_group = project_group
-        self.project = project
-        self.gitwrapper = gitwrapper
 
-    def run(self):
+    def check(self, context):
         """Execute the plugin - ensure permission to write to branches
+
+        :arg context: hook_helper.push_context.PushContext
+        :return: dict, ref: reason for refs rejected
         """
-        for rev in self.revisions:
-            head = rev[2]
-            if not head.startswith('refs/heads/'):
-                hook_helper.log_abort("Unexpected refernce: {}".format(head))
-            branch = head.split('/')[-1]
-            if 'branches' not in self.plugin_config:
-                hook_helper.log_abort("Config missing: branches")
+        if 'branches' not in self.plugin_config:
+            hook_helper.log_abort("Config missing: branches")
+        rejected = {}
+        for update in context.updates:
+            if update.kind != 'branch':
+                rejected[update.ref] = "Unexpected reference: {}".format(update.ref)
+                continue
+            branch = update.ref.split('/')[-1]
 
             # check if a branch is configured (restricted)
             branch_config = self.plugin_config['branches']
             if branch not in branch_config:
                 logging.info("non-restricted branch, allowed to write to: %s", branch)
                 continue
-            # check if write permission TODO
+            # check if write permission
             branch_config = branch_config[branch]
-            print(self.groups)
-            print(branch_config)
-            if '.write_groups' in branch_config and not self.groups.isdisjoint(set(branch_config['.write_groups'])):
+            if '.write_groups' in branch_config and not context.groups.isdisjoint(set(branch_config['.write_groups'])):
                 logging.info("Group allowed to write to: %s", branch)
                 continue
-            if '.write_users' in branch_config and self.username in branch_config['.write_users']:
+            if '.write_users' in branch_config and context.username in branch_config['.write_users']:
                 logging.info("User allowed to write to: %s", branch)
                 continue
-            # failed to get permission - STOP
-            message = "Neither groups or user has permission to write to restricted branch: {}".format(branch)
-            print(message)
-            hook_helper.log_abort(message)
+            # failed to get permission
+            rejected[update.ref] = "Neither groups or user has permission to write to restricted branch: {}".format(branch)
+        return rejected
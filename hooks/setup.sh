@@ -77,4 +77,5 @@ fi
 # create links
 #link_hook update
 link_hook pre-receive
+link_hook post-receive
 
@@ -0,0 +1,140 @@
+"""Git LFS object storage beside each repo
+
+git4nginx tools for using git via http(s) with Nginx
+Copyright (C) 2019  Glen Pitt-Pladdy
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+Objects are stored by SHA-256 under lfs/objects/ in the repo, laid out as
+git-lfs does locally (lfs/objects/ab/cd/abcd...). Uploads are written to
+lfs/tmp/ while being hashed and only moved into place once the size and
+hash match the oid, so a stored object is always complete and correct.
+Downloads are left to nginx (X-Accel-Redirect) so only the batch API
+metadata and uploads pass through Python.
+"""
+
+import os
+import re
+import hashlib
+import tempfile
+
+
+OID_RE = re.compile(r'^[0-9a-f]{64}$')
+CHUNK_SIZE = 1048576
+MEDIA_TYPE = 'application/vnd.git-lfs+json'
+
+
+
+def object_path(repo_path, oid):
+    """Where an object is stored
+
+    :arg repo_path: str, path to repo
+    :arg oid: str, SHA-256 hex (must be validated first)
+    :return: str
+    """
+    return os.path.join(repo_path, 'lfs', 'objects', oid[0:2], oid[2:4], oid)
+
+
+def object_size(repo_path, oid):
+    """Size of a stored object
+
+    :arg repo_path: str, path to repo
+    :arg oid: str, SHA-256 hex (must be validated first)
+    :return: int|None, None if not stored
+    """
+    try:
+        return os.stat(object_path(repo_path, oid)).st_size
+    except FileNotFoundError:
+        return None
+
+
+def store_object(repo_path, oid, size, stream, chunk_size=CHUNK_SIZE):
+    """Stream an upload to disk, verifying it as it arrives
+
+    :arg repo_path: str, path to repo
+    :arg oid: str, SHA-256 hex (must be validated first)
+    :arg size: int, expected size
+    :arg stream: stream, upload body
+    :arg chunk_size: int, bytes read at a time
+    :raises ValueError: if the size or hash does not match
+    """
+    temp_dir = os.path.join(repo_path, 'lfs', 'tmp')
+    os.makedirs(temp_dir, exist_ok=True)
+    digest = hashlib.sha256()
+    received = 0
+    f_temp = tempfile.NamedTemporaryFile(dir=temp_dir, prefix=oid + '.', delete=False)
+    try:
+        with f_temp:
+            while True:
+                data = stream.read(min(chunk_size, size + 1 - received))
+                if not data:
+                    break
+                received += len(data)
+                if received > size:
+                    raise ValueError("Upload larger than expected {} bytes".format(size))
+                digest.update(data)
+                f_temp.write(data)
+        if received != size:
+            raise ValueError("Upload of {} bytes does not match expected {} bytes".format(received, size))
+        if digest.hexdigest() != oid:
+            raise ValueError("Upload does not match oid, got {}".format(digest.hexdigest()))
+        path = object_path(repo_path, oid)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # readable by nginx for X-Accel-Redirect
+        os.chmod(f_temp.name, 0o644)
+        os.rename(f_temp.name, path)
+    except BaseException:
+        os.unlink(f_temp.name)
+        raise
+
+
+def batch_objects(repo_path, operation, objects, href, headers, max_size=None):
+    """Objects part of a batch API response
+
+    :arg repo_path: str, path to repo
+    :arg operation: str, download or upload
+    :arg objects: list of dict, oid and size requested
+    :arg href: str, base URL for object transfers (ending /)
+    :arg headers: dict, headers the client should send with transfers
+    :arg max_size: int|None, largest object accepted for upload
+    :return: list of dict
+    :raises ValueError: on malformed objects
+    """
+    response = []
+    for item in objects:
+        if not isinstance(item, dict) or not isinstance(item.get('oid'), str) or not OID_RE.match(item['oid']):
+            raise ValueError("Invalid object oid")
+        if not isinstance(item.get('size'), int) or item['size'] < 0:
+            raise ValueError("Invalid object size: {}".format(item['oid']))
+        oid, size = item['oid'], item['size']
+        entry = {'oid': oid, 'size': size}
+        stored = object_size(repo_path, oid)
+        action = {'href': href + oid, 'header': headers}
+        if operation == 'download':
+            if stored is None:
+                entry['error'] = {'code': 404, 'message': "Object does not exist"}
+            else:
+                entry['size'] = stored
+                entry['authenticated'] = True
+                entry['actions'] = {'download': action}
+        elif stored is None:
+            if max_size is not None and size > max_size:
+                entry['error'] = {'code': 422, 'message': "Object larger than {} bytes".format(max_size)}
+            else:
+                entry['authenticated'] = True
+                entry['actions'] = {'upload': action}
+        # else already stored, no actions so the client skips it
+        response.append(entry)
+    return response
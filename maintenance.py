@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+"""Background maintenance of served repos
+
+git4nginx tools for using git via http(s) with Nginx
+Copyright (C) 2019  Glen Pitt-Pladdy
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+Pushes are recorded per repo (post-receive plugin record_push) and each
+maintenance pass works through repos under repo_root that have been pushed
+to, or never maintained (eg. new from create_repo.sh), running the tasks
+their layout needs:
+    pack-refs       loose refs from pushes into packed-refs
+    repack          geometric repack with multi-pack-index and bitmaps
+    commit-graph    single file, as used by hook_helper.reachability
+    bundle          clone bundles (see bundles.py), if configured
+
+Repos with a push in progress or pushed to within quiet_period are left for
+a later pass. Work runs at low CPU and IO priority and is paced to use at
+most cpu_budget of one CPU, and a pass stops starting work after
+max_pass_seconds. Run from cron or as a service, eg:
+    GIT4NGINX_CONFIG=/path/to/config.yaml maintenance.py run
+    GIT4NGINX_CONFIG=/path/to/config.yaml maintenance.py service
+    GIT4NGINX_CONFIG=/path/to/config.yaml maintenance.py status
+"""
+
+import os
+import sys
+import glob
+import json
+import time
+import fcntl
+import shutil
+import logging
+import argparse
+import resource
+import subprocess
+import yaml
+import bundles
+
+
+STATE = 'state.json'
+RUN_LOCK = 'run.lock'
+
+
+
+class Maintainer(object):
+    """Push tracking and maintenance of repos below repo_root
+    """
+    def __init__(self, repo_root, path, quiet_period=120, cpu_budget=0.5, max_pass_seconds=1800, geometric_factor=2, bundle_store=None):
+        """Setup
+
+        :arg repo_root: str, served repos
+        :arg path: str, directory for maintenance state
+        :arg quiet_period: float, seconds since the last push before a repo is maintained
+        :arg cpu_budget: float, fraction of one CPU to use
+        :arg max_pass_seconds: float, no new work is started after this long in a pass
+        :arg geometric_factor: int, pack size progression for geometric repacks
+        :arg bundle_store: bundles.BundleStore|None, clone bundles to keep current
+        """
+        self.repo_root = repo_root
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.quiet_period = quiet_period
+        self.cpu_budget = cpu_budget
+        self.max_pass_seconds = max_pass_seconds
+        self.geometric_factor = geometric_factor
+        self.bundle_store = bundle_store
+
+    def _update(self, change=None):
+        """Modify the state under lock
+
+        :arg change: callable|None, passed the state to modify
+        :return: dict, state
+        """
+        with open(os.path.join(self.path, STATE), 'a+') as f_state:
+            fcntl.flock(f_state, fcntl.LOCK_EX)
+            f_state.seek(0)
+            content = f_state.read()
+            try:
+                state = json.loads(content) if content else {}
+            except ValueError as exc:
+                logging.error("Maintenance state corrupt, resetting: %s", exc)
+                state = {}
+            if change is not None:
+                change(state)
+                f_state.seek(0)
+                f_state.truncate()
+                f_state.write(json.dumps(state, sort_keys=True))
+        return state
+
+    def record_push(self, repo, refs):
+        """Note a push so the repo is maintained once it goes quiet
+
+        :arg repo: str, repo path relative to repo_root (eg. group/project.git)
+        :arg refs: int, number of refs updated
+        """
+        def change(state):
+            """Count the push"""
+            entry = state.setdefault(repo, {})
+            entry['pushes'] = entry.get('pushes', 0) + 1
+            entry['refs_updated'] = entry.get('refs_updated', 0) + refs
+            entry['last_push'] = time.time()
+        self._update(change)
+
+    def repos(self):
+        """Repos below repo_root, at the top level or in a project group
+
+        :return: list of str, paths relative to repo_root
+        """
+        return sorted(
+            os.path.relpath(path, self.repo_root)
+            for pattern in ['*.git', os.path.join('*', '*.git')]
+            for path in glob.glob(os.path.join(self.repo_root, pattern))
+            if os.path.isdir(os.path.join(path, 'objects'))
+        )
+
+    def skip_reason(self, repo, entry, now):
+        """Why a repo should not be maintained now
+
+        :arg repo: str, repo path relative to repo_root
+        :arg entry: dict, state for the repo
+        :arg now: float, time.time()
+        :return: str|None, reason or None if due
+        """
+        if 'last_maintenance' in entry and not entry.get('pushes'):
+            if not entry.get('bundle_pushes') or not self.bundle_needed(os.path.join(self.repo_root, repo), 0, {}):
+                return 'unchanged'
+        if now - entry.get('last_push', 0) < self.quiet_period:
+            return 'recent push'
+        # receive-pack quarantines incoming objects until the push completes
+        if glob.glob(os.path.join(self.repo_root, repo, 'objects', 'tmp_objdir-incoming-*')):
+            return 'push in progress'
+        return None
+
+    def run_pass(self, only=None, force=False):
+        """Maintain repos that are due
+
+        :arg only: list of str|None, limit to these repos
+        :arg force: bool, maintain even if unchanged or recently pushed to
+        :return: bool, False if another pass is already running
+        """
+        with open(os.path.join(self.path, RUN_LOCK), 'a') as f_lock:
+            try:
+                fcntl.flock(f_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                logging.warning("Maintenance already running")
+                return False
+            start = time.monotonic()
+            for repo in only or self.repos():
+                if time.monotonic() - start > self.max_pass_seconds:
+                    logging.warning("Maintenance pass time exceeded, remaining repos left for next pass")
+                    break
+                entry = self._update().get(repo, {})
+                reason = None if force else self.skip_reason(repo, entry, time.time())
+                if reason is not None:
+                    logging.debug("Skipping %s: %s", repo, reason)
+                    if reason != 'unchanged':
+                        self._update(lambda state, repo=repo, reason=reason: state.setdefault(repo, {}).update(skipped=reason))
+                    continue
+                self.maintain(repo, entry.get('pushes', 0))
+        return True
+
+    def maintain(self, repo, pushes):
+        """Run the tasks a repo needs
+
+        :arg repo: str, repo path relative to repo_root
+        :arg pushes: int, pushes recorded when the repo was found due
+        """
+        repo_path = os.path.join(self.repo_root, repo)
+        logging.info("Maintaining: %s", repo)
+        results = {}
+        for name, needed, command in [
+                ('pack-refs', self.pack_refs_needed, ['pack-refs', '--all']),
+                ('repack', self.repack_needed, [
+                    'repack', '-d', '--geometric={}'.format(self.geometric_factor),
+                    '--write-midx', '--write-bitmap-index', '--quiet',
+                ]),
+                ('commit-graph', self.commit_graph_needed, ['commit-graph', 'write', '--reachable', '--no-progress']),
+        ]:
+            if not needed(repo_path, pushes, results):
+                continue
+            results[name] = self.run_task(repo_path, command)
+            if results[name]['status'] != 'ok':
+                logging.error("%s failed for %s: %s", name, repo, results[name]['error'])
+        if self.bundle_needed(repo_path, pushes, results):
+            results['bundle'] = self.bundle_store.generate(repo, repo_path, self.run_task)
+            if results['bundle']['status'] == 'failed':
+                logging.error("bundle failed for %s: %s", repo, results['bundle']['error'])
+        def change(state):
+            """Record results, keeping pushes that arrived meanwhile"""
+            entry = state.setdefault(repo, {})
+            entry['pushes'] = max(0, entry.get('pushes', 0) - pushes)
+            # pushes not yet in bundles
+            entry['bundle_pushes'] = entry.get('bundle_pushes', 0) + pushes
+            if results.get('bundle', {}).get('status') in ['ok', 'unchanged']:
+                entry['bundle_pushes'] = 0
+            entry['last_maintenance'] = time.time()
+            entry['packs'] = pack_names(repo_path)
+            entry.pop('skipped', None)
+            entry.setdefault('tasks', {}).update(results)
+        self._update(change)
+
+    def run_task(self, repo_path, command):
+        """Run a git command at low priority, then pause to keep within the CPU budget
+
+        :arg repo_path: str, path to repo
+        :arg command: list, git arguments
+        :return: dict, last_run, seconds, status and error
+        """
+        command = ['git', '--git-dir', repo_path] + command
+        if shutil.which('ionice'):
+            # idle IO class, only gets disk time when nothing else wants it
+            command = ['ionice', '-c', '3'] + command
+        cpu_start = child_cpu()
+        start = time.monotonic()
+        process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=False)
+        seconds = time.monotonic() - start
+        pause = (child_cpu() - cpu_start) / self.cpu_budget - seconds
+        if pause > 0:
+            time.sleep(pause)
+        return {
+            'last_run': time.time(),
+            'seconds': round(seconds, 3),
+            'status': 'ok' if process.returncode == 0 else 'failed',
+            'error': process.stderr.decode('utf-8', 'replace').strip()[-1000:] if process.returncode else None,
+        }
+
+    def pack_refs_needed(self, repo_path, pushes, results):     # pylint: disable=unused-argument
+        """Loose refs exist
+
+        :return: bool
+        """
+        for _, _, files in os.walk(os.path.join(repo_path, 'refs')):
+            if files:
+                return True
+        return False
+
+    def repack_needed(self, repo_path, pushes, results):    # pylint: disable=unused-argument
+        """Loose objects, packs from pushes since the last repack or missing index/bitmaps
+
+        :return: bool
+        """
+        objects = os.path.join(repo_path, 'objects')
+        if any(os.listdir(path) for path in glob.glob(os.path.join(objects, '[0-9a-f][0-9a-f]'))):
+            return True
+        if not glob.glob(os.path.join(objects, 'pack', 'multi-pack-index-*.bitmap')):
+            return bool(pack_names(repo_path))
+        state = self._update()
+        return pack_names(repo_path) != state.get(os.path.relpath(repo_path, self.repo_root), {}).get('packs')
+
+    def commit_graph_needed(self, repo_path, pushes, results):
+        """New commits since the graph was written, or no graph
+
+        :return: bool
+        """
+        if not os.path.exists(os.path.join(repo_path, 'objects', 'info', 'commit-graph')):
+            # empty repos have nothing to graph
+            return bool(pack_names(repo_path)) or 'repack' in results
+        return pushes > 0 or 'repack' in results
+
+    def bundle_needed(self, repo_path, pushes, results):     # pylint: disable=unused-argument
+        """Bundles are configured and enough has been pushed since the last ones
+
+        :return: bool
+        """
+        if self.bundle_store is None:
+            return False
+        repo = os.path.relpath(repo_path, self.repo_root)
+        pushes += self._update().get(repo, {}).get('bundle_pushes', 0)
+        return self.bundle_store.due(repo, pushes, time.time())
+
+    def status(self):
+        """Maintenance status of all repos
+
+        :return: dict, repo: state
+        """
+        state = self._update()
+        return {repo: state.get(repo, {}) for repo in sorted(set(self.repos()) | set(state))}
+
+
+
+def pack_names(repo_path):
+    """Packs in a repo
+
+    :arg repo_path: str
+    :return: list of str
+    """
+    return sorted(os.path.basename(path) for path in glob.glob(os.path.join(repo_path, 'objects', 'pack', 'pack-*.pack')))
+
+
+def child_cpu():
+    """CPU time used by finished child processes
+
+    :return: float, seconds
+    """
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def from_config(config):
+    """Maintainer for the app config
+
+    :arg config: dict, app config
+    :return: Maintainer
+    """
+    maintenance_config = config['maintenance']
+    return Maintainer(
+        config['repo_root'],
+        maintenance_config['path'],
+        maintenance_config.get('quiet_period', 120),
+        maintenance_config.get('cpu_budget', 0.5),
+        maintenance_config.get('max_pass_seconds', 1800),
+        maintenance_config.get('geometric_factor', 2),
+        bundles.from_config(config) if config.get('bundles') else None
+    )
+
+
+def format_time(timestamp):
+    """Short local time for status
+
+    :arg timestamp: float|None
+    :return: str
+    """
+    return time.strftime('%Y-%m-%d %H:%M', time.localtime(timestamp)) if timestamp else '-'
+
+
+def main(argv):
+    """Main entry point
+
+    :arg argv: list, command line arguments
+    """
+    parser = argparse.ArgumentParser(description="git4nginx repo maintenance (config from GIT4NGINX_CONFIG)")
+    parser.add_argument('action', choices=['run', 'service', 'status'], help="one pass, repeated passes or show status")
+    parser.add_argument('--repo', action='append', help="only this repo, relative to repo_root (repeatable)")
+    parser.add_argument('--force', action='store_true', help="maintain even if unchanged or recently pushed to")
+    parser.add_argument('--json', action='store_true', help="status as JSON")
+    args = parser.parse_args(argv[1:])
+    logging.basicConfig(
+        format='%(asctime)s - %(levelname)s %(message)s (%(filename)s:%(lineno)d)',
+        level=getattr(logging, os.environ.get('GIT4NGINX_LOG_LEVEL', 'INFO')),
+    )
+    if 'GIT4NGINX_CONFIG' not in os.environ:
+        sys.exit("Require environment variable to be set: GIT4NGINX_CONFIG")
+    with open(os.environ['GIT4NGINX_CONFIG'], 'rt') as f_config:
+        config = yaml.safe_load(f_config)
+    if not config.get('maintenance'):
+        sys.exit("Maintenance not configured (maintenance: path)")
+    maintainer = from_config(config)
+    if args.action == 'status':
+        status = maintainer.status()
+        if args.json:
+            print(json.dumps(status, indent=4, sort_keys=True))
+            return
+        print("{:<40} {:>7} {:<16} {:<16} {:<16} {}".format('repo', 'pushes', 'last push', 'maintained', 'skipped', 'tasks'))
+        for repo, entry in status.items():
+            print("{:<40} {:>7} {:<16} {:<16} {:<16} {}".format(
+                repo, entry.get('pushes', 0), format_time(entry.get('last_push')),
+                format_time(entry.get('last_maintenance')), entry.get('skipped', '-'),
+                ' '.join('{}:{}'.format(name, task['status']) for name, task in sorted(entry.get('tasks', {}).items()))
+            ))
+        return
+    os.nice(config['maintenance'].get('nice', 10))
+    while True:
+        maintainer.run_pass(args.repo, args.force)
+        if args.action != 'service':
+            return
+        time.sleep(config['maintenance'].get('interval', 300))
+
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,343 @@
+"""Metrics shared across worker processes, exposed in Prometheus text format
+
+git4nginx tools for using git via http(s) with Nginx
+Copyright (C) 2019  Glen Pitt-Pladdy
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+Each process (uWSGI worker, hook) keeps its own counters and histograms in
+memory and writes them to its own file in the metrics directory after each
+request, so there is no locking between processes. A scrape sums the files
+of all processes. Files of processes that have exited are folded into a
+single archive file on scrape so counters never go backwards. Gauges take
+the highest value of all processes (eg. the most recent config load).
+"""
+
+import os
+import json
+import time
+import fcntl
+import logging
+import threading
+import contextlib
+
+
+# seconds, suits anything from a cached config load to a large clone
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+PREFIX = 'git4nginx_'
+ARCHIVE = 'archive.json'
+# name: type, help
+METRICS = {
+    'phase_seconds': ('histogram', "Time spent in each phase of handling a request"),
+    'hook_plugin_seconds': ('histogram', "Time spent running each hook plugin"),
+    'requests_total': ('counter', "Requests by service and status code"),
+    'bytes_in_total': ('counter', "Request body bytes passed to git by service"),
+    'bytes_out_total': ('counter', "Response body bytes from git by service"),
+    'replica_reads_total': ('counter', "Fetches by the replica (or primary) served from"),
+    'config_reloads_total': ('counter', "Configuration loads by workers, initial and on change"),
+    'config_errors_total': ('counter', "Configuration loads that failed, last good configuration kept"),
+    'config_loaded_timestamp_seconds': ('gauge', "Time the most recently loaded configuration was loaded"),
+}
+
+
+
+def metric_key(name, labels):
+    """Hashable key for a metric with labels
+
+    :arg name: str, metric name
+    :arg labels: dict, label name: value
+    :return: tuple
+    """
+    return (name, ) + tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+
+
+class Metrics(object):
+    """Metrics for this process, saved to and collected from a shared directory
+    """
+    def __init__(self, path):
+        """Setup
+
+        :arg path: str, directory shared by all processes
+        """
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self._lock = threading.Lock()
+        self._pid = None
+        self._file = None
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    def _check_process(self):
+        """Start afresh in a new (forked) process - values belong to the parent
+        """
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._file = os.path.join(self.path, '{}_{}.json'.format(self._pid, time.time_ns()))
+            self.counters = {}
+            self.histograms = {}
+            self.gauges = {}
+
+    def inc(self, name, value=1, **labels):
+        """Add to a counter
+
+        :arg name: str, metric name (see METRICS)
+        :arg value: int|float, amount to add
+        :arg labels: str, label values
+        """
+        key = metric_key(name, labels)
+        with self._lock:
+            self._check_process()
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """Set a gauge, the highest value of all processes is reported
+
+        :arg name: str, metric name (see METRICS)
+        :arg value: int|float, eg. timestamp
+        :arg labels: str, label values
+        """
+        key = metric_key(name, labels)
+        with self._lock:
+            self._check_process()
+            self.gauges[key] = value
+
+    def observe(self, name, value, **labels):
+        """Record a value in a histogram
+
+        :arg name: str, metric name (see METRICS)
+        :arg value: float, eg. seconds
+        :arg labels: str, label values
+        """
+        key = metric_key(name, labels)
+        with self._lock:
+            self._check_process()
+            # bucket counts (not cumulative), then sum, count
+            histogram = self.histograms.setdefault(key, [0] * (len(BUCKETS) + 2))
+            for index, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    histogram[index] += 1
+                    break
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    @contextlib.contextmanager
+    def time(self, name, **labels):
+        """Context recording how long it takes in a histogram
+
+        :arg name: str, metric name (see METRICS)
+        :arg labels: str, label values
+        """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start, **labels)
+
+    def flush(self):
+        """Save values for this process where a scrape will find them
+        """
+        with self._lock:
+            self._check_process()
+            content = dump_values(self.counters, self.histograms, self.gauges)
+        temp_path = self._file + '.tmp'
+        try:
+            with open(temp_path, 'wt') as f_metrics:
+                f_metrics.write(content)
+            os.rename(temp_path, self._file)
+        except OSError as exc:
+            logging.error("Unable to save metrics: %s", exc)
+
+    def collect(self):
+        """Sum values from all processes, archiving those of exited processes
+
+        :return: tuple of dicts (key: value) counters, histograms, gauges
+        """
+        with open(os.path.join(self.path, 'lock'), 'a') as f_lock:
+            fcntl.flock(f_lock, fcntl.LOCK_EX)
+            archive_path = os.path.join(self.path, ARCHIVE)
+            archive = load_values(archive_path) or ({}, {}, {})
+            live = ({}, {}, {})
+            exited = []
+            for name in sorted(os.listdir(self.path)):
+                if not name.endswith('.json') or name == ARCHIVE:
+                    continue
+                path = os.path.join(self.path, name)
+                values = load_values(path)
+                if values is None:
+                    continue
+                if pid_alive(int(name.split('_', 1)[0])):
+                    merge_values(live, values)
+                else:
+                    merge_values(archive, values)
+                    exited.append(path)
+            if exited:
+                with open(archive_path + '.tmp', 'wt') as f_archive:
+                    f_archive.write(dump_values(*archive))
+                os.rename(archive_path + '.tmp', archive_path)
+                for path in exited:
+                    os.unlink(path)
+        merge_values(live, archive)
+        return live
+
+    def render(self, extra_counters=None):
+        """Prometheus text exposition of all processes
+
+        :arg extra_counters: dict|None, name: (help, value) counters from elsewhere (eg. pack cache)
+        :return: str
+        """
+        counters, histograms, gauges = self.collect()
+        lines = []
+        for name, (metric_type, description) in sorted(METRICS.items()):
+            lines.append('# HELP {}{} {}'.format(PREFIX, name, description))
+            lines.append('# TYPE {}{} {}'.format(PREFIX, name, metric_type))
+            if metric_type in ['counter', 'gauge']:
+                values = counters if metric_type == 'counter' else gauges
+                for key in sorted(key for key in values if key[0] == name):
+                    lines.append('{}{}{} {}'.format(PREFIX, name, format_labels(key[1:]), format_value(values[key])))
+                continue
+            for key in sorted(key for key in histograms if key[0] == name):
+                histogram = histograms[key]
+                cumulative = 0
+                for bound, count in zip(BUCKETS, histogram):
+                    cumulative += count
+                    lines.append('{}{}_bucket{} {}'.format(PREFIX, name, format_labels(key[1:] + (('le', str(bound)), )), cumulative))
+                lines.append('{}{}_bucket{} {}'.format(PREFIX, name, format_labels(key[1:] + (('le', '+Inf'), )), histogram[-1]))
+                lines.append('{}{}_sum{} {}'.format(PREFIX, name, format_labels(key[1:]), format_value(histogram[-2])))
+                lines.append('{}{}_count{} {}'.format(PREFIX, name, format_labels(key[1:]), histogram[-1]))
+        for name, (description, value) in sorted((extra_counters or {}).items()):
+            lines.append('# HELP {}{} {}'.format(PREFIX, name, description))
+            lines.append('# TYPE {}{} counter'.format(PREFIX, name))
+            lines.append('{}{} {}'.format(PREFIX, name, format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+
+class NullMetrics(object):
+    """Stand-in when metrics are not configured, records nothing
+    """
+    def inc(self, name, value=1, **labels):
+        """Ignore counter"""
+
+    def set(self, name, value, **labels):
+        """Ignore gauge"""
+
+    def observe(self, name, value, **labels):
+        """Ignore value"""
+
+    @contextlib.contextmanager
+    def time(self, name, **labels):
+        """Run context untimed"""
+        yield
+
+    def flush(self):
+        """Nothing to save"""
+
+
+NULL_METRICS = NullMetrics()
+
+
+
+def dump_values(counters, histograms, gauges):
+    """Serialise values for a metrics file
+
+    :arg counters: dict, key: value
+    :arg histograms: dict, key: list of bucket counts, sum, count
+    :arg gauges: dict, key: value
+    :return: str
+    """
+    return json.dumps({
+        'counters': [[list(key), value] for key, value in counters.items()],
+        'histograms': [[list(key), value] for key, value in histograms.items()],
+        'gauges': [[list(key), value] for key, value in gauges.items()],
+    })
+
+
+def load_values(path):
+    """Read values from a metrics file
+
+    :arg path: str
+    :return: tuple of dicts counters, histograms, gauges or None if the file could not be read
+    """
+    try:
+        with open(path, 'rt') as f_metrics:
+            content = json.loads(f_metrics.read())
+    except FileNotFoundError:
+        return None
+    except ValueError as exc:
+        logging.error("Unable to read metrics %s: %s", path, exc)
+        return None
+    return tuple(
+        # gauges are missing from files written before they were added
+        {tuple(key[:1] + [tuple(label) for label in key[1:]]): value for key, value in content.get(kind, [])}
+        for kind in ['counters', 'histograms', 'gauges']
+    )
+
+
+def merge_values(totals, values):
+    """Add values into totals, gauges take the highest
+
+    :arg totals: tuple of dicts counters, histograms, gauges to add to
+    :arg values: tuple of dicts counters, histograms, gauges
+    """
+    for key, value in values[0].items():
+        totals[0][key] = totals[0].get(key, 0) + value
+    for key, value in values[1].items():
+        if key in totals[1]:
+            totals[1][key] = [total + add for total, add in zip(totals[1][key], value)]
+        else:
+            totals[1][key] = list(value)
+    for key, value in values[2].items():
+        totals[2][key] = max(totals[2].get(key, value), value)
+
+
+def pid_alive(pid):
+    """Check if a process is still running
+
+    :arg pid: int
+    :return: bool
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # exists, but not ours
+        return True
+    return True
+
+
+def format_labels(labels):
+    """Prometheus label set
+
+    :arg labels: iterable of (name, value)
+    :return: str, eg. {code="200",service="git-upload-pack"} or empty
+    """
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(name, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels
+    ) + '}'
+
+
+def format_value(value):
+    """Prometheus sample value
+
+    :arg value: int|float
+    :return: str
+    """
+    return repr(float(value)) if isinstance(value, float) else str(value)
@@ -0,0 +1,452 @@
+"""Content-addressed cache of upload-pack responses
+
+git4nginx tools for using git via http(s) with Nginx
+Copyright (C) 2019  Glen Pitt-Pladdy
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+Responses are keyed on the repo, the ref state and a normalized form of the
+request (want/have/capability lines) so identical fetches (eg. many CI
+runners cloning the same commit) are served from local disk rather than
+running pack-objects again. Only final negotiation rounds (with "done"),
+which carry the pack, are cached.
+
+Optionally concurrent identical requests are coalesced (single-flight): the
+first process to start a response (the leader) publishes its cache file
+under flight/ while holding a lock on it, and other processes (followers)
+stream the file as it grows rather than running git-http-backend.
+"""
+
+import os
+import re
+import json
+import zlib
+import time
+import fcntl
+import hashlib
+import logging
+import tempfile
+
+
+# capabilities that don't affect the response
+IGNORE_CAPABILITIES = ('agent=', 'session-id=')
+STATS = ['hits', 'misses', 'coalesced', 'stores', 'evictions', 'bytes_saved', 'bytes_stored']
+CHUNK_SIZE = 65536
+# leader marks its file readable when the response is complete
+COMPLETE_MODE = 0o644
+
+
+
+def parse_pkt_lines(data):
+    """Split request data into pkt-lines, dropping special packets
+
+    :arg data: bytes, request body
+    :return: list of str, payloads with trailing newline removed
+    :raises ValueError: on malformed data
+    """
+    lines = []
+    offset = 0
+    while offset < len(data):
+        header = data[offset:offset + 4]
+        if not re.match(rb'^[0-9a-f]{4}$', header):
+            raise ValueError("Malformed pkt-line")
+        length = int(header, 16)
+        if length < 4:
+            offset += 4
+            continue
+        if offset + length > len(data):
+            raise ValueError("Truncated pkt-line")
+        lines.append(data[offset + 4:offset + length].decode('utf-8').rstrip('\n'))
+        offset += length
+    return lines
+
+
+def request_key(repo_path, protocol, body, fingerprint, content_encoding=None):
+    """Calculate cache key for an upload-pack request
+
+    :arg repo_path: str, path to repo
+    :arg protocol: str, git protocol requested (Git-Protocol header)
+    :arg body: bytes, request body
+    :arg fingerprint: str, identifies the ref state of the repo
+    :arg content_encoding: str|None, Content-Encoding of body
+    :return: str|None, key or None if the request can't be cached
+    """
+    if content_encoding == 'gzip':
+        try:
+            body = zlib.decompress(body, 31)
+        except zlib.error:
+            return None
+    elif content_encoding:
+        return None
+    try:
+        lines = parse_pkt_lines(body)
+    except (ValueError, UnicodeDecodeError):
+        return None
+    if 'version=2' in protocol.split(':'):
+        if not lines or lines[0] != 'command=fetch' or 'done' not in lines:
+            return None
+    elif 'done' not in lines:
+        # negotiation only, no pack
+        return None
+    normalized = []
+    for line in lines:
+        if line.startswith('want ') and ' ' in line[5:]:
+            # protocol v0 capabilities on first want
+            line, capabilities = line[:45], line[46:].split(' ')
+            normalized += ['capability ' + capability for capability in capabilities]
+        normalized.append(line)
+    normalized = sorted(set(line for line in normalized if not line.split(' ')[-1].startswith(IGNORE_CAPABILITIES)))
+    digest = hashlib.sha256()
+    for item in [os.path.realpath(repo_path), protocol, fingerprint] + normalized:
+        digest.update(item.encode('utf-8') + b'\n')
+    return digest.hexdigest()
+
+
+
+class PackCacheWriter(object):
+    """Store a response in the cache as it is streamed to the client
+    """
+    def __init__(self, pack_cache, key, fingerprint, flight=False):
+        """Setup
+
+        :arg pack_cache: PackCache
+        :arg key: str, cache key
+        :arg fingerprint: str, ref state the response is built from
+        :arg flight: bool, lead a flight so concurrent requests can follow
+        :raises FileExistsError: if flight and another process is already leading
+        """
+        self.pack_cache = pack_cache
+        self.key = key
+        self.fingerprint = fingerprint
+        self.size = 0
+        self.started = False
+        self.flight_path = None
+        self._file = None
+        if flight:
+            self._open()
+            # locked before it is visible so followers can tell when we finish
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+            try:
+                os.link(self._file.name, pack_cache.flight_path(key))
+            except FileExistsError:
+                self._file.close()
+                os.unlink(self._file.name)
+                self._file = None
+                raise
+            self.flight_path = pack_cache.flight_path(key)
+
+    def _open(self):
+        """Create the (unbuffered so followers see it promptly) cache file
+        """
+        self._file = tempfile.NamedTemporaryFile(dir=self.pack_cache.tmp_path, prefix=self.key, delete=False, buffering=0)
+
+    def start(self, status_code, headers):
+        """Response header is known - start the cache file
+
+        :arg status_code: int, HTTP status
+        :arg headers: list of [name, value]
+        """
+        if status_code != 200:
+            return
+        if self._file is None:
+            self._open()
+        metadata = {
+            'status': status_code,
+            'headers': headers,
+            'fingerprint': self.fingerprint,
+            'created': time.time(),
+        }
+        self._file.write(json.dumps(metadata).encode('utf-8') + b'\n')
+        self.started = True
+
+    def write(self, data):
+        """Add response data
+
+        :arg data: bytes
+        """
+        if self.started:
+            self._file.write(data)
+            self.size += len(data)
+
+    def finish(self, success):
+        """Response complete - keep or discard the cache file
+
+        :arg success: bool, True if the complete response was produced without error
+        """
+        if self._file is None:
+            return
+        stored = False
+        try:
+            if success and self.started:
+                os.fchmod(self._file.fileno(), COMPLETE_MODE)
+                path = self.pack_cache.entry_path(self.key)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.rename(self._file.name, path)
+                stored = True
+            else:
+                os.unlink(self._file.name)
+        finally:
+            if self.flight_path is not None:
+                os.unlink(self.flight_path)
+            # releases flight lock
+            self._file.close()
+            self._file = None
+        if stored:
+            logging.info("Pack cache stored %d bytes: %s", self.size, self.key)
+            self.pack_cache.count(stores=1, bytes_stored=self.size)
+            self.pack_cache.evict()
+
+
+
+class PackCacheFollower(object):
+    """Stream a response as it is written by the leader of a flight
+    """
+    def __init__(self, pack_cache, key):
+        """Setup
+
+        :arg pack_cache: PackCache
+        :arg key: str, cache key
+        :raises FileNotFoundError: if there is no flight (eg. just finished)
+        """
+        self.path = pack_cache.flight_path(key)
+        self._file = open(self.path, 'rb', buffering=0)
+        self._pending = b''
+        self.size = 0
+
+    def _leader_finished(self):
+        """Check if the leader has released the flight lock
+
+        :return: bool
+        """
+        try:
+            fcntl.flock(self._file, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        fcntl.flock(self._file, fcntl.LOCK_UN)
+        return True
+
+    def _read(self):
+        """Wait for more data from the leader
+
+        :return: bytes, empty once the response is complete
+        :raises RuntimeError: if the leader failed
+        """
+        delay = 0.005
+        while True:
+            finished = self._leader_finished()
+            data = self._file.read(CHUNK_SIZE)
+            if data:
+                return data
+            if finished:
+                break
+            time.sleep(delay)
+            delay = min(delay * 2, 0.1)
+        stat = os.fstat(self._file.fileno())
+        if stat.st_mode & 0o777 == COMPLETE_MODE:
+            return b''
+        # leader failed (or died) - remove its flight if still there so it can be retried
+        try:
+            if os.stat(self.path).st_ino == stat.st_ino:
+                os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        raise RuntimeError("Leader failed to produce response")
+
+    def metadata(self):
+        """Wait for the response header
+
+        :return: dict|None, metadata as stored in the cache or None if the leader failed first
+        """
+        try:
+            while b'\n' not in self._pending:
+                data = self._read()
+                if not data:
+                    # complete but no header: not a cacheable response
+                    return None
+                self._pending += data
+        except RuntimeError:
+            return None
+        line, self._pending = self._pending.split(b'\n', 1)
+        return json.loads(line.decode('utf-8'))
+
+    def iter_body(self):
+        """Response body as produced by the leader
+
+        :raises RuntimeError: if the leader fails part way
+        """
+        data = self._pending or self._read()
+        self._pending = b''
+        while data:
+            self.size += len(data)
+            yield data
+            data = self._read()
+
+    def close(self):
+        """Finished following
+        """
+        self._file.close()
+
+
+
+class PackCache(object):
+    """Size bounded LRU cache of upload-pack responses on local disk
+
+    Shared between workers - entries are written to a temporary file and
+    renamed into place, and hit/miss/bytes-saved counters are kept in a
+    locked stats file.
+    """
+    def __init__(self, path, max_bytes, max_request=1048576):
+        """Setup
+
+        :arg path: str, cache directory
+        :arg max_bytes: int, maximum size of cached responses
+        :arg max_request: int, largest request body considered for caching
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_request = max_request
+        self.tmp_path = os.path.join(path, 'tmp')
+        self.flights_path = os.path.join(path, 'flight')
+        self.stats_path = os.path.join(path, 'stats.json')
+        os.makedirs(self.tmp_path, exist_ok=True)
+        os.makedirs(self.flights_path, exist_ok=True)
+
+    def entry_path(self, key):
+        """Path of cache entry
+
+        :arg key: str, cache key
+        :return: str
+        """
+        return os.path.join(self.path, key[:2], key)
+
+    def flight_path(self, key):
+        """Path of response in progress
+
+        :arg key: str, cache key
+        :return: str
+        """
+        return os.path.join(self.flights_path, key)
+
+    def open(self, key, fingerprint):
+        """Open a cache entry if available
+
+        :arg key: str, cache key
+        :arg fingerprint: str, current ref state of the repo
+        :return: tuple of metadata (dict), file positioned at start of body, or None
+        """
+        path = self.entry_path(key)
+        try:
+            f_entry = open(path, 'rb')
+        except FileNotFoundError:
+            return None
+        metadata = json.loads(f_entry.readline().decode('utf-8'))
+        if metadata['fingerprint'] != fingerprint:
+            # built from different refs
+            f_entry.close()
+            os.unlink(path)
+            return None
+        # mark recently used
+        os.utime(path)
+        return metadata, f_entry
+
+    def writer(self, key, fingerprint, flight=False):
+        """Get a writer to store a response
+
+        :arg key: str, cache key
+        :arg fingerprint: str, ref state the response is built from
+        :arg flight: bool, lead a flight so concurrent requests can follow
+        :return: PackCacheWriter
+        :raises FileExistsError: if flight and another process is already leading
+        """
+        return PackCacheWriter(self, key, fingerprint, flight)
+
+    def follow(self, key):
+        """Follow the flight in progress for a key
+
+        :arg key: str, cache key
+        :return: PackCacheFollower|None, None if there is no flight
+        """
+        try:
+            return PackCacheFollower(self, key)
+        except FileNotFoundError:
+            return None
+
+    def evict(self):
+        """Remove least recently used entries until within max_bytes
+        """
+        entries = []
+        total = 0
+        for prefix in os.scandir(self.path):
+            if not prefix.is_dir() or len(prefix.name) != 2:
+                continue
+            for entry in os.scandir(prefix.path):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+        entries.sort()
+        evictions = 0
+        while total > self.max_bytes and entries:
+            _, size, path = entries.pop(0)
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                continue
+            total -= size
+            evictions += 1
+        if evictions:
+            logging.info("Pack cache evicted %d entries", evictions)
+            self.count(evictions=evictions)
+
+    def count(self, **increments):
+        """Add to shared counters
+
+        :arg increments: int, amount to add to each named counter
+        """
+        with open(self.stats_path, 'a+') as f_stats:
+            fcntl.flock(f_stats, fcntl.LOCK_EX)
+            f_stats.seek(0)
+            content = f_stats.read()
+            stats = json.loads(content) if content else {}
+            for name, value in increments.items():
+                stats[name] = stats.get(name, 0) + value
+            f_stats.seek(0)
+            f_stats.truncate()
+            f_stats.write(json.dumps(stats))
+
+    def stats(self):
+        """Current counters
+
+        :return: dict, counter name: value
+        """
+        try:
+            with open(self.stats_path, 'rt') as f_stats:
+                fcntl.flock(f_stats, fcntl.LOCK_SH)
+                content = f_stats.read()
+        except FileNotFoundError:
+            content = ''
+        stats = json.loads(content) if content else {}
+        return {name: stats.get(name, 0) for name in STATS}
+
+
+
+if __name__ == '__main__':
+    import sys
+    import argparse
+    parser = argparse.ArgumentParser(description="Show pack cache counters")
+    parser.add_argument('path', help="Cache directory (pack_cache: path in config)")
+    args = parser.parse_args()
+    if not os.path.isdir(args.path):
+        sys.exit("Not a directory: {}".format(args.path))
+    print(json.dumps(PackCache(args.path, 0).stats(), indent=4))
@@ -0,0 +1,391 @@
+#!/usr/bin/env python3
+"""Push replication to replica repo roots and read routing
+
+git4nginx tools for using git via http(s) with Nginx
+Copyright (C) 2019  Glen Pitt-Pladdy
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+repo_root is the primary. After each push (post-receive plugin replicate)
+a background process mirrors the repo (git push --mirror) to every replica
+so the push doesn't wait on replicas, either a local
+repo root (eg. another disk or an NFS export from another host) or the URL
+of another git4nginx node. Each push bumps the repo generation and each
+replica records the generation it holds, so lag is known per replica and
+failed replicas are caught up with:
+    GIT4NGINX_CONFIG=/path/to/config.yaml replication.py sync
+    GIT4NGINX_CONFIG=/path/to/config.yaml replication.py status
+
+Fetches and clones are served from a healthy local replica root whose refs
+are the same as the primary, else from the primary. Users who pushed to a
+repo within read_your_writes seconds always read it from the primary.
+"""
+
+import os
+import sys
+import json
+import time
+import zlib
+import fcntl
+import logging
+import argparse
+import subprocess
+import yaml
+
+
+STATE = 'state.json'
+LOCK = 'state.lock'
+# per repo locks so background runs for one repo take turns
+REPO_LOCKS = 'locks'
+
+
+
+class Replicator(object):
+    """Replication state and routing for replicas of repo_root
+    """
+    def __init__(self, repo_root, path, replicas, read_your_writes=300, unhealthy_after=3, timeout=300):
+        """Setup
+
+        :arg repo_root: str, primary repos
+        :arg path: str, directory for replication state
+        :arg replicas: list of dict, name and repo_root (local) or url (remote node)
+        :arg read_your_writes: float, seconds a pushing user reads the repo from the primary
+        :arg unhealthy_after: int, consecutive failures before a replica is not read from
+        :arg timeout: float, seconds allowed to mirror a repo to a replica
+        """
+        self.repo_root = repo_root
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.replicas = replicas
+        self.read_your_writes = read_your_writes
+        self.unhealthy_after = unhealthy_after
+        self.timeout = timeout
+        # (state file signature, state) for lock-free reads when routing
+        self._state = (None, {})
+
+    def _update(self, change):
+        """Modify the state under lock, replacing the file so readers don't need the lock
+
+        :arg change: callable, passed the state to modify
+        :return: dict, state
+        """
+        with open(os.path.join(self.path, LOCK), 'a') as f_lock:
+            fcntl.flock(f_lock, fcntl.LOCK_EX)
+            state = self._read()
+            change(state)
+            with open(os.path.join(self.path, STATE + '.tmp'), 'wt') as f_state:
+                f_state.write(json.dumps(state, sort_keys=True))
+            os.rename(os.path.join(self.path, STATE + '.tmp'), os.path.join(self.path, STATE))
+        return state
+
+    def _read(self):
+        """Current state, reread only when the file has been replaced
+
+        :return: dict
+        """
+        path = os.path.join(self.path, STATE)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return {'repos': {}, 'replicas': {}}
+        signature = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if self._state[0] != signature:
+            with open(path, 'rt') as f_state:
+                try:
+                    self._state = (signature, json.load(f_state))
+                except ValueError as exc:
+                    logging.error("Replication state corrupt, resetting: %s", exc)
+                    self._state = (signature, {'repos': {}, 'replicas': {}})
+        # copy so callers changing it don't change the cache
+        return json.loads(json.dumps(self._state[1]))
+
+    def state(self):
+        """Replication state (not to be modified)
+
+        :return: dict
+        """
+        self._read()
+        return self._state[1]
+
+    def record_push(self, repo, user):
+        """Note a push, the primary now has a new generation of the repo
+
+        :arg repo: str, repo path relative to repo_root (eg. group/project.git)
+        :arg user: str, who pushed
+        """
+        now = time.time()
+        def change(state):
+            """Bump the generation and remember the user"""
+            entry = state['repos'].setdefault(repo, {})
+            entry['generation'] = entry.get('generation', 0) + 1
+            entry['pushed'] = now
+            entry['users'] = {
+                name: pushed for name, pushed in entry.get('users', {}).items()
+                if now - pushed < self.read_your_writes
+            }
+            entry['users'][user] = now
+        self._update(change)
+
+    def target(self, replica, repo):
+        """Where a replica keeps a repo
+
+        :arg replica: dict, replica config
+        :arg repo: str, repo path relative to repo_root
+        :return: str, path or URL
+        """
+        if 'repo_root' in replica:
+            return os.path.join(replica['repo_root'], repo)
+        return replica['url'].rstrip('/') + '/' + repo
+
+    def replicate(self, repo, only=None):
+        """Mirror a repo to replicas
+
+        :arg repo: str, repo path relative to repo_root
+        :arg only: list of str|None, limit to these replica names
+        :return: dict, replica name: True if mirrored
+        """
+        generation = self._read()['repos'].get(repo, {}).get('generation', 0)
+        primary = os.path.join(self.repo_root, repo)
+        results = {}
+        for replica in self.replicas:
+            if only is not None and replica['name'] not in only:
+                continue
+            target = self.target(replica, repo)
+            start = time.monotonic()
+            error = None
+            try:
+                if 'repo_root' in replica and not os.path.isdir(target):
+                    subprocess.run(['git', 'init', '--quiet', '--bare', target], check=True, stderr=subprocess.PIPE, timeout=self.timeout)
+                subprocess.run(
+                    ['git', '--git-dir', primary, 'push', '--quiet', '--mirror', target],
+                    check=True, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=self.timeout
+                )
+            except subprocess.CalledProcessError as exc:
+                error = exc.stderr.decode('utf-8', 'replace').strip()[-1000:]
+            except (subprocess.TimeoutExpired, OSError) as exc:
+                error = str(exc)
+            seconds = time.monotonic() - start
+            if error is None:
+                logging.info("Replicated %s to %s in %.3fs", repo, replica['name'], seconds)
+            else:
+                logging.error("Replicating %s to %s failed: %s", repo, replica['name'], error)
+            results[replica['name']] = error is None
+            def change(state, name=replica['name'], error=error):
+                """Record the outcome"""
+                entry = state['replicas'].setdefault(name, {})
+                if error is None:
+                    entry['failures'] = 0
+                    entry['last_success'] = time.time()
+                    repo_entry = entry.setdefault('repos', {}).setdefault(repo, {})
+                    # pushes may have arrived meanwhile, they are caught up later
+                    repo_entry['generation'] = max(repo_entry.get('generation', 0), generation)
+                    repo_entry['replicated'] = time.time()
+                else:
+                    entry['failures'] = entry.get('failures', 0) + 1
+                    entry['last_error'] = error
+                    entry['last_failure'] = time.time()
+            self._update(change)
+        return results
+
+    def replicate_queued(self, repo):
+        """Mirror a repo to replicas behind on it, waiting for any other run for the repo
+
+        Pushes arriving while a run is in progress are picked up by the next run.
+
+        :arg repo: str, repo path relative to repo_root
+        :return: dict, replica name: True if mirrored
+        """
+        os.makedirs(os.path.join(self.path, REPO_LOCKS), exist_ok=True)
+        lock_path = os.path.join(self.path, REPO_LOCKS, '{:08x}.lock'.format(zlib.crc32(repo.encode('utf-8'))))
+        with open(lock_path, 'a') as f_lock:
+            fcntl.flock(f_lock, fcntl.LOCK_EX)
+            behind = [replica['name'] for replica in self.replicas if repo in self.behind(replica['name'])]
+            if not behind:
+                logging.info("Replicas already have %s", repo)
+                return {}
+            return self.replicate(repo, behind)
+
+    def behind(self, name):
+        """Repos a replica does not have the latest generation of
+
+        :arg name: str, replica name
+        :return: dict, repo: time of the push not yet replicated
+        """
+        state = self._read()
+        replica_repos = state['replicas'].get(name, {}).get('repos', {})
+        return {
+            repo: entry.get('pushed', 0)
+            for repo, entry in state['repos'].items()
+            if replica_repos.get(repo, {}).get('generation', 0) < entry.get('generation', 0)
+        }
+
+    def sync(self):
+        """Catch up all replicas on repos they are behind with
+        """
+        for replica in self.replicas:
+            for repo in sorted(self.behind(replica['name'])):
+                if os.path.isdir(os.path.join(self.repo_root, repo)):
+                    self.replicate(repo, [replica['name']])
+
+    def healthy(self, name):
+        """Replica has not been failing
+
+        :arg name: str, replica name
+        :return: bool
+        """
+        return self.state()['replicas'].get(name, {}).get('failures', 0) < self.unhealthy_after
+
+    def status(self):
+        """Health and lag of each replica
+
+        :return: dict, replica name: status
+        """
+        now = time.time()
+        state = self._read()
+        status = {}
+        for replica in self.replicas:
+            entry = state['replicas'].get(replica['name'], {})
+            behind = self.behind(replica['name'])
+            status[replica['name']] = {
+                'target': replica.get('repo_root', replica.get('url')),
+                'healthy': entry.get('failures', 0) < self.unhealthy_after,
+                'failures': entry.get('failures', 0),
+                'last_success': entry.get('last_success'),
+                'last_error': entry.get('last_error'),
+                'repos_behind': len(behind),
+                'lag_seconds': round(now - min(behind.values()), 3) if behind else 0,
+            }
+        return status
+
+    def read_replica(self, repo, user, fingerprint):
+        """Replica to serve a fetch from
+
+        :arg repo: str, repo path relative to repo_root
+        :arg user: str, user fetching
+        :arg fingerprint: callable, ref state of a repo path, for comparing with the primary
+        :return: tuple (name, repo root)|None, None to use the primary
+        """
+        state = self.state()
+        pushed = state['repos'].get(repo, {}).get('users', {}).get(user)
+        if pushed is not None and time.time() - pushed < self.read_your_writes:
+            return None
+        candidates = [
+            replica for replica in self.replicas
+            if 'repo_root' in replica and self.healthy(replica['name'])
+            and os.path.isdir(os.path.join(replica['repo_root'], repo))
+        ]
+        if not candidates:
+            return None
+        primary = fingerprint(os.path.join(self.repo_root, repo))
+        candidates = [
+            replica for replica in candidates
+            if fingerprint(os.path.join(replica['repo_root'], repo)) == primary
+        ]
+        if not candidates:
+            return None
+        # the same replica for each user and repo, so a fetch is served from one place
+        replica = candidates[zlib.crc32('{} {}'.format(user, repo).encode('utf-8')) % len(candidates)]
+        return replica['name'], replica['repo_root']
+
+
+
+def from_config(config):
+    """Replicator for the app config
+
+    :arg config: dict, app config
+    :return: Replicator
+    """
+    replication_config = config['replication']
+    return Replicator(
+        config['repo_root'],
+        replication_config['path'],
+        replication_config['replicas'],
+        replication_config.get('read_your_writes', 300),
+        replication_config.get('unhealthy_after', 3),
+        replication_config.get('timeout', 300)
+    )
+
+
+def start_replicate(repo):
+    """Replicate a repo in a background process (replication.py replicate)
+
+    Nothing is inherited that git waits on, so the push completes without
+    waiting for replicas. Config is from GIT4NGINX_CONFIG in the environment.
+
+    :arg repo: str, repo path relative to repo_root
+    """
+    # GIT_DIR etc. of the hook would redirect the git commands run
+    environ = {name: value for name, value in os.environ.items() if not name.startswith('GIT_')}
+    subprocess.Popen(   # pylint: disable=consider-using-with
+        [sys.executable, os.path.realpath(__file__), 'replicate', repo],
+        stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        cwd='/', env=environ, start_new_session=True
+    )
+
+
+def format_time(timestamp):
+    """Short local time for status
+
+    :arg timestamp: float|None
+    :return: str
+    """
+    return time.strftime('%Y-%m-%d %H:%M', time.localtime(timestamp)) if timestamp else '-'
+
+
+def main(argv):
+    """Main entry point
+
+    :arg argv: list, command line arguments
+    """
+    parser = argparse.ArgumentParser(description="git4nginx replication (config from GIT4NGINX_CONFIG)")
+    parser.add_argument('action', choices=['sync', 'status', 'replicate'], help="catch up replicas, show status or replicate one repo")
+    parser.add_argument('repo', nargs='?', help="repo to replicate (eg. group/project.git)")
+    parser.add_argument('--json', action='store_true', help="status as JSON")
+    args = parser.parse_args(argv[1:])
+    logging.basicConfig(
+        format='%(asctime)s - %(levelname)s %(message)s (%(filename)s:%(lineno)d)',
+        level=getattr(logging, os.environ.get('GIT4NGINX_LOG_LEVEL', 'INFO')),
+    )
+    if 'GIT4NGINX_CONFIG' not in os.environ:
+        sys.exit("Require environment variable to be set: GIT4NGINX_CONFIG")
+    with open(os.environ['GIT4NGINX_CONFIG'], 'rt') as f_config:
+        config = yaml.safe_load(f_config)
+    if not config.get('replication'):
+        sys.exit("Replication not configured (replication: path, replicas)")
+    replicator = from_config(config)
+    if args.action == 'replicate':
+        if not args.repo:
+            sys.exit("Require repo to replicate")
+        replicator.replicate_queued(args.repo)
+        return
+    if args.action == 'sync':
+        replicator.sync()
+        return
+    status = replicator.status()
+    if args.json:
+        print(json.dumps(status, indent=4, sort_keys=True))
+        return
+    print("{:<16} {:<8} {:>8} {:>12} {:>10} {:<16} {}".format('replica', 'healthy', 'failures', 'repos behind', 'lag', 'last success', 'last error'))
+    for name, entry in status.items():
+        print("{:<16} {:<8} {:>8} {:>12} {:>10} {:<16} {}".format(
+            name, 'yes' if entry['healthy'] else 'no', entry['failures'], entry['repos_behind'],
+            '{:.0f}s'.format(entry['lag_seconds']), format_time(entry['last_success']),
+            (entry['last_error'] or '-').splitlines()[-1] if entry['last_error'] else '-'
+        ))
+
+
+
+if __name__ == '__main__':
+    main(sys.argv)
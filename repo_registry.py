@@ -0,0 +1,306 @@
+"""Registry of repos below repo_root for routing and listing
+
+git4nginx tools for using git via http(s) with Nginx
+Copyright (C) 2019  Glen Pitt-Pladdy
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+Repos (directories ending .git at the top level of repo_root or in a
+project group directory) are found with one scan, then kept current from
+inotify events so requests don't need to stat the repo (slow on NFS).
+Events are read without blocking when the registry is used, so no thread
+is needed (uWSGI workers may not have threads). inotify does not see
+changes made on other NFS clients, so the registry is also rescanned
+every rescan_interval, and a repo not in the registry is checked on disk
+before it is reported missing.
+"""
+
+import os
+import time
+import errno
+import bisect
+import ctypes
+import struct
+import logging
+import threading
+
+
+# see inotify(7)
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+EVENT = struct.Struct('iIII')
+
+
+
+class Inotify(object):
+    """Minimal non-blocking inotify for directories (Linux, via libc)
+    """
+    def __init__(self):
+        """Setup
+
+        :raises OSError: if inotify is not available
+        """
+        try:
+            self._libc = ctypes.CDLL(None, use_errno=True)
+            init = self._libc.inotify_init1
+        except (OSError, AttributeError):
+            raise OSError(errno.ENOSYS, "inotify not available")
+        self.fd = init(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    def watch(self, path):
+        """Watch a directory for entries created, deleted or moved
+
+        :arg path: str, directory
+        :return: int, watch descriptor
+        :raises OSError: eg. watch limit reached
+        """
+        watch_descriptor = self._libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if watch_descriptor < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, "inotify_add_watch failed: {}".format(os.strerror(error)), path)
+        return watch_descriptor
+
+    def read(self):
+        """Events available now
+
+        :return: list of tuples (watch descriptor, mask, name)
+        """
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return events
+            offset = 0
+            while offset < len(data):
+                watch_descriptor, mask, _, length = EVENT.unpack_from(data, offset)
+                offset += EVENT.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+                offset += length
+                events.append((watch_descriptor, mask, name))
+
+    def close(self):
+        """Close, removing all watches
+        """
+        os.close(self.fd)
+
+
+
+class RepoRegistry(object):
+    """Repos below repo_root, scanned once and kept current
+    """
+    def __init__(self, repo_root, rescan_interval=300.0, use_inotify=True, clock=None):
+        """Setup - scanned on first use
+
+        :arg repo_root: str, served repos
+        :arg rescan_interval: float, seconds between full scans
+        :arg use_inotify: bool, follow changes between scans with inotify
+        :arg clock: callable|None, time source (for testing)
+        """
+        self.repo_root = repo_root
+        self.rescan_interval = rescan_interval
+        self.use_inotify = use_inotify
+        self._clock = clock or time.monotonic
+        # (project group, project): path
+        self.repos = {}
+        # sorted names and entries for listing, rebuilt after changes
+        self._names = None
+        self._entries = None
+        self._inotify = None
+        # watch descriptor: project group (None for repo_root)
+        self._watches = {}
+        self._lock = threading.Lock()
+        # inotify must not be shared with forked processes
+        self._pid = None
+        self.scanned_at = None
+        self.scans = 0
+
+    def _scan_dir(self, project_group):
+        """Repos in a directory
+
+        :arg project_group: str|None, project group or None for repo_root
+        :return: list of tuples (name, is repo) for directories
+        """
+        path = self.repo_root if project_group is None else os.path.join(self.repo_root, project_group)
+        entries = []
+        with os.scandir(path) as scan:
+            for entry in scan:
+                # uses the directory entry type where available, no stat
+                if entry.name.startswith('.') or not entry.is_dir():
+                    continue
+                entries.append((entry.name, entry.name.endswith('.git')))
+        return entries
+
+    def _watch(self, project_group):
+        """Follow changes to a directory if inotify is in use
+
+        :arg project_group: str|None, project group or None for repo_root
+        """
+        if self._inotify is None:
+            return
+        path = self.repo_root if project_group is None else os.path.join(self.repo_root, project_group)
+        try:
+            self._watches[self._inotify.watch(path)] = project_group
+        except OSError as exc:
+            logging.warning("Repo registry falling back to rescans only: %s", exc)
+            self._stop_inotify()
+
+    def _stop_inotify(self):
+        """Stop following changes
+        """
+        if self._inotify is not None:
+            self._inotify.close()
+        self._inotify = None
+        self._watches = {}
+
+    def _add_group(self, project_group):
+        """Add all repos in a project group
+
+        :arg project_group: str
+        """
+        self._watch(project_group)
+        try:
+            entries = self._scan_dir(project_group)
+        except OSError:
+            return
+        for name, is_repo in entries:
+            if is_repo:
+                self.repos[(project_group, name)] = os.path.join(self.repo_root, project_group, name)
+
+    def scan(self):
+        """Full scan of repo_root, replacing the registry
+
+        :raises OSError: if repo_root can't be read
+        """
+        self._stop_inotify()
+        if self.use_inotify:
+            try:
+                self._inotify = Inotify()
+            except OSError as exc:
+                logging.warning("Repo registry without inotify: %s", exc)
+        self.repos = {}
+        self._names = None
+        self._watch(None)
+        for name, is_repo in self._scan_dir(None):
+            if is_repo:
+                self.repos[(None, name)] = os.path.join(self.repo_root, name)
+            else:
+                self._add_group(name)
+        self._pid = os.getpid()
+        self.scanned_at = self._clock()
+        self.scans += 1
+        logging.info("Repo registry scanned %d repos in: %s", len(self.repos), self.repo_root)
+
+    def _apply(self, events):
+        """Update the registry from inotify events
+
+        :arg events: list of tuples (watch descriptor, mask, name)
+        :return: bool, False if a full scan is needed
+        """
+        for watch_descriptor, mask, name in events:
+            if mask & IN_Q_OVERFLOW:
+                return False
+            if mask & IN_IGNORED or watch_descriptor not in self._watches:
+                continue
+            project_group = self._watches[watch_descriptor]
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                if project_group is None:
+                    return False
+                del self._watches[watch_descriptor]
+                continue
+            if not mask & IN_ISDIR or name.startswith('.'):
+                continue
+            added = mask & (IN_CREATE | IN_MOVED_TO)
+            self._names = None
+            if name.endswith('.git'):
+                path = os.path.join(self.repo_root, name) if project_group is None else os.path.join(self.repo_root, project_group, name)
+                if added:
+                    self.repos[(project_group, name)] = path
+                else:
+                    self.repos.pop((project_group, name), None)
+            elif project_group is None:
+                if added:
+                    self._add_group(name)
+                else:
+                    for key in [key for key in self.repos if key[0] == name]:
+                        del self.repos[key]
+        return True
+
+    def refresh(self):
+        """Bring the registry up to date (cheap unless a rescan is due)
+
+        :raises OSError: if repo_root can't be read
+        """
+        with self._lock:
+            if self._pid != os.getpid() or self._clock() - self.scanned_at >= self.rescan_interval:
+                self.scan()
+            elif self._inotify is not None and not self._apply(self._inotify.read()):
+                self.scan()
+
+    def lookup(self, project_group, project):
+        """Path of a repo
+
+        :arg project_group: str|None, project group or None for top level
+        :arg project: str, project with .git
+        :return: str|None, path or None if it does not exist
+        :raises OSError: if repo_root can't be read
+        """
+        self.refresh()
+        path = self.repos.get((project_group, project))
+        if path is not None:
+            return path
+        # may have been created since the last scan (eg. by another NFS client)
+        path = os.path.join(self.repo_root, project) if project_group is None else os.path.join(self.repo_root, project_group, project)
+        if not os.path.isdir(path):
+            return None
+        with self._lock:
+            self.repos[(project_group, project)] = path
+            self._names = None
+        return path
+
+    def names(self, after=None):
+        """Repo names in order, as project or project_group/project
+
+        :arg after: str|None, start after this name
+        :return: iterator of tuples (name, project group, project)
+        """
+        self.refresh()
+        with self._lock:
+            if self._names is None:
+                self._entries = sorted(
+                    (project if project_group is None else '{}/{}'.format(project_group, project), project_group, project)
+                    for project_group, project in self.repos
+                )
+                self._names = [entry[0] for entry in self._entries]
+            names, entries = self._names, self._entries
+        start = 0 if after is None else bisect.bisect_right(names, after)
+        return iter(entries[start:])
+
+    def close(self):
+        """Release inotify
+        """
+        with self._lock:
+            self._stop_inotify()
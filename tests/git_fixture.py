@@ -0,0 +1,48 @@
+"""Synthetic git repos for tests - commits of the empty tree, made without a work tree
+"""
+
+
+import os
+import subprocess
+
+
+EMPTY_TREE = '4b825dc642cb6eb9a060e54bf8d69288fbee4904'
+# commits are made with fixed identities whatever the user's git config
+GIT_ENV = dict(
+    os.environ,
+    GIT_AUTHOR_NAME='Test', GIT_AUTHOR_EMAIL='test@example.com',
+    GIT_COMMITTER_NAME='Test', GIT_COMMITTER_EMAIL='test@example.com',
+)
+
+
+def init_repo(repo):
+    """Bare repo with the empty tree stored (so it can be packed and bundled)
+
+    :arg repo: str, path for the repo
+    """
+    subprocess.check_call(['git', 'init', '-q', '--bare', repo])
+    subprocess.check_call(['git', '--git-dir', repo, 'hash-object', '-w', '-t', 'tree', '/dev/null'], stdout=subprocess.DEVNULL)
+
+
+def commit(repo, message, parents=()):
+    """Commit of the empty tree, not on any ref
+
+    :arg repo: str, path to repo
+    :arg message: str, commit message (distinct messages give distinct commits)
+    :arg parents: iterable of str, parent oids
+    :return: str, oid of the commit
+    """
+    command = ['git', '--git-dir', repo, 'commit-tree', '-m', message, EMPTY_TREE]
+    for parent in parents:
+        command += ['-p', parent]
+    return subprocess.check_output(command, env=GIT_ENV).decode('ascii').strip()
+
+
+def update_ref(repo, ref, oid):
+    """Point a ref at an object
+
+    :arg repo: str, path to repo
+    :arg ref: str, full ref name
+    :arg oid: str, object
+    """
+    subprocess.check_call(['git', '--git-dir', repo, 'update-ref', ref, oid])
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""Check admission limits, ordering and refusal
+"""
+
+
+import unittest
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+sys.path.append(os.path.realpath(os.path.join(os.path.dirname(__file__), '..')))
+import admission
+
+
+class UnitTestAdmission(unittest.TestCase):
+    """Slots shared between schedulers (as separate workers would have)
+    """
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def scheduler(self, **kwargs):
+        """Scheduler on the shared state
+        """
+        return admission.Scheduler(self.temp_dir, **kwargs)
+
+    def test_limits(self):
+        """Per repo and total limits, refusal after max_wait
+        """
+        scheduler = self.scheduler(limits={'total': 2}, repo_limits={'git-receive-pack': 1}, max_wait=0.1)
+        first = scheduler.acquire('a.git', 'git-receive-pack', 'joe')
+        self.assertIsNotNone(first)
+        self.assertIsNone(scheduler.acquire('a.git', 'git-receive-pack', 'joe'))
+        second = self.scheduler(max_wait=0.1).acquire('b.git', 'git-receive-pack', 'joe')
+        self.assertIsNotNone(second)
+        self.assertIsNone(scheduler.acquire('c.git', 'git-upload-pack', 'joe'))
+        self.assertEqual(scheduler.status(), {'running': 2, 'waiting': 0})
+        scheduler.release(first)
+        self.assertIsNotNone(scheduler.acquire('a.git', 'git-receive-pack', 'joe'))
+
+    def test_order(self):
+        """Pushes first, then the user with fewest running, then arrival
+        """
+        scheduler = self.scheduler(limits={'total': 2})
+        held = [scheduler.acquire('a.git', 'git-upload-pack', 'joe') for _ in range(2)]
+        granted = []
+        def wait(service, user):
+            """Record when granted"""
+            granted.append((service, user, scheduler.acquire('a.git', service, user)))
+        threads = []
+        for service, user in [
+                ('git-upload-pack', 'joe'),
+                ('git-upload-pack', 'geoff'),
+                ('git-receive-pack', 'joe'),
+        ]:
+            threads.append(threading.Thread(target=wait, args=(service, user)))
+            threads[-1].start()
+            # arrival order
+            while scheduler.status()['waiting'] < len(threads):
+                time.sleep(0.01)
+        # free one slot at a time
+        for request_id in held + [None]:
+            count = len(granted)
+            scheduler.release(request_id if request_id is not None else granted[0][2])
+            while len(granted) == count:
+                time.sleep(0.01)
+        for thread in threads:
+            thread.join()
+        self.assertEqual([grant[:2] for grant in granted], [
+            ('git-receive-pack', 'joe'),
+            # joe is running the push
+            ('git-upload-pack', 'geoff'),
+            ('git-upload-pack', 'joe'),
+        ])
+
+    def test_exited(self):
+        """Slots held by processes that have exited are freed
+        """
+        scheduler = self.scheduler(limits={'total': 1}, max_wait=0.1)
+        pid = os.fork()
+        if pid == 0:
+            try:
+                scheduler.acquire('a.git', 'git-upload-pack', 'joe')
+            finally:
+                os._exit(0)     # pylint: disable=protected-access
+        os.waitpid(pid, 0)
+        self.assertIsNotNone(scheduler.acquire('a.git', 'git-upload-pack', 'joe'))
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""Check the ASGI entry point against git-http-backend
+"""
+
+
+import unittest
+import os
+import sys
+import base64
+import shutil
+import asyncio
+import tempfile
+import warnings
+import threading
+from unittest import mock
+sys.path.append(os.path.realpath(os.path.join(os.path.dirname(__file__), '..')))
+import githttp_asgi
+import githttp
+import admission
+import git_fixture
+with warnings.catch_warnings():
+    warnings.simplefilter('ignore', DeprecationWarning)
+    try:
+        import crypt
+    except ImportError:
+        crypt = None
+
+
+BIN_PATH = '/usr/lib/git-core/git-http-backend'
+CONFIG = """
+repo_root: {root}
+bin_path: {bin_path}
+authentication:
+  plugin: htpasswd
+  plugin_config:
+    htpasswd: {root}/htpasswd
+    users:
+      joe:
+        groups: [developers_group]
+authorisation:
+  project_group:
+    .read_groups: [developers_group]
+"""
+# pushes allowed, and admitted
+PUSH_CONFIG = """
+    .write_users: [joe]
+admission:
+  path: {root}/admission
+"""
+
+
+@unittest.skipUnless(os.path.exists(BIN_PATH) and crypt is not None, "git-http-backend or crypt not available")
+class UnitTestASGI(unittest.TestCase):
+    """Requests served through the ASGI app
+    """
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.repo = os.path.join(self.temp_dir, 'project_group', 'project.git')
+        git_fixture.init_repo(self.repo)
+        self.oid = git_fixture.commit(self.repo, 'test')
+        git_fixture.update_ref(self.repo, 'refs/heads/master', self.oid)
+        with open(os.path.join(self.temp_dir, 'htpasswd'), 'wt') as f_htpasswd:
+            f_htpasswd.write('joe:{}\n'.format(crypt.crypt('secret', crypt.mksalt(crypt.METHOD_SHA512))))
+        self.config_path = os.path.join(self.temp_dir, 'config.yaml')
+        with open(self.config_path, 'wt') as f_config:
+            f_config.write(CONFIG.format(root=self.temp_dir, bin_path=BIN_PATH))
+        self.environ = os.environ.get('GIT4NGINX_CONFIG')
+        os.environ['GIT4NGINX_CONFIG'] = self.config_path
+
+    def tearDown(self):
+        if self.environ is None:
+            del os.environ['GIT4NGINX_CONFIG']
+        else:
+            os.environ['GIT4NGINX_CONFIG'] = self.environ
+        shutil.rmtree(self.temp_dir)
+
+    def request(self, method, path, query=b'', body=b'', password='secret', service='git-upload-pack'):
+        """Run a request through the app
+
+        :return: tuple of status, headers (dict), body
+        """
+        headers = [[b'content-type', 'application/x-{}-request'.format(service).encode('ascii')]]
+        if password is not None:
+            headers.append([b'authorization', b'Basic ' + base64.b64encode('joe:{}'.format(password).encode('utf-8'))])
+        scope = {
+            'type': 'http',
+            'method': method,
+            'path': path,
+            'query_string': query,
+            'headers': headers,
+            'http_version': '1.1',
+        }
+        messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+        sent = []
+        async def receive():
+            if messages:
+                return messages.pop(0)
+            await asyncio.sleep(3600)
+            return {'type': 'http.disconnect'}
+        async def send(message):
+            sent.append(message)
+        asyncio.run(githttp_asgi.app(scope, receive, send))
+        return (
+            sent[0]['status'],
+            {name.decode('latin-1'): value.decode('latin-1') for name, value in sent[0]['headers']},
+            b''.join(message.get('body', b'') for message in sent[1:])
+        )
+
+    def test_refs(self):
+        """Ref advertisement
+        """
+        status, headers, body = self.request('GET', '/project_group/project.git/info/refs', b'service=git-upload-pack')
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['content-type'], 'application/x-git-upload-pack-advertisement')
+        self.assertTrue(body.startswith(b'001e# service=git-upload-pack\n'))
+        self.assertIn(self.oid.encode('ascii') + b' refs/heads/master', body)
+
+    def test_fetch(self):
+        """Request body passed through and pack returned
+        """
+        request = '0032want {}\n00000009done\n'.format(self.oid).encode('ascii')
+        status, _, body = self.request('POST', '/project_group/project.git/git-upload-pack', body=request)
+        self.assertEqual(status, 200)
+        self.assertIn(b'PACK', body)
+
+    def test_rejected(self):
+        """Authentication, authorisation and validation are applied
+        """
+        status, headers, _ = self.request('GET', '/project_group/project.git/info/refs', b'service=git-upload-pack', password=None)
+        self.assertEqual(status, 401)
+        self.assertIn('www-authenticate', headers)
+        status, _, _ = self.request('GET', '/project_group/project.git/info/refs', b'service=git-upload-pack', password='wrong')
+        self.assertEqual(status, 401)
+        status, _, _ = self.request('POST', '/project_group/project.git/git-receive-pack')
+        self.assertEqual(status, 403)
+        status, _, _ = self.request('GET', '/project_group/project.git/info/refs', b'service=other')
+        self.assertEqual(status, 400)
+        status, _, _ = self.request('GET', '/project_group/missing.git/info/refs', b'service=git-upload-pack')
+        self.assertEqual(status, 404)
+
+    def test_blocking_off_loop(self):
+        """Admission file locks and waiting for the hook log don't block the event loop
+        """
+        with open(self.config_path, 'at') as f_config:
+            f_config.write(PUSH_CONFIG.format(root=self.temp_dir))
+        threads = []
+        def recording(function):
+            """Note whether the call was made on the event loop's thread"""
+            def wrapper(*args, **kwargs):
+                threads.append((function.__name__, threading.current_thread() is threading.main_thread()))
+                return function(*args, **kwargs)
+            return wrapper
+        with mock.patch.object(admission.Scheduler, 'enqueue', recording(admission.Scheduler.enqueue)), \
+                mock.patch.object(admission.Scheduler, 'release', recording(admission.Scheduler.release)), \
+                mock.patch.object(githttp.HookLog, 'close', recording(githttp.HookLog.close)):
+            try:
+                status, _, _ = self.request(
+                    'POST', '/project_group/project.git/git-receive-pack', body=b'0000', service='git-receive-pack'
+                )
+            finally:
+                githttp.schedulers.clear()
+        self.assertEqual(status, 200)
+        self.assertEqual(sorted(threads), [('close', False), ('enqueue', False), ('release', False)])
+
+
+
+if __name__ == '__main__':
+    unittest.main()
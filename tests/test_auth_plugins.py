@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""Check authentication plugins are loaded once per worker and reinitialised on change
+"""
+
+
+import unittest
+import os
+import sys
+import shutil
+import tempfile
+sys.path.append(os.path.realpath(os.path.join(os.path.dirname(__file__), '..')))
+import githttp
+
+
+# records what the registry does with it
+PLUGIN = '''
+VERSION = {version!r}
+
+def record(event):
+    with open({events!r}, 'at') as f_events:
+        f_events.write(event + '\\n')
+
+record('import ' + VERSION)
+
+def init(logger, auth_config):
+    record('init ' + auth_config['name'])
+
+def teardown(logger):
+    record('teardown ' + VERSION)
+
+def authenticate(logger, auth_config, username, password):
+    return True, [], {{}}
+'''
+
+
+class UnitTestAuthPluginRegistry(unittest.TestCase):
+    """Import, reload, init and teardown of plugins
+    """
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.events_path = os.path.join(self.temp_dir, 'events')
+        self.write_plugin('v1')
+        self.registry = githttp.AuthPluginRegistry(self.temp_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def write_plugin(self, version, content=None):
+        """Write the plugin file
+        """
+        with open(os.path.join(self.temp_dir, 'recorder.py'), 'wt') as f_plugin:
+            f_plugin.write(content if content is not None else PLUGIN.format(version=version, events=self.events_path))
+
+    def events(self):
+        """Events recorded since last called
+        """
+        if not os.path.exists(self.events_path):
+            return []
+        with open(self.events_path, 'rt') as f_events:
+            events = f_events.read().splitlines()
+        os.unlink(self.events_path)
+        return events
+
+    def test_once_per_worker(self):
+        """Imported and initialised on first use only
+        """
+        plugin = self.registry.get('recorder', {'name': 'a'})
+        self.assertEqual(plugin.VERSION, 'v1')
+        for _ in range(3):
+            self.assertIs(self.registry.get('recorder', {'name': 'a'}), plugin)
+        self.assertEqual(self.events(), ['import v1', 'init a'])
+        self.registry.close()
+        self.assertEqual(self.events(), ['teardown v1'])
+
+    def test_plugin_config_change(self):
+        """Same module, old resources released and initialised with the new config
+        """
+        plugin = self.registry.get('recorder', {'name': 'a'})
+        self.events()
+        self.assertIs(self.registry.get('recorder', {'name': 'b'}), plugin)
+        self.assertEqual(self.events(), ['teardown v1', 'init b'])
+        self.assertIs(self.registry.get('recorder', {'name': 'b'}), plugin)
+        self.assertEqual(self.events(), [])
+
+    def test_file_change(self):
+        """Changed plugin file is imported again, replacing the old module
+        """
+        self.registry.get('recorder', {'name': 'a'})
+        self.events()
+        self.write_plugin('v2 changed')
+        plugin = self.registry.get('recorder', {'name': 'a'})
+        self.assertEqual(plugin.VERSION, 'v2 changed')
+        self.assertEqual(self.events(), ['import v2 changed', 'teardown v1', 'init a'])
+        # broken plugin is not used, and fixing it loads it
+        self.write_plugin(None, "def authenticate(:\n")
+        with self.assertLogs(githttp.app.logger, 'CRITICAL'):
+            self.assertIsNone(self.registry.get('recorder', {'name': 'a'}))
+        self.assertEqual(self.events(), ['teardown v2 changed'])
+        self.write_plugin('v3')
+        self.assertEqual(self.registry.get('recorder', {'name': 'a'}).VERSION, 'v3')
+        self.assertEqual(self.events(), ['import v3', 'init a'])
+
+    def test_invalid_name(self):
+        """Only plain names from the plugin directory
+        """
+        with self.assertLogs(githttp.app.logger, 'CRITICAL'):
+            self.assertIsNone(self.registry.get('../recorder', {'name': 'a'}))
+        with self.assertLogs(githttp.app.logger, 'CRITICAL'):
+            self.assertIsNone(self.registry.get('missing', {'name': 'a'}))
+
+
+
+if __name__ == '__main__':
+    unittest.main()
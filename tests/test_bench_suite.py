@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+"""Smoke run of the microbenchmark suite so it keeps up with the code it measures
+"""
+
+
+import unittest
+import os
+import sys
+import json
+import shutil
+import tempfile
+import subprocess
+
+
+BENCH_SUITE = os.path.realpath(os.path.join(os.path.dirname(__file__), '..', 'benchmarks', 'bench_suite.py'))
+
+
+class UnitTestBenchSuite(unittest.TestCase):
+    """bench_suite.py --quick runs every benchmark
+    """
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_quick(self):
+        """All benchmarks run, produce results and are compared with the reference baseline
+        """
+        results_path = os.path.join(self.temp_dir, 'results.json')
+        # timings on this machine may be anything, only the comparison running is checked
+        output = subprocess.check_output([sys.executable, BENCH_SUITE, '--quick', '--save', results_path, '--tolerance', '1e9']).decode('utf-8')
+        with open(results_path, 'rt') as f_results:
+            results = json.load(f_results)['results']
+        with open(os.path.join(os.path.dirname(BENCH_SUITE), 'baseline.json'), 'rt') as f_baseline:
+            baseline = json.load(f_baseline)['results']
+        self.assertEqual(sorted(results), sorted(baseline))
+        for name, seconds in results.items():
+            self.assertGreater(seconds, 0, name)
+            self.assertRegex(output, r'\n{} +[0-9.e+-]+ +[0-9.e+-]+ +[+-][0-9.]+%\n'.format(name))
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""Check clone bundles are written by maintenance and served to clients
+"""
+
+
+import unittest
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+sys.path.append(os.path.realpath(os.path.join(os.path.dirname(__file__), '..')))
+import bundles
+import maintenance
+import githttp
+import git_fixture
+
+
+CONFIG = """
+repo_root: {root}/repos
+bin_path: /usr/lib/git-core/git-http-backend
+bundles:
+  path: {root}/bundles
+  accel_redirect: /git4nginx-bundles/
+authentication:
+  plugin: lookup_groups
+  plugin_config:
+    users:
+      joe:
+        groups: [developers_group]
+authorisation:
+  grp:
+    .read_users: [joe]
+"""
+
+
+class UnitTestBundles(unittest.TestCase):
+    """Full then incremental bundles, the bundle list and downloads
+    """
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.repo_root = os.path.join(self.temp_dir, 'repos')
+        self.repo = os.path.join(self.repo_root, 'grp', 'project.git')
+        git_fixture.init_repo(self.repo)
+        self.commit = None
+        self.store = bundles.BundleStore(os.path.join(self.temp_dir, 'bundles'), push_threshold=2)
+        self.maintainer = maintenance.Maintainer(
+            self.repo_root, os.path.join(self.temp_dir, 'state'), quiet_period=0, cpu_budget=1.0, bundle_store=self.store
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def push(self, count=1):
+        """Commits on master, recorded as pushes
+        """
+        for _ in range(count):
+            self.commit = git_fixture.commit(self.repo, str(self.commit), [] if self.commit is None else [self.commit])
+            git_fixture.update_ref(self.repo, 'refs/heads/master', self.commit)
+            self.maintainer.record_push('grp/project.git', 1)
+
+    def test_bundles(self):
+        """Bundles follow pushes and are served from the list
+        """
+        self.push()
+        self.maintainer.run_pass()
+        manifest = self.store.manifest('grp/project.git')
+        self.assertEqual([bundle['id'].split('-')[0] for bundle in manifest], ['full'])
+        self.assertEqual(manifest[0]['heads'], {'refs/heads/master': self.commit})
+        # below push_threshold
+        self.push()
+        self.maintainer.run_pass()
+        self.assertEqual(len(self.store.manifest('grp/project.git')), 1)
+        self.push()
+        self.maintainer.run_pass()
+        manifest = self.store.manifest('grp/project.git')
+        self.assertEqual([bundle['id'].split('-')[0] for bundle in manifest], ['full', 'incr'])
+        self.assertGreater(manifest[1]['creation_token'], manifest[0]['creation_token'])
+        self.assertEqual(self.maintainer.status()['grp/project.git']['bundle_pushes'], 0)
+        # incremental bundle needs the full bundle
+        incremental = os.path.join(self.store.repo_dir('grp/project.git'), manifest[1]['file'])
+        clone = os.path.join(self.temp_dir, 'clone.git')
+        subprocess.check_call(['git', 'init', '-q', '--bare', clone])
+        self.assertNotEqual(subprocess.call(['git', 'bundle', 'verify', '-q', incremental], cwd=clone, stderr=subprocess.DEVNULL), 0)
+        subprocess.check_call(['git', 'fetch', '-q', os.path.join(self.store.repo_dir('grp/project.git'), manifest[0]['file']), 'refs/heads/*:refs/heads/*'], cwd=clone)
+        subprocess.check_call(['git', 'bundle', 'verify', '-q', incremental], cwd=clone, stderr=subprocess.DEVNULL)
+
+        config_path = os.path.join(self.temp_dir, 'config.yaml')
+        with open(config_path, 'wt') as f_config:
+            f_config.write(CONFIG.format(root=self.temp_dir))
+        environ = os.environ.get('GIT4NGINX_CONFIG')
+        os.environ['GIT4NGINX_CONFIG'] = config_path
+        try:
+            client = githttp.app.test_client()
+            response = client.get('/grp/project.git/bundles/list', environ_base={'REMOTE_USER': 'joe'})
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('\turi = http://localhost/grp/project.git/bundles/{}\n'.format(manifest[1]['file']), response.data.decode('utf-8'))
+            response = client.get('/grp/project.git/bundles/' + manifest[0]['file'], environ_base={'REMOTE_USER': 'joe'})
+            self.assertEqual(response.headers['X-Accel-Redirect'], '/git4nginx-bundles/grp/project.git/' + manifest[0]['file'])
+            self.assertEqual(client.get('/grp/project.git/bundles/manifest.json', environ_base={'REMOTE_USER': 'joe'}).status_code, 404)
+            self.assertEqual(client.get('/grp/project.git/bundles/list').status_code, 401)
+        finally:
+            githttp.bundle_stores.clear()
+            if environ is None:
+                del os.environ['GIT4NGINX_CONFIG']
+            else:
+                os.environ['GIT4NGINX_CONFIG'] = environ
+        env = {'GIT_CONFIG_COUNT': '1'}
+        self.store.config_env('grp/project.git', 'https://example.com/grp/project.git/bundles/', env)
+        self.assertEqual(env['GIT_CONFIG_KEY_1'], 'uploadpack.advertiseBundleURIs')
+        self.assertEqual(env['GIT_CONFIG_COUNT'], str(1 + 4 + 2 * 2))
+
+    def test_unreadable_bundle(self):
+        """Bundle git can't list the heads of fails the task, not the pass
+        """
+        self.push()
+        run_task = self.maintainer.run_task
+        def corrupting_run_task(repo_path, command):
+            """Bundle written, then damaged"""
+            result = run_task(repo_path, command)
+            if command[0] == 'bundle':
+                with open(command[3], 'wb') as f_bundle:
+                    f_bundle.write(b'not a bundle\n')
+            return result
+        self.maintainer.run_task = corrupting_run_task
+        with self.assertLogs(level='ERROR'):
+            self.maintainer.run_pass()
+        status = self.maintainer.status()['grp/project.git']
+        self.assertEqual(status['tasks']['bundle']['status'], 'failed')
+        self.assertEqual(status['bundle_pushes'], 1)
+        self.assertEqual(self.store.manifest('grp/project.git'), [])
+        self.assertEqual(os.listdir(self.store.repo_dir('grp/project.git')), [])
+        # next pass writes it
+        self.maintainer.run_task = run_task
+        self.maintainer.run_pass(force=True)
+        self.assertEqual(len(self.store.manifest('grp/project.git')), 1)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
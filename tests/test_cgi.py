@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""Check cgi output is parsed and streamed incrementally, using a stub cgi
+"""
+
+
+import unittest
+import os
+import sys
+import shutil
+import tempfile
+sys.path.append(os.path.realpath(os.path.join(os.path.dirname(__file__), '..')))
+import githttp
+
+
+CONFIG = """
+repo_root: {root}
+bin_path: {stub}
+cgi:
+  buffer_size: {buffer_size}
+authentication:
+  plugin: lookup_groups
+  plugin_config:
+    users:
+      joe:
+        groups: [developers_group]
+authorisation:
+  grp:
+    .write_groups: [developers_group]
+"""
+# behaviour chosen by the X-Stub request header
+STUB = """#!{python}
+import os
+import sys
+import time
+
+def send(data):
+    sys.stdout.buffer.write(data)
+    sys.stdout.flush()
+    # separate reads by the app
+    time.sleep(0.02)
+
+mode = os.environ['HTTP_X_STUB']
+if mode == 'split':
+    # header terminator split across chunks
+    for piece in [b'Content-Type: text/pl', b'ain\\r\\nX-Stub: split\\r', b'\\n\\r', b'\\nfirst', b' second']:
+        send(piece)
+elif mode == 'echo':
+    send(b'Content-Type: application/octet-stream\\r\\n\\r\\n')
+    while True:
+        data = sys.stdin.buffer.read(1000)
+        if not data:
+            break
+        sys.stdout.buffer.write(data)
+elif mode == 'status':
+    send(b'Status: 403 Forbidden\\r\\n\\r\\n')
+elif mode == 'no_header':
+    send(b'Content-Type: text/plain\\r\\n')
+    sys.exit(1)
+elif mode == 'huge_header':
+    sys.stdout.buffer.write(b'X-Long: ' + b'x' * (2 * {header_limit}))
+    sys.stdout.flush()
+    time.sleep(5)
+"""
+INFO_REFS = '/grp/project.git/info/refs?service=git-upload-pack'
+
+
+class UnitTestCGI(unittest.TestCase):
+    """Requests through cgi_wrapper and CGIStream
+    """
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.temp_dir, 'grp', 'project.git'))
+        stub = os.path.join(self.temp_dir, 'stub.py')
+        with open(stub, 'wt') as f_stub:
+            f_stub.write(STUB.format(python=sys.executable, header_limit=githttp.CGI_HEADER_LIMIT))
+        os.chmod(stub, 0o755)
+        config_path = os.path.join(self.temp_dir, 'config.yaml')
+        self.buffer_size = 16
+        with open(config_path, 'wt') as f_config:
+            f_config.write(CONFIG.format(root=self.temp_dir, stub=stub, buffer_size=self.buffer_size))
+        self.environ = os.environ.get('GIT4NGINX_CONFIG')
+        os.environ['GIT4NGINX_CONFIG'] = config_path
+        self.client = githttp.app.test_client()
+
+    def tearDown(self):
+        if self.environ is None:
+            del os.environ['GIT4NGINX_CONFIG']
+        else:
+            os.environ['GIT4NGINX_CONFIG'] = self.environ
+        shutil.rmtree(self.temp_dir)
+
+    def request(self, mode, data=None):
+        """Request run by the stub cgi
+        """
+        environ = {'REMOTE_USER': 'joe', 'HTTP_X_STUB': mode}
+        if data is None:
+            return self.client.get(INFO_REFS, environ_base=environ)
+        return self.client.post('/grp/project.git/git-upload-pack', data=data, environ_base=environ)
+
+    def test_header_across_chunks(self):
+        """Header lines and the blank line ending the header arrive in separate reads
+        """
+        response = self.request('split')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Content-Type'], 'text/plain')
+        self.assertEqual(response.headers['X-Stub'], 'split')
+        self.assertEqual(response.data, b'first second')
+
+    def test_status(self):
+        """Status header sets the response code, reason is the body
+        """
+        response = self.request('status')
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(response.data, b'Forbidden')
+
+    def test_streamed_body(self):
+        """Request body goes through the cgi and the response comes back in buffer sized chunks
+        """
+        data = bytes(range(256)) * 40
+        response = self.request('echo', data)
+        self.assertEqual(response.status_code, 200)
+        chunks = list(response.response)
+        self.assertEqual(b''.join(chunks), data)
+        self.assertGreater(len(chunks), 1)
+        self.assertLessEqual(max(len(chunk) for chunk in chunks), self.buffer_size)
+
+    def test_bad_header(self):
+        """Missing or oversized header is a server error
+        """
+        with self.assertLogs(githttp.app.logger, 'ERROR') as logs:
+            self.assertEqual(self.request('no_header').status_code, 500)
+        self.assertIn("before completing header", '\n'.join(logs.output))
+        with self.assertLogs(githttp.app.logger, 'ERROR') as logs:
+            self.assertEqual(self.request('huge_header').status_code, 500)
+        self.assertIn("No end of cgi header", '\n'.join(logs.output))
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""Check the per-worker config cache reloads only on change and reports loads to metrics
+"""
+
+
+import unittest
+import os
+import sys
+import time
+import shutil
+import tempfile
+sys.path.append(os.path.realpath(os.path.join(os.path.dirname(__file__), '..')))
+import githttp
+
+
+CONFIG = """
+repo_root: {root}
+metrics:
+  path: {root}/metrics
+authentication:
+  plugin: lookup_groups
+  plugin_config:
+    users: {{}}
+authorisation: {{}}
+# {comment}
+"""
+
+
+class UnitTestConfigCache(unittest.TestCase):
+    """Reloading, keeping the last good config and reporting
+    """
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.config_path = os.path.join(self.temp_dir, 'config.yaml')
+        self.write_config('first')
+        self.cache = githttp.ConfigCache()
+        self.parses = 0
+        parse = self.cache._parse       # pylint: disable=protected-access
+        def counting_parse(config_path):
+            """Count parses"""
+            self.parses += 1
+            return parse(config_path)
+        self.cache._parse = counting_parse      # pylint: disable=protected-access
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def write_config(self, comment, content=None, path=None):
+        """Write the config, keeping the mtime of any existing file
+        """
+        path = path or self.config_path
+        mtime = os.stat(path).st_mtime_ns if os.path.exists(path) else None
+        with open(path, 'wt') as f_config:
+            f_config.write(content if content is not None else CONFIG.format(root=self.temp_dir, comment=comment))
+        if mtime is not None:
+            os.utime(path, ns=(mtime, mtime))
+
+    def test_reload(self):
+        """Parsed again only when mtime, size or inode changes
+        """
+        config = self.cache.get(self.config_path)
+        self.assertEqual((self.parses, self.cache.reloads), (1, 1))
+        loaded_at = self.cache.loaded_at
+        self.assertIs(self.cache.get(self.config_path), config)
+        # same size and mtime is taken as unchanged
+        self.write_config('other')
+        self.assertIs(self.cache.get(self.config_path), config)
+        self.assertEqual(self.parses, 1)
+        # size
+        self.write_config('changed size')
+        self.cache.get(self.config_path)
+        self.assertEqual(self.parses, 2)
+        # mtime
+        stat = os.stat(self.config_path)
+        os.utime(self.config_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000))
+        self.cache.get(self.config_path)
+        self.assertEqual(self.parses, 3)
+        # inode (replaced, eg. by config management) with the same size and mtime
+        stat = os.stat(self.config_path)
+        replacement = self.config_path + '.new'
+        self.write_config('changed  size', path=replacement)
+        os.utime(replacement, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        os.rename(replacement, self.config_path)
+        self.cache.get(self.config_path)
+        self.assertEqual((self.parses, self.cache.reloads), (4, 4))
+        self.assertGreaterEqual(self.cache.loaded_at, loaded_at)
+
+    def test_keep_last_good(self):
+        """Broken config is reported once and the last good one kept
+        """
+        config = self.cache.get(self.config_path)
+        loaded_at = self.cache.loaded_at
+        with self.assertLogs(githttp.app.logger, 'CRITICAL'):
+            self.write_config(None, "authentication: [unterminated\n")
+            self.assertIs(self.cache.get(self.config_path), config)
+        self.assertIs(self.cache.get(self.config_path), config)
+        self.assertEqual((self.parses, self.cache.reloads, self.cache.errors), (2, 1, 1))
+        self.assertEqual(self.cache.loaded_at, loaded_at)
+        # fixed
+        self.write_config('fixed')
+        self.assertIsNot(self.cache.get(self.config_path), config)
+        self.assertEqual((self.cache.reloads, self.cache.errors), (2, 1))
+
+    def test_metrics(self):
+        """Loads, failures and the load time are on /metrics
+        """
+        environ = os.environ.get('GIT4NGINX_CONFIG')
+        os.environ['GIT4NGINX_CONFIG'] = self.config_path
+        start = time.time()
+        try:
+            client = githttp.app.test_client()
+            client.get('/metrics')
+            with self.assertLogs(githttp.app.logger, 'CRITICAL'):
+                self.write_config(None, CONFIG.format(root=self.temp_dir, comment='x') + "authorisation: [\n")
+                client.get('/metrics')
+            self.write_config('fixed')
+            text = client.get('/metrics').data.decode('utf-8')
+        finally:
+            if environ is None:
+                del os.environ['GIT4NGINX_CONFIG']
+            else:
+                os.environ['GIT4NGINX_CONFIG'] = environ
+        self.assertIn('git4nginx_config_reloads_total 2\n', text)
+        self.assertIn('git4nginx_config_errors_total 1\n', text)
+        self.assertIn('# TYPE git4nginx_config_loaded_timestamp_seconds gauge\n', text)
+        loaded_at = [line for line in text.splitlines() if line.startswith('git4nginx_config_loaded_timestamp_seconds ')]
+        self.assertEqual(len(loaded_at), 1)
+        self.assertGreaterEqual(float(loaded_at[0].split()[-1]), start)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
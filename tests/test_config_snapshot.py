@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""Check hooks load config from the compiled snapshot only while it is current
+"""
+
+
+import unittest
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+sys.path.append(os.path.realpath(os.path.join(os.path.dirname(__file__), '..')))
+import hook_helper
+from hook_helper import config_snapshot
+
+
+CONFIG = '''
+repo_root: {repo_root}
+authentication: {{}}
+authorisation: {{}}
+hooks:
+  .branch_flow:
+    flow: [dev, master]
+  .record_push:
+    enable: true
+  grp:
+    .branch_flow:
+      flow: [test, master]
+    project.git:
+      .record_push:
+        enable: false
+  null:
+    top.git:
+      .branch_protect:
+        protect: [master]
+'''
+
+
+class UnitTestConfigSnapshot(unittest.TestCase):
+    """Compiling, loading and invalidating the snapshot
+    """
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.repo_root = os.path.join(self.temp_dir, 'repos')
+        for repo in ['grp/project.git', 'grp/other.git', 'top.git']:
+            subprocess.check_call(['git', 'init', '-q', '--bare', os.path.join(self.repo_root, repo)])
+        self.config_path = os.path.join(self.temp_dir, 'config.yaml')
+        self.write_config(CONFIG)
+        self.environ = os.environ.get('GIT4NGINX_CONFIG')
+        os.environ['GIT4NGINX_CONFIG'] = self.config_path
+
+    def tearDown(self):
+        if self.environ is None:
+            del os.environ['GIT4NGINX_CONFIG']
+        else:
+            os.environ['GIT4NGINX_CONFIG'] = self.environ
+        shutil.rmtree(self.temp_dir)
+
+    def write_config(self, config):
+        """Write the YAML config
+        """
+        with open(self.config_path, 'wt') as f_config:
+            f_config.write(config.format(repo_root=self.repo_root))
+
+    def test_resolve(self):
+        """Closest to the repo wins, including top level projects
+        """
+        config = hook_helper.load_config(use_snapshot=False)
+        hooks = config['hooks']
+        self.assertEqual(config_snapshot.resolve_hooks(hooks, 'grp', 'project.git'), {
+            'branch_flow': {'flow': ['test', 'master']},
+            'record_push': {'enable': False},
+        })
+        self.assertEqual(config_snapshot.resolve_hooks(hooks, None, 'top.git'), {
+            'branch_flow': {'flow': ['dev', 'master']},
+            'record_push': {'enable': True},
+            'branch_protect': {'protect': ['master']},
+        })
+        self.assertEqual(config_snapshot.resolve_hooks(hooks, 'nogroup', 'new.git'), {
+            'branch_flow': {'flow': ['dev', 'master']},
+            'record_push': {'enable': True},
+        })
+
+    def test_snapshot(self):
+        """Compiled on first load, used while current, recompiled after changes
+        """
+        snapshot_path = config_snapshot.snapshot_path(self.config_path)
+        # hooks only resolve the repo they run in
+        cwd = os.getcwd()
+        os.chdir(os.path.join(self.repo_root, 'grp', 'project.git'))
+        try:
+            config = hook_helper.load_config()
+        finally:
+            os.chdir(cwd)
+        self.assertTrue(os.path.exists(snapshot_path))
+        snapshot = config_snapshot.load_snapshot(self.config_path)
+        self.assertEqual(snapshot, config)
+        self.assertEqual(list(snapshot.repo_hooks), [('grp', 'project.git')])
+        # all repos (as by compile_config.py)
+        config_snapshot.compile_config(self.config_path, dict(config), config_snapshot.source_signature(self.config_path))
+        snapshot = config_snapshot.load_snapshot(self.config_path)
+        self.assertEqual(sorted(snapshot.repo_hooks, key=str), [('grp', 'other.git'), ('grp', 'project.git'), (None, 'top.git')])
+        for (project_group, project), resolved in snapshot.repo_hooks.items():
+            self.assertEqual(resolved, config_snapshot.resolve_hooks(config['hooks'], project_group, project))
+        self.assertEqual(
+            hook_helper.hook_configs(snapshot, 'grp', 'project.git'),
+            hook_helper.hook_configs(dict(config), 'grp', 'project.git')
+        )
+        # repos created since compiling are resolved from the config
+        self.assertEqual(hook_helper.hook_configs(snapshot, 'grp', 'new.git')['branch_flow'], {'flow': ['test', 'master']})
+        # edited config makes the snapshot stale
+        self.write_config(CONFIG.replace('[dev, master]', '[dev, staging, master]'))
+        self.assertIsNone(config_snapshot.load_snapshot(self.config_path))
+        config = hook_helper.load_config()
+        self.assertEqual(config['hooks']['.branch_flow']['flow'], ['dev', 'staging', 'master'])
+        self.assertEqual(config_snapshot.load_snapshot(self.config_path), config)
+        # corrupt snapshot falls back to the YAML
+        with open(snapshot_path, 'wb') as f_snapshot:
+            f_snapshot.write(b'\xff\x00garbage')
+        with self.assertLogs(level='WARNING'):
+            self.assertIsNone(config_snapshot.load_snapshot(self.config_path))
+        self.assertEqual(hook_helper.load_config()['hooks']['.branch_flow']['flow'], ['dev', 'staging', 'master'])
+
+    def test_mode(self):
+        """Snapshot has the permissions of the YAML, whatever the umask
+        """
+        snapshot_path = config_snapshot.snapshot_path(self.config_path)
+        umask = os.umask(0)
+        try:
+            for mode in [0o600, 0o640, 0o644]:
+                os.chmod(self.config_path, mode)
+                os.utime(self.config_path, ns=(0, mode))
+                hook_helper.load_config()
+                self.assertEqual(os.stat(snapshot_path).st_mode & 0o777, mode)
+        finally:
+            os.umask(umask)
+        self.assertEqual([name for name in os.listdir(self.temp_dir) if name.endswith('.tmp')], [])
+
+    def test_unwritable(self):
+        """Snapshot that can't be written leaves the YAML in use, without scanning repo_root first
+        """
+        # in the way of the temp file (permissions don't stop root)
+        os.mkdir('{}.{}.tmp'.format(config_snapshot.snapshot_path(self.config_path), os.getpid()))
+        find_repos = config_snapshot.find_repos
+        config_snapshot.find_repos = lambda repo_root: self.fail("repo_root scanned")
+        try:
+            with self.assertLogs(level='WARNING') as logs:
+                config = hook_helper.load_config()
+            with self.assertRaises(OSError):
+                config_snapshot.compile_config(self.config_path, dict(config), config_snapshot.source_signature(self.config_path))
+        finally:
+            config_snapshot.find_repos = find_repos
+        self.assertIn('compile_config.py', '\n'.join(logs.output))
+        self.assertEqual(config['hooks']['.branch_flow'], {'flow': ['dev', 'master']})
+        self.assertFalse(os.path.exists(config_snapshot.snapshot_path(self.config_path)))
+
+    def test_current_repo(self):
+        """Repo hooks run in, relative to repo_root
+        """
+        self.assertEqual(config_snapshot.current_repo(self.repo_root, os.path.join(self.repo_root, 'grp', 'project.git')), ('grp', 'project.git'))
+        self.assertEqual(config_snapshot.current_repo(self.repo_root, os.path.join(self.repo_root, 'top.git')), (None, 'top.git'))
+        for repo_dir in [self.repo_root, self.temp_dir, os.path.join(self.repo_root, 'grp'), os.path.join(self.repo_root, 'grp', 'project.git', 'objects')]:
+            self.assertIsNone(config_snapshot.current_repo(self.repo_root, repo_dir))
+
+    def test_uncompilable(self):
+        """Values marshal can't store leave the YAML in use
+        """
+        self.write_config(CONFIG + 'deployed: 2019-01-01 00:00:00\n')
+        config = hook_helper.load_config()
+        self.assertIn('deployed', config)
+        self.assertFalse(os.path.exists(config_snapshot.snapshot_path(self.config_path)))
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""Check native ref advertisement is byte-identical to git-http-backend
+"""
+
+
+import unittest
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+sys.path.append(os.path.realpath(os.path.join(os.path.dirname(__file__), '..')))
+import git_refs
+
+
+BIN_PATH = '/usr/lib/git-core/git-http-backend'
+GIT_ENV = {
+    'GIT_AUTHOR_NAME': 'Test',
+    'GIT_AUTHOR_EMAIL': 'test@example.com',
+    'GIT_COMMITTER_NAME': 'Test',
+    'GIT_COMMITTER_EMAIL': 'test@example.com',
+}
+
+
+@unittest.skipUnless(os.path.exists(BIN_PATH), "git-http-backend not available")
+class UnitTestGitRefs(unittest.TestCase):
+    """Native output must match git-http-backend
+    """
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.work = os.path.join(self.temp_dir, 'work')
+        self.repo = os.path.join(self.temp_dir, 'test.git')
+        self.ref_cache = git_refs.RefCache(BIN_PATH)
+        # refs are created just before checking
+        self.racy_ns = git_refs.RACY_NS
+        git_refs.RACY_NS = 0
+
+    def tearDown(self):
+        git_refs.RACY_NS = self.racy_ns
+        shutil.rmtree(self.temp_dir)
+
+    def git(self, *args, git_dir=None):
+        """Run git in the work tree (or repo)
+        """
+        env = dict(os.environ)
+        env.update(GIT_ENV)
+        command = ['git', '--git-dir={}'.format(git_dir)] if git_dir else ['git', '-C', self.work]
+        return subprocess.check_output(command + list(args), env=env).decode('utf-8').strip()
+
+    def build_repo(self):
+        """Repo with packed and loose refs, annotated and lightweight tags and a symref
+        """
+        subprocess.check_call(['git', 'init', '-q', '-b', 'master', self.work])
+        for count in range(3):
+            with open(os.path.join(self.work, 'file'), 'wt') as f_file:
+                f_file.write(str(count))
+            self.git('add', 'file')
+            self.git('commit', '-q', '-m', 'commit {}'.format(count))
+        self.git('tag', '-a', '-m', 'annotated', 'v1', 'HEAD~1')
+        self.git('tag', '-a', '-m', 'tag of tag', 'v1-outer', 'v1')
+        self.git('tag', 'light', 'HEAD~2')
+        self.git('branch', 'dev-a', 'HEAD~1')
+        self.git('branch', 'dev/b', 'HEAD~2')
+        subprocess.check_call(['git', 'clone', '-q', '--bare', self.work, self.repo])
+        self.git('pack-refs', '--all', git_dir=self.repo)
+        # some loose refs on top
+        self.git('tag', '-a', '-m', 'loose', 'v2')
+        self.git('branch', 'zz')
+        self.git('push', '-q', self.repo, 'refs/tags/v2', 'zz', 'HEAD:dev-a')
+        self.git('symbolic-ref', 'refs/remotes/origin/HEAD', 'refs/heads/master', git_dir=self.repo)
+
+    def ls_refs_request(self, arguments):
+        """Protocol v2 ls-refs request body
+        """
+        return git_refs.pkt_line('command=ls-refs\n') + git_refs.DELIM \
+            + b''.join(git_refs.pkt_line(argument + '\n') for argument in arguments) + git_refs.FLUSH
+
+    def check(self):
+        """Compare all output variations
+        """
+        capabilities = self.ref_cache.capabilities(self.repo)
+        self.assertIsNotNone(capabilities)
+        snapshot = git_refs.RefSnapshot(self.repo)
+        self.assertEqual(
+            snapshot.advertisement_v0(capabilities),
+            self.ref_cache._backend(self.repo, 'GET', 'service=git-upload-pack')   # pylint: disable=protected-access
+        )
+        for arguments in [
+                [],
+                ['peel', 'symrefs', 'unborn'],
+                ['symrefs', 'ref-prefix HEAD', 'ref-prefix refs/tags/'],
+                ['peel', 'ref-prefix refs/heads/dev'],
+        ]:
+            self.assertEqual(
+                snapshot.ls_refs(arguments),
+                self.ref_cache._backend(self.repo, 'POST', '', self.ls_refs_request(arguments)),   # pylint: disable=protected-access
+                str(arguments)
+            )
+
+    def test_refs(self):
+        """Packed, loose, peeled and symrefs
+        """
+        self.build_repo()
+        self.check()
+
+    def test_detached_head(self):
+        """HEAD pointing directly at a commit
+        """
+        self.build_repo()
+        self.git('update-ref', '--no-deref', 'HEAD', 'refs/heads/dev-a', git_dir=self.repo)
+        self.check()
+
+    def test_empty(self):
+        """Repo with no refs (unborn HEAD)
+        """
+        subprocess.check_call(['git', 'init', '-q', '--bare', self.repo])
+        self.check()
+
+    def test_first_refs(self):
+        """Capabilities are learnt again once an empty repo has refs
+        """
+        subprocess.check_call(['git', 'init', '-q', '--bare', self.repo])
+        self.assertEqual(self.ref_cache.capabilities(self.repo), ((), ()))
+        subprocess.check_call(['git', 'init', '-q', '-b', 'master', self.work])
+        self.git('commit', '-q', '--allow-empty', '-m', 'first')
+        self.git('push', '-q', self.repo, 'master')
+        self.assertIn('side-band-64k', self.ref_cache.capabilities(self.repo)[0])
+        self.check()
+
+    def test_hidden_refs(self):
+        """Repos hiding refs are left to git-http-backend, including refs hidden later
+        """
+        self.build_repo()
+        for key in ['uploadpack.hideRefs', 'transfer.hideRefs']:
+            ref_cache = git_refs.RefCache(BIN_PATH)
+            self.git('config', key, 'refs/secret', git_dir=self.repo)
+            with self.assertLogs(level='INFO'):
+                self.assertIsNone(ref_cache.capabilities(self.repo))
+            self.git('update-ref', 'refs/secret/x', 'refs/heads/master', git_dir=self.repo)
+            self.assertIsNone(ref_cache.capabilities(self.repo))
+            self.assertNotIn(b'refs/secret/x', ref_cache._backend(self.repo, 'GET', 'service=git-upload-pack'))  # pylint: disable=protected-access
+            self.git('config', '--unset', key, git_dir=self.repo)
+            self.git('update-ref', '-d', 'refs/secret/x', git_dir=self.repo)
+        self.check()
+
+    def test_change_detected(self):
+        """Snapshot is invalidated when refs change
+        """
+        self.build_repo()
+        snapshot = git_refs.RefSnapshot(self.repo)
+        self.assertTrue(snapshot.is_current())
+        self.git('update-ref', 'refs/heads/new', 'refs/heads/master', git_dir=self.repo)
+        self.assertFalse(snapshot.is_current())
+
+
+
+if __name__ == '__main__':
+    unittest.main()
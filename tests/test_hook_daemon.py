@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""Check hooks give the same result through the hook daemon as run directly
+"""
+
+
+import unittest
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import warnings
+import subprocess
+
+
+HOOKS_DIR = os.path.realpath(os.path.join(os.path.dirname(__file__), '..', 'hooks'))
+sys.path.append(HOOKS_DIR)
+import master_pre_receive
+CONFIG = """
+repo_root: {root}
+authentication: {{}}
+authorisation: {{}}
+hook_daemon:
+  socket: {root}/hooks.sock
+hooks:
+  .branch_protect:
+    enable: true
+    branches:
+      master:
+        .write_users: [sydney]
+"""
+
+
+class UnitTestHookDaemon(unittest.TestCase):
+    """pre-receive via the daemon and directly
+    """
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.repo = os.path.join(self.temp_dir, 'project.git')
+        subprocess.check_call(['git', 'init', '-q', '--bare', self.repo])
+        os.symlink(os.path.join(HOOKS_DIR, 'master_pre_receive.py'), os.path.join(self.repo, 'hooks', 'pre-receive'))
+        config_path = os.path.join(self.temp_dir, 'config.yaml')
+        with open(config_path, 'wt') as f_config:
+            f_config.write(CONFIG.format(root=self.temp_dir))
+        self.socket_path = os.path.join(self.temp_dir, 'hooks.sock')
+        self.env = dict(
+            os.environ,
+            GIT4NGINX_CONFIG=config_path,
+            GIT4NGINX_GROUPS='["developers_group"]',
+            GIT4NGINX_INFO='{}',
+            REMOTE_USER='joe',
+        )
+        self.daemon = None
+        self.logs = []
+
+    def tearDown(self):
+        if self.daemon is not None:
+            self.daemon.terminate()
+            self.daemon.wait()
+        shutil.rmtree(self.temp_dir)
+
+    def start_daemon(self):
+        """Run the daemon until it is listening
+        """
+        self.daemon = subprocess.Popen(
+            [sys.executable, os.path.join(HOOKS_DIR, 'hook_daemon.py')],
+            env=self.env, stderr=subprocess.DEVNULL
+        )
+        for _ in range(100):
+            if os.path.exists(self.socket_path):
+                return
+            time.sleep(0.05)
+        self.fail("Hook daemon did not start")
+
+    def run_hook(self, ref, socket_path=None):
+        """Run pre-receive for a new ref, collecting log records in self.logs
+
+        :return: tuple of exit status, stdout
+        """
+        env = dict(self.env)
+        if socket_path is not None:
+            env['GIT4NGINX_HOOK_SOCKET'] = socket_path
+        read_fd, write_fd = os.pipe()
+        env['GIT4NGINX_LOG_FD'] = str(write_fd)
+        try:
+            process = subprocess.run(
+                [sys.executable, 'hooks/pre-receive'],
+                cwd=self.repo, env=env, pass_fds=(write_fd, ),
+                input='{} {} {}\n'.format('0' * 40, '1' * 40, ref).encode('ascii'),
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=False
+            )
+        finally:
+            os.close(write_fd)
+        with open(read_fd, 'rb') as f_log:
+            self.logs += [json.loads(line) for line in f_log]
+        return process.returncode, process.stdout.decode('utf-8')
+
+    def test_same_result(self):
+        """Allowed and rejected pushes match, with hook logs passed back
+        """
+        direct = [self.run_hook(ref) for ref in ['refs/heads/dev', 'refs/heads/master']]
+        self.assertEqual(direct[0][0], 0)
+        self.assertNotEqual(direct[1][0], 0)
+        self.assertIn("restricted branch: master", direct[1][1])
+        errors = [log for log in self.logs if log['level'] == 'ERROR']
+        self.assertEqual([log['hook'] for log in errors], ['pre-receive'])
+        self.assertIn("restricted branch: master", errors[0]['message'])
+        self.start_daemon()
+        self.logs = []
+        daemon = [self.run_hook(ref, self.socket_path) for ref in ['refs/heads/dev', 'refs/heads/master']]
+        self.assertEqual(daemon, direct)
+        self.assertIn("Running in hook daemon", [log['message'].split(':')[0] for log in self.logs])
+
+    def test_fallback(self):
+        """Hook runs itself when the daemon is not available
+        """
+        self.assertEqual(self.run_hook('refs/heads/dev', self.socket_path)[0], 0)
+        self.assertNotEqual(self.run_hook('refs/heads/master', self.socket_path)[0], 0)
+
+    def test_load_plugin(self):
+        """Plugins are reused until changed, and directories don't share modules
+        """
+        for hook_name in ['pre_receive_plugins', 'post_receive_plugins']:
+            os.mkdir(os.path.join(self.temp_dir, hook_name))
+            with open(os.path.join(self.temp_dir, hook_name, 'example.py'), 'wt') as f_plugin:
+                f_plugin.write('HOOK = {!r}\n'.format(hook_name))
+        plugin_dir = os.path.join(self.temp_dir, 'pre_receive_plugins')
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', DeprecationWarning)
+            plugin = master_pre_receive.load_plugin(plugin_dir, 'example')
+        self.assertEqual(plugin.HOOK, 'pre_receive_plugins')
+        self.assertIs(master_pre_receive.load_plugin(plugin_dir, 'example'), plugin)
+        self.assertEqual(master_pre_receive.load_plugin(os.path.join(self.temp_dir, 'post_receive_plugins'), 'example').HOOK, 'post_receive_plugins')
+        with open(os.path.join(plugin_dir, 'example.py'), 'wt') as f_plugin:
+            f_plugin.write('HOOK = "changed"\n')
+        os.utime(os.path.join(plugin_dir, 'example.py'), ns=(0, 0))
+        self.assertEqual(master_pre_receive.load_plugin(plugin_dir, 'example').HOOK, 'changed')
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""Check the htpasswd authentication plugin verifies hashes and caches verifications
+"""
+
+
+import unittest
+import os
+import sys
+import time
+import shutil
+import logging
+import tempfile
+sys.path.append(os.path.realpath(os.path.join(os.path.dirname(__file__), '..')))
+from authentication_plugins import htpasswd
+
+
+# password is 'secret' for all but geoff ('other')
+HASHES = {
+    'joe': '$2y$04$abcdefghijklmnopqrstuu2r9OfJnfCsdneAXAGHnS4UpFFP8WIrW',
+    'james': '$5$git4nginxsalt$rdDbIegmp4o4FYtXBhcrLd5S2caBZsp4NBNbVaSZXsA',
+    'sydney': '$6$rounds=5000$git4nginxsalt$KCmRLIquiRmXgYrtnL01z9qqWjfMTVFaS7SNx9cAJuO2lwic5s29En2edt5zj8icD8VyjkhGemzx3SQdRPkGg.',
+    'geoff': '$6$othersalt$eMcU/nJ8pRnR7JyhmYydf4xIZpFEZN9gbUjJ67B9PG9TZgoBq5B5mUj.2afJl1okAmT9zZv82ieToiVvvaEr50',
+}
+LOGGER = logging.getLogger('test_htpasswd')
+
+
+class UnitTestHtpasswd(unittest.TestCase):
+    """Verification, cache expiry and bounds, and file reloads
+    """
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, 'htpasswd')
+        self.write_htpasswd(HASHES)
+        self.verifies = []
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def write_htpasswd(self, hashes, mtime=None):
+        """Write the htpasswd file
+        """
+        with open(self.path, 'wt') as f_htpasswd:
+            f_htpasswd.write('# test users\n')
+            for username, password_hash in hashes.items():
+                f_htpasswd.write('{}:{}\n'.format(username, password_hash))
+        if mtime is not None:
+            os.utime(self.path, (mtime, mtime))
+
+    def cache(self, cache_size=1024, cache_ttl=300):
+        """Cache counting the (slow) hash verifications
+        """
+        cache = htpasswd.HtpasswdCache(cache_size, cache_ttl)
+        verify = cache._verify      # pylint: disable=protected-access
+        def counting_verify(logger, password, password_hash):
+            """Count verifications"""
+            self.verifies.append(password_hash)
+            return verify(logger, password, password_hash)
+        cache._verify = counting_verify     # pylint: disable=protected-access
+        return cache
+
+    @unittest.skipUnless('bcrypt' in htpasswd.VERIFIERS, "no bcrypt, bcrypt module or passlib needed")
+    def test_bcrypt(self):
+        """bcrypt ($2y$ as from htpasswd -B)
+        """
+        cache = self.cache()
+        self.assertTrue(cache.check(LOGGER, self.path, 'joe', 'secret'))
+        self.assertFalse(cache.check(LOGGER, self.path, 'joe', 'Secret'))
+
+    @unittest.skipUnless('SHA-crypt' in htpasswd.VERIFIERS, "no SHA-crypt, crypt module or passlib needed")
+    def test_sha_crypt(self):
+        """SHA-256 and SHA-512 crypt, wrong passwords and unknown users
+        """
+        cache = self.cache()
+        self.assertTrue(cache.check(LOGGER, self.path, 'james', 'secret'))
+        self.assertTrue(cache.check(LOGGER, self.path, 'sydney', 'secret'))
+        self.assertTrue(cache.check(LOGGER, self.path, 'geoff', 'other'))
+        self.assertFalse(cache.check(LOGGER, self.path, 'geoff', 'secret'))
+        self.assertFalse(cache.check(LOGGER, self.path, 'sydney', ''))
+        with self.assertLogs(LOGGER, 'WARNING'):
+            self.assertFalse(cache.check(LOGGER, self.path, 'nobody', 'secret'))
+
+    @unittest.skipUnless('SHA-crypt' in htpasswd.VERIFIERS, "no SHA-crypt, crypt module or passlib needed")
+    def test_cache(self):
+        """Verified credentials are cached until they expire, failures are not cached
+        """
+        cache = self.cache(cache_ttl=0.2)
+        for _ in range(3):
+            self.assertTrue(cache.check(LOGGER, self.path, 'sydney', 'secret'))
+            self.assertFalse(cache.check(LOGGER, self.path, 'sydney', 'wrong'))
+        self.assertEqual(len(self.verifies), 4)
+        time.sleep(0.3)
+        self.assertTrue(cache.check(LOGGER, self.path, 'sydney', 'secret'))
+        self.assertEqual(len(self.verifies), 5)
+
+    @unittest.skipUnless('SHA-crypt' in htpasswd.VERIFIERS, "no SHA-crypt, crypt module or passlib needed")
+    def test_lru(self):
+        """Least recently used credentials are dropped beyond cache_size
+        """
+        cache = self.cache(cache_size=2)
+        for username, password in [('james', 'secret'), ('sydney', 'secret'), ('james', 'secret'), ('geoff', 'other')]:
+            self.assertTrue(cache.check(LOGGER, self.path, username, password))
+        self.assertEqual(len(cache.verified), 2)
+        self.assertEqual(self.verifies, [HASHES['james'], HASHES['sydney'], HASHES['geoff']])
+        # james was used more recently than sydney
+        self.assertTrue(cache.check(LOGGER, self.path, 'james', 'secret'))
+        self.assertEqual(len(self.verifies), 3)
+        self.assertTrue(cache.check(LOGGER, self.path, 'sydney', 'secret'))
+        self.assertEqual(len(self.verifies), 4)
+
+    @unittest.skipUnless('SHA-crypt' in htpasswd.VERIFIERS, "no SHA-crypt, crypt module or passlib needed")
+    def test_reload(self):
+        """Changed htpasswd is reread, cached verifications of old hashes are not used
+        """
+        cache = self.cache()
+        self.assertTrue(cache.check(LOGGER, self.path, 'sydney', 'secret'))
+        mtime = os.stat(self.path).st_mtime
+        self.write_htpasswd(dict(HASHES, sydney=HASHES['geoff']), mtime + 10)
+        self.assertFalse(cache.check(LOGGER, self.path, 'sydney', 'secret'))
+        self.assertTrue(cache.check(LOGGER, self.path, 'sydney', 'other'))
+        self.write_htpasswd({'geoff': HASHES['geoff']}, mtime + 20)
+        with self.assertLogs(LOGGER, 'WARNING'):
+            self.assertFalse(cache.check(LOGGER, self.path, 'sydney', 'other'))
+
+    def test_missing_module(self):
+        """Plugin refuses to load if entries can't be verified (eg. Python 3.13+ without passlib)
+        """
+        verifiers = dict(htpasswd.VERIFIERS)
+        htpasswd.VERIFIERS.pop('SHA-crypt', None)
+        try:
+            with self.assertLogs(LOGGER, 'CRITICAL'):
+                with self.assertRaisesRegex(RuntimeError, 'passlib'):
+                    htpasswd.init(LOGGER, {'htpasswd': self.path})
+        finally:
+            htpasswd.VERIFIERS.clear()
+            htpasswd.VERIFIERS.update(verifiers)
+        if 'bcrypt' in htpasswd.VERIFIERS:
+            self.write_htpasswd({'joe': HASHES['joe']})
+            htpasswd.init(LOGGER, {'htpasswd': self.path, 'users': {'joe': {'groups': ['developers_group']}}})
+            self.assertEqual(
+                htpasswd.authenticate(LOGGER, {'htpasswd': self.path, 'users': {'joe': {'groups': ['developers_group']}}}, 'joe', 'secret'),
+                (True, ['developers_group'], {})
+            )
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""Check the Git LFS batch API, uploads and downloads handed to nginx
+"""
+
+
+import unittest
+import os
+import sys
+import json
+import shutil
+import hashlib
+import tempfile
+sys.path.append(os.path.realpath(os.path.join(os.path.dirname(__file__), '..')))
+import githttp
+
+
+CONFIG = """
+repo_root: {root}
+bin_path: /usr/lib/git-core/git-http-backend
+lfs:
+  accel_redirect: /git4nginx-lfs/
+  max_object_size: 1000
+authentication:
+  plugin: lookup_groups
+  plugin_config:
+    users:
+      joe:
+        groups: [developers_group]
+      geoff:
+        groups: [developers_group]
+authorisation:
+  grp:
+    .read_groups: [developers_group]
+    project.git:
+      .write_users: [joe]
+"""
+BATCH = '/grp/project.git/info/lfs/objects/batch'
+
+
+class UnitTestLFS(unittest.TestCase):
+    """LFS requests through the app
+    """
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.repo = os.path.join(self.temp_dir, 'grp', 'project.git')
+        os.makedirs(self.repo)
+        config_path = os.path.join(self.temp_dir, 'config.yaml')
+        with open(config_path, 'wt') as f_config:
+            f_config.write(CONFIG.format(root=self.temp_dir))
+        self.environ = os.environ.get('GIT4NGINX_CONFIG')
+        os.environ['GIT4NGINX_CONFIG'] = config_path
+        self.client = githttp.app.test_client()
+        self.data = b'large file contents\n'
+        self.oid = hashlib.sha256(self.data).hexdigest()
+
+    def tearDown(self):
+        if self.environ is None:
+            del os.environ['GIT4NGINX_CONFIG']
+        else:
+            os.environ['GIT4NGINX_CONFIG'] = self.environ
+        shutil.rmtree(self.temp_dir)
+
+    def batch(self, operation, user='joe', size=None):
+        """Batch request for the test object
+        """
+        response = self.client.post(BATCH, data=json.dumps({
+            'operation': operation, 'transfers': ['basic'],
+            'objects': [{'oid': self.oid, 'size': len(self.data) if size is None else size}],
+        }), environ_base={'REMOTE_USER': user})
+        if response.status_code != 200:
+            return response.status_code, None
+        self.assertEqual(response.headers['Content-Type'], 'application/vnd.git-lfs+json')
+        return response.status_code, json.loads(response.data)['objects'][0]
+
+    def test_transfers(self):
+        """Upload then download of an object
+        """
+        href = 'http://localhost/grp/project.git/info/lfs/objects/' + self.oid
+        _, result = self.batch('download')
+        self.assertEqual(result['error']['code'], 404)
+        _, result = self.batch('upload')
+        self.assertEqual(result['actions']['upload']['href'], href)
+        self.assertEqual(self.batch('upload', size=1001)[1]['error']['code'], 422)
+        self.assertEqual(self.batch('upload', user='geoff'), (403, None))
+        # corrupt upload is not stored
+        response = self.client.put(href, data=b'x' * len(self.data), environ_base={'REMOTE_USER': 'joe'})
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(os.listdir(os.path.join(self.repo, 'lfs', 'tmp')), [])
+        response = self.client.put(href, data=self.data, environ_base={'REMOTE_USER': 'joe'})
+        self.assertEqual(response.status_code, 200)
+        with open(os.path.join(self.repo, 'lfs', 'objects', self.oid[0:2], self.oid[2:4], self.oid), 'rb') as f_object:
+            self.assertEqual(f_object.read(), self.data)
+        # stored objects need no upload
+        self.assertNotIn('actions', self.batch('upload')[1])
+        _, result = self.batch('download', user='geoff')
+        self.assertEqual(result['actions']['download']['href'], href)
+        response = self.client.get(href, environ_base={'REMOTE_USER': 'geoff'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, b'')
+        self.assertEqual(
+            response.headers['X-Accel-Redirect'],
+            '/git4nginx-lfs/grp/project.git/lfs/objects/{}/{}/{}'.format(self.oid[0:2], self.oid[2:4], self.oid)
+        )
+        self.assertEqual(self.client.get(href).status_code, 401)
+        response = self.client.post('/grp/project.git/info/lfs/locks/verify', data='{}', environ_base={'REMOTE_USER': 'joe'})
+        self.assertEqual(response.status_code, 404)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
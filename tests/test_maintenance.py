@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""Check repos are maintained when due and left alone otherwise
+"""
+
+
+import unittest
+import os
+import sys
+import glob
+import shutil
+import tempfile
+sys.path.append(os.path.realpath(os.path.join(os.path.dirname(__file__), '..')))
+import maintenance
+import git_fixture
+
+
+
+
+class UnitTestMaintenance(unittest.TestCase):
+    """Maintenance passes over a repo_root
+    """
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.repo_root = os.path.join(self.temp_dir, 'repos')
+        self.repo = os.path.join(self.repo_root, 'grp', 'project.git')
+        git_fixture.init_repo(self.repo)
+        self.commits = 0
+        self.add_commits(5)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def add_commits(self, count):
+        """Loose commits, each on its own loose branch
+        """
+        parents = []
+        for number in range(count):
+            self.commits += 1
+            commit = git_fixture.commit(self.repo, str(self.commits), parents)
+            git_fixture.update_ref(self.repo, 'refs/heads/b{}'.format(number), commit)
+            parents = [commit]
+
+    def maintainer(self, **kwargs):
+        """Maintainer with state in the temp dir
+        """
+        return maintenance.Maintainer(self.repo_root, os.path.join(self.temp_dir, 'state'), cpu_budget=1.0, **kwargs)
+
+    def test_pass(self):
+        """New repo gets everything, then only after pushes once quiet
+        """
+        maintainer = self.maintainer(quiet_period=0)
+        self.assertTrue(maintainer.run_pass())
+        objects = os.path.join(self.repo, 'objects')
+        self.assertTrue(os.path.exists(os.path.join(self.repo, 'packed-refs')))
+        self.assertEqual(glob.glob(os.path.join(self.repo, 'refs', 'heads', '*')), [])
+        self.assertEqual(len(glob.glob(os.path.join(objects, 'pack', 'multi-pack-index-*.bitmap'))), 1)
+        self.assertTrue(os.path.exists(os.path.join(objects, 'info', 'commit-graph')))
+        status = maintainer.status()['grp/project.git']
+        self.assertEqual({name: task['status'] for name, task in status['tasks'].items()}, {
+            'pack-refs': 'ok', 'repack': 'ok', 'commit-graph': 'ok',
+        })
+        last_runs = {name: task['last_run'] for name, task in status['tasks'].items()}
+        # nothing changed
+        maintainer.run_pass()
+        self.assertEqual({name: task['last_run'] for name, task in maintainer.status()['grp/project.git']['tasks'].items()}, last_runs)
+        # pushed to but not yet quiet
+        self.add_commits(2)
+        maintainer.record_push('grp/project.git', 2)
+        maintainer.quiet_period = 3600
+        maintainer.run_pass()
+        status = maintainer.status()['grp/project.git']
+        self.assertEqual((status['pushes'], status['skipped']), (1, 'recent push'))
+        # push in progress
+        maintainer.quiet_period = 0
+        quarantine = os.path.join(objects, 'tmp_objdir-incoming-test')
+        os.mkdir(quarantine)
+        maintainer.run_pass()
+        self.assertEqual(maintainer.status()['grp/project.git']['skipped'], 'push in progress')
+        os.rmdir(quarantine)
+        maintainer.run_pass()
+        status = maintainer.status()['grp/project.git']
+        self.assertEqual(status['pushes'], 0)
+        self.assertNotIn('skipped', status)
+        self.assertTrue(all(status['tasks'][name]['last_run'] > last_runs[name] for name in last_runs))
+        self.assertEqual(glob.glob(os.path.join(objects, '[0-9a-f][0-9a-f]', '*')), [])
+
+
+
+if __name__ == '__main__':
+    unittest.main()
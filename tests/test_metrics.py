@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""Check metrics add up across processes
+"""
+
+
+import unittest
+import os
+import sys
+import shutil
+import tempfile
+sys.path.append(os.path.realpath(os.path.join(os.path.dirname(__file__), '..')))
+import metrics
+
+
+class UnitTestMetrics(unittest.TestCase):
+    """Values from live and exited processes are summed
+    """
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def record(self, collector, code):
+        """Record a request in a forked child (which then exits)
+        """
+        pid = os.fork()
+        if pid == 0:
+            try:
+                collector.inc('requests_total', service='git-upload-pack', code=code)
+                collector.observe('phase_seconds', 0.02, phase='authentication')
+                collector.flush()
+            finally:
+                os._exit(0)     # pylint: disable=protected-access
+        os.waitpid(pid, 0)
+
+    def test_aggregate(self):
+        """Counters and histograms sum and survive processes exiting
+        """
+        collector = metrics.Metrics(self.temp_dir)
+        collector.inc('requests_total', service='git-upload-pack', code=200)
+        collector.observe('phase_seconds', 3.0, phase='authentication')
+        collector.flush()
+        for code in [200, 200, 401]:
+            self.record(collector, code)
+        # exited processes are archived on the first scrape
+        for _ in range(2):
+            text = collector.render({'pack_cache_hits_total': ("Pack cache hits", 5)})
+            self.assertIn('git4nginx_requests_total{code="200",service="git-upload-pack"} 3\n', text)
+            self.assertIn('git4nginx_requests_total{code="401",service="git-upload-pack"} 1\n', text)
+            self.assertIn('git4nginx_phase_seconds_bucket{phase="authentication",le="0.025"} 3\n', text)
+            self.assertIn('git4nginx_phase_seconds_bucket{phase="authentication",le="+Inf"} 4\n', text)
+            self.assertIn('git4nginx_phase_seconds_count{phase="authentication"} 4\n', text)
+            self.assertIn('git4nginx_pack_cache_hits_total 5\n', text)
+            self.assertEqual(
+                sorted(name for name in os.listdir(self.temp_dir) if name.endswith('.json')),
+                sorted([metrics.ARCHIVE, os.path.basename(collector._file)])    # pylint: disable=protected-access
+            )
+        sum_line = [line for line in text.splitlines() if line.startswith('git4nginx_phase_seconds_sum')][0]
+        self.assertAlmostEqual(float(sum_line.split()[-1]), 3.06)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
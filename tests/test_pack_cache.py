@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""Check pack cache keys and eviction
+"""
+
+
+import unittest
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+sys.path.append(os.path.realpath(os.path.join(os.path.dirname(__file__), '..')))
+import pack_cache
+import git_refs
+
+
+WANT_A = 'a' * 40
+WANT_B = 'b' * 40
+
+
+def request(*lines):
+    """Request body from lines (None for flush)
+    """
+    return b''.join(git_refs.FLUSH if line is None else git_refs.pkt_line(line + '\n') for line in lines)
+
+
+class UnitTestPackCache(unittest.TestCase):
+    """Requests for the same pack share a key
+    """
+    def test_key_normalized(self):
+        """Line order and agent don't matter, wants, capabilities and refs do
+        """
+        key = pack_cache.request_key
+        base = key('/repo', '', request('want {} ofs-delta agent=git/2.39'.format(WANT_A), 'want ' + WANT_B, None, 'done'), 'f1')
+        self.assertIsNotNone(base)
+        self.assertEqual(base, key('/repo', '', request('want {} agent=git/2.45 ofs-delta'.format(WANT_B), 'want ' + WANT_A, None, 'done'), 'f1'))
+        self.assertNotEqual(base, key('/repo', '', request('want {} agent=git/2.39'.format(WANT_A), 'want ' + WANT_B, None, 'done'), 'f1'))
+        self.assertNotEqual(base, key('/repo', '', request('want {} ofs-delta agent=git/2.39'.format(WANT_A), 'want ' + WANT_B, None, 'done'), 'f2'))
+        self.assertNotEqual(base, key('/other', '', request('want {} ofs-delta agent=git/2.39'.format(WANT_A), 'want ' + WANT_B, None, 'done'), 'f1'))
+        # negotiation without a pack
+        self.assertIsNone(key('/repo', '', request('want ' + WANT_A, None, 'have ' + WANT_B), 'f1'))
+        # protocol v2 fetch only
+        self.assertIsNotNone(key('/repo', 'version=2', request('command=fetch', 'agent=git/2.39', 'want ' + WANT_A, 'done'), 'f1'))
+        self.assertIsNone(key('/repo', 'version=2', request('command=ls-refs', 'done'), 'f1'))
+        self.assertIsNone(key('/repo', '', b'garbage', 'f1'))
+
+    def test_store_and_evict(self):
+        """Entries are stored on success, checked against refs and evicted oldest first
+        """
+        temp_dir = tempfile.mkdtemp()
+        try:
+            cache = pack_cache.PackCache(temp_dir, 500)
+            for age, key in [(20, 'k1'), (10, 'k2')]:
+                writer = cache.writer(key, 'f1')
+                writer.start(200, [['Content-Type', 'application/x-git-upload-pack-result']])
+                writer.write(b'x' * 100)
+                writer.finish(True)
+                os.utime(cache.entry_path(key), (time.time() - age, time.time() - age))
+            writer = cache.writer('k3', 'f1')
+            writer.start(200, [])
+            writer.write(b'y' * 100)
+            writer.finish(False)
+            self.assertIsNone(cache.open('k3', 'f1'))
+            metadata, f_entry = cache.open('k1', 'f1')
+            with f_entry:
+                self.assertEqual(f_entry.read(), b'x' * 100)
+            self.assertEqual(metadata['status'], 200)
+            self.assertIsNone(cache.open('k2', 'f2'))
+            writer = cache.writer('k3', 'f1')
+            writer.start(200, [])
+            writer.write(b'z' * 200)
+            writer.finish(True)
+            self.assertIsNone(cache.open('k1', 'f1'))
+            self.assertIsNotNone(cache.open('k3', 'f1'))
+            stats = cache.stats()
+            self.assertEqual(stats['stores'], 3)
+            self.assertEqual(stats['evictions'], 1)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_coalesce(self):
+        """Followers stream the response of the leader as it is written
+        """
+        temp_dir = tempfile.mkdtemp()
+        try:
+            cache = pack_cache.PackCache(temp_dir, 10000000)
+            writer = cache.writer('k1', 'f1', flight=True)
+            with self.assertRaises(FileExistsError):
+                cache.writer('k1', 'f1', flight=True)
+            results = []
+            def follow():
+                """Read everything the leader writes
+                """
+                follower = cache.follow('k1')
+                results.append((follower.metadata(), b''.join(follower.iter_body())))
+                follower.close()
+            threads = [threading.Thread(target=follow) for _ in range(3)]
+            for thread in threads:
+                thread.start()
+            writer.start(200, [])
+            for count in range(20):
+                time.sleep(0.01)
+                writer.write(str(count).encode('ascii') * 1000)
+            writer.finish(True)
+            for thread in threads:
+                thread.join()
+            expected = b''.join(str(count).encode('ascii') * 1000 for count in range(20))
+            self.assertEqual([(metadata['status'], body) for metadata, body in results], [(200, expected)] * 3)
+            self.assertIsNone(cache.follow('k1'))
+            self.assertIsNotNone(cache.open('k1', 'f1'))
+            # leader failing
+            writer = cache.writer('k2', 'f1', flight=True)
+            follower = cache.follow('k2')
+            writer.start(200, [])
+            writer.write(b'partial')
+            writer.finish(False)
+            self.assertEqual(follower.metadata()['status'], 200)
+            with self.assertRaises(RuntimeError):
+                b''.join(follower.iter_body())
+            follower.close()
+            self.assertIsNone(cache.open('k2', 'f1'))
+        finally:
+            shutil.rmtree(temp_dir)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
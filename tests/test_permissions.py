@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""Check compiled PermissionIndex against the Permissions inheritance rules
+"""
+
+
+import unittest
+import os
+import sys
+import random
+import itertools
+sys.path.append(os.path.realpath(os.path.join(os.path.dirname(__file__), '..')))
+import githttp
+
+
+USERS = ['joe', 'geoff', 'sydney', 'james', 'nobody']
+GROUPS = ['developers_group', 'managers_group', 'ops_group', 'empty_group']
+
+
+def random_node(rand):
+    """Generate a node with a random selection of grants
+    """
+    node = {}
+    for key, names in [
+            ('.read_users', USERS),
+            ('.write_users', USERS),
+            ('.read_groups', GROUPS),
+            ('.write_groups', GROUPS),
+    ]:
+        if rand.random() < 0.5:
+            node[key] = rand.sample(names, rand.randint(0, 2))
+    return node
+
+
+class UnitTestPermissionIndex(unittest.TestCase):
+    """PermissionIndex must give the same result as Permissions
+    """
+    def test_matches_permissions(self):
+        """Randomly generated trees without wildcards
+        """
+        rand = random.Random(2019)
+        for _ in range(20):
+            authorisation = {}
+            for project_group in [None, 'group_a', 'group_b', 'group_c']:
+                if rand.random() < 0.2:
+                    continue
+                authorisation[project_group] = random_node(rand)
+                for project in ['one.git', 'two.git', 'three.git']:
+                    if rand.random() < 0.7:
+                        authorisation[project_group][project] = random_node(rand)
+            index = githttp.PermissionIndex(authorisation)
+            for project_group, project, username in itertools.product(
+                    [None, 'group_a', 'group_b', 'group_c', 'group_d'],
+                    ['one.git', 'two.git', 'three.git', 'four.git'],
+                    USERS,
+            ):
+                groups = rand.sample(GROUPS, rand.randint(0, 2))
+                expected = githttp.Permissions(authorisation, username, groups).get_permission(project_group, project)
+                self.assertEqual(
+                    index.get_permission(project_group, project, username, groups),
+                    expected,
+                    "{} {} {}/{}".format(username, groups, project_group, project)
+                )
+
+    def test_wildcards(self):
+        """Wildcard project groups and projects combine with exact matches
+        """
+        authorisation = {
+            'team_*': {
+                '.read_groups': ['developers_group'],
+                'lib_*.git': {
+                    '.write_users': ['joe'],
+                },
+            },
+            'team_web': {
+                'site.git': {
+                    '.write_groups': ['managers_group'],
+                },
+            },
+            None: {
+                '*.git': {
+                    '.read_users': ['geoff'],
+                },
+                'empty.git': None,
+            },
+        }
+        index = githttp.PermissionIndex(authorisation)
+        check = index.get_permission
+        self.assertEqual(check('team_web', 'site.git', 'geoff', ['developers_group']), {'read': True, 'write': False})
+        self.assertEqual(check('team_web', 'site.git', 'james', ['managers_group']), {'read': True, 'write': True})
+        self.assertEqual(check('team_db', 'lib_core.git', 'joe', []), {'read': True, 'write': True})
+        self.assertEqual(check('team_db', 'core.git', 'joe', []), {'read': False, 'write': False})
+        self.assertEqual(check('other', 'lib_core.git', 'joe', ['developers_group']), {'read': False, 'write': False})
+        self.assertEqual(check(None, 'anything.git', 'geoff', []), {'read': True, 'write': False})
+        self.assertEqual(check(None, 'empty.git', 'joe', []), {'read': False, 'write': False})
+
+    def test_invalid(self):
+        """Invalid config is rejected when compiled
+        """
+        with self.assertRaises(ValueError):
+            githttp.PermissionIndex({'group': {'.read_users': 'joe'}})
+        with self.assertRaises(ValueError):
+            githttp.PermissionIndex({'group': ['joe']})
+
+
+
+if __name__ == '__main__':
+    unittest.main()
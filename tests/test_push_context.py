@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+"""Check the push context shared by v2 hook plugins, and v1 plugins alongside
+"""
+
+
+import unittest
+import os
+import sys
+import random
+import shutil
+import logging
+import tempfile
+import subprocess
+sys.path.append(os.path.realpath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.append(os.path.realpath(os.path.join(os.path.dirname(__file__), '..', 'hooks')))
+import hook_helper
+from hook_helper import push_context
+import master_pre_receive
+import git_fixture
+
+
+ZERO = push_context.ZERO
+V1_PLUGIN = '''
+class Plugin(object):
+    def __init__(self, username, groups, user_info, plugin_config, config, inputs, project_group, project, gitwrapper):
+        self.plugin_config = plugin_config
+        self.revisions = inputs[1]
+    def run(self):
+        with open(self.plugin_config['output'], 'wt') as f_output:
+            f_output.write(' '.join(rev[2] for rev in self.revisions))
+'''
+
+
+class UnitTestPushContext(unittest.TestCase):
+    """Facts about a push, worked out once for all refs
+    """
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.repo = os.path.join(self.temp_dir, 'grp', 'project.git')
+        git_fixture.init_repo(self.repo)
+        self.commits = 0
+        self.gitwrapper = hook_helper.GitWrapper(self.repo)
+
+    def tearDown(self):
+        self.gitwrapper.close()
+        shutil.rmtree(self.temp_dir)
+
+    def commit(self, *parents):
+        """Commit (not on any ref)
+        """
+        self.commits += 1
+        return git_fixture.commit(self.repo, str(self.commits), parents)
+
+    def update_ref(self, ref, oid):
+        """Point a ref at an object
+        """
+        git_fixture.update_ref(self.repo, ref, oid)
+
+    def test_context(self):
+        """Kinds, commits, fast-forwards and new commits for a mixed push
+        """
+        base = self.commit()
+        self.update_ref('refs/heads/master', base)
+        self.update_ref('refs/heads/old', base)
+        ahead = self.commit(base)
+        other = self.commit()
+        tag = subprocess.check_output(
+            ['git', '--git-dir', self.repo, 'mktag'], env=git_fixture.GIT_ENV,
+            input='object {}\ntype commit\ntag v1\ntagger Test <test@example.com> 0 +0000\n\nv1\n'.format(ahead).encode('ascii')
+        ).decode('ascii').strip()
+        references = [
+            [base, ahead, 'refs/heads/master'],
+            [base, other, 'refs/heads/old'],
+            [ZERO, ahead, 'refs/heads/feature/new'],
+            [ZERO, tag, 'refs/tags/v1'],
+            [base, ZERO, 'refs/heads/gone'],
+            [ZERO, ahead, 'refs/notes/commits'],
+        ]
+        calls = []
+        git_run = self.gitwrapper.git_run
+        def counting_run(args, stdin='', repo_path=None):
+            calls.append(args[0])
+            return git_run(args, stdin, repo_path)
+        self.gitwrapper.git_run = counting_run
+        context = push_context.PushContext(['pre-receive'], references, self.gitwrapper, 'joe', set(), set(), 'grp', 'project.git')
+        self.assertEqual([update.kind for update in context.updates], ['branch', 'branch', 'branch', 'tag', 'branch', 'other'])
+        self.assertEqual(context.by_ref['refs/heads/feature/new'].name, 'feature/new')
+        self.assertEqual([update.ref for update in context.tags()], ['refs/tags/v1'])
+        context.fast_forwards()
+        self.assertEqual(context.by_ref['refs/tags/v1'].new_commit, ahead)
+        self.assertEqual(
+            [(update.ref, update.fast_forward) for update in context.updates if update.fast_forward is not None],
+            [('refs/heads/master', True), ('refs/heads/old', False)]
+        )
+        self.assertTrue(context.by_ref['refs/heads/gone'].is_delete)
+        self.assertEqual(context.new_commits, {ahead, other})
+        # answers are shared, not asked again
+        self.assertEqual(context.new_commits, {ahead, other})
+        self.assertEqual(context.are_ancestors([(base, ahead)]), {(base, ahead): True})
+        self.assertEqual(calls, ['rev-list'])
+
+    def test_plugins(self):
+        """branch_flow (v2) checks every ref, v1 plugins still run
+        """
+        plugin_dir = os.path.join(self.temp_dir, 'plugins')
+        os.mkdir(plugin_dir)
+        shutil.copy(master_pre_receive.plugin_dir_for('pre-receive') + '/branch_flow.py', plugin_dir)
+        with open(os.path.join(plugin_dir, 'v1_record.py'), 'wt') as f_plugin:
+            f_plugin.write(V1_PLUGIN)
+        output = os.path.join(self.temp_dir, 'v1_output')
+        config = {
+            'repo_root': self.temp_dir,
+            'hooks': {
+                '.branch_flow': {'flow': ['dev', 'test', 'master']},
+                '.v1_record': {'output': output},
+            },
+        }
+        dev = self.commit()
+        self.update_ref('refs/heads/dev', dev)
+        self.update_ref('refs/heads/test', dev)
+        not_in_dev = self.commit(dev)
+        references = [
+            # unrestricted branch first, used to stop all further checks
+            [ZERO, not_in_dev, 'refs/heads/feature'],
+            [ZERO, dev, 'refs/heads/release/test'],
+            [ZERO, not_in_dev, 'refs/heads/master'],
+        ]
+        environ = dict(os.environ)
+        cwd = os.getcwd()
+        plugin_dir_for = master_pre_receive.plugin_dir_for
+        os.environ.update(REMOTE_USER='joe', GIT4NGINX_GROUPS='[]', GIT4NGINX_INFO='{}')
+        os.chdir(self.repo)
+        master_pre_receive.plugin_dir_for = lambda hook_name: plugin_dir
+        try:
+            with self.assertLogs(level=logging.WARNING) as logs, self.assertRaises(SystemExit):
+                master_pre_receive.run(['hooks/pre-receive'], references, config)
+        finally:
+            master_pre_receive.plugin_dir_for = plugin_dir_for
+            os.chdir(cwd)
+            os.environ.clear()
+            os.environ.update(environ)
+        errors = [record.getMessage() for record in logs.records if record.levelno == logging.ERROR]
+        self.assertEqual(len(errors), 1)
+        self.assertIn("refs/heads/master: Upstream branch (test) does not contain to revision", errors[0])
+        self.assertNotIn("refs/heads/release/test:", errors[0])
+        with open(output, 'rt') as f_output:
+            self.assertEqual(f_output.read(), 'refs/heads/feature refs/heads/release/test refs/heads/master')
+
+    def test_branch_flow(self):
+        """Flow checks as rev-list old^..upstream, branch names from the last part of the ref
+        """
+        branch_flow = master_pre_receive.load_plugin(master_pre_receive.plugin_dir_for('pre-receive'), 'branch_flow')
+        plugin = branch_flow.Plugin({'flow': ['dev', 'test', 'master']}, {})
+        c1 = self.commit()
+        c2 = self.commit(c1)
+        c3 = self.commit(c2)
+        c4 = self.commit(c3)
+        not_in_test = self.commit(c2)
+        self.update_ref('refs/heads/test', c4)
+        self.update_ref('refs/heads/master', c3)
+        def check(*references):
+            """Refs rejected, and the start of the reasons"""
+            context = push_context.PushContext(['pre-receive'], references, self.gitwrapper, 'joe', set(), set(), 'grp', 'project.git')
+            return {ref: reason.split(' for ')[0] for ref, reason in plugin.check(context).items()}
+        to_reason = "Upstream branch (test) does not contain to revision"
+        from_reason = "Upstream branch (test) does not contain from revision"
+        # forward along upstream
+        self.assertEqual(check([c3, c4, 'refs/heads/master']), {})
+        # rewinds, even to commits in upstream, are not allowed
+        self.assertEqual(check([c3, c1, 'refs/heads/master']), {'refs/heads/master': to_reason})
+        self.assertEqual(check([c3, c2, 'refs/heads/master']), {'refs/heads/master': to_reason})
+        self.assertEqual(check([c3, not_in_test, 'refs/heads/master']), {'refs/heads/master': to_reason})
+        # new branch may start anywhere in upstream
+        self.assertEqual(check([ZERO, c1, 'refs/heads/release/master']), {})
+        self.assertEqual(check([ZERO, not_in_test, 'refs/heads/release/master']), {'refs/heads/release/master': to_reason})
+        # root commit has no parent to take the range from
+        self.assertEqual(check([c1, c2, 'refs/heads/master']), {'refs/heads/master': from_reason})
+        # upstream already merged below the current commit, nothing to move to
+        self.update_ref('refs/heads/test', c2)
+        self.assertEqual(check([c4, c2, 'refs/heads/master'], [c4, c3, 'refs/heads/release/master']), {
+            'refs/heads/master': from_reason, 'refs/heads/release/master': from_reason,
+        })
+        self.update_ref('refs/heads/test', c4)
+        # unrestricted and starting branches don't stop other refs being checked
+        self.assertEqual(
+            check([ZERO, not_in_test, 'refs/heads/feature'], [ZERO, not_in_test, 'refs/heads/dev'], [c3, c1, 'refs/heads/master']),
+            {'refs/heads/master': to_reason}
+        )
+        # upstream that doesn't exist yet
+        subprocess.check_call(['git', '--git-dir', self.repo, 'update-ref', '-d', 'refs/heads/test'])
+        self.assertEqual(check([ZERO, c1, 'refs/heads/master']), {'refs/heads/master': from_reason})
+
+    def test_branch_flow_rev_list(self):
+        """Batched ancestry gives the verdicts rev-list old^..upstream (less its last entry) gave
+
+        Other than for the last entry, which was refused whether or not it was
+        the current commit.
+        """
+        branch_flow = master_pre_receive.load_plugin(master_pre_receive.plugin_dir_for('pre-receive'), 'branch_flow')
+        plugin = branch_flow.Plugin({'flow': ['test', 'master']}, {})
+        rand = random.Random(2019)
+        commits = [self.commit()]
+        for _ in range(60):
+            commits.append(self.commit(*set(rand.sample(commits[-8:], min(len(commits), rand.choice([1, 1, 2]))))))
+        checked = 0
+        for _ in range(100):
+            old, new, upstream = rand.choice(commits), rand.choice(commits), rand.choice(commits)
+            self.update_ref('refs/heads/test', upstream)
+            context = push_context.PushContext(['pre-receive'], [[old, new, 'refs/heads/master']], self.gitwrapper, 'joe', set(), set(), 'grp', 'project.git')
+            reason = plugin.check(context).get('refs/heads/master', '')
+            revisions = self.gitwrapper.get_revisions([old, 'refs/heads/test'])
+            self.assertEqual('from revision' in reason, not revisions)
+            if not revisions:
+                continue
+            checked += 1
+            if revisions[-1] not in (new, old):
+                self.assertEqual('to revision' in reason, new not in revisions[:-1])
+            else:
+                self.assertEqual('to revision' in reason, new not in revisions or new == old)
+        self.assertGreater(checked, 10)
+
+    def test_branch_flow_processes(self):
+        """git processes for a push don't grow with the refs in it
+        """
+        branch_flow = master_pre_receive.load_plugin(master_pre_receive.plugin_dir_for('pre-receive'), 'branch_flow')
+        plugin = branch_flow.Plugin({'flow': ['test', 'master']}, {})
+        commits = [self.commit()]
+        for _ in range(202):
+            commits.append(self.commit(commits[-1]))
+        self.update_ref('refs/heads/test', commits[-1])
+        popen = subprocess.Popen
+        started = []
+        def counting_popen(args, *posargs, **kwargs):
+            """Count git processes"""
+            started.append(args)
+            return popen(args, *posargs, **kwargs)
+        def processes(refs):
+            """git processes started to check a push of refs updated and created"""
+            references = [[commits[number + 1], commits[number + 2], 'refs/heads/master{}/master'.format(number)] for number in range(refs)]
+            references += [[ZERO, commits[number], 'refs/heads/new{}/master'.format(number)] for number in range(refs)]
+            gitwrapper = hook_helper.GitWrapper(self.repo)
+            started.clear()
+            subprocess.Popen = counting_popen
+            try:
+                context = push_context.PushContext(['pre-receive'], references, gitwrapper, 'joe', set(), set(), 'grp', 'project.git')
+                self.assertEqual(plugin.check(context), {})
+            finally:
+                subprocess.Popen = popen
+                gitwrapper.close()
+            return len(started)
+        # first check writes the commit-graph
+        processes(1)
+        self.assertEqual(processes(200), processes(2))
+
+    def test_branch_protect(self):
+        """Restricted branches matched on the last part of the ref, by group or user
+        """
+        branch_protect = master_pre_receive.load_plugin(master_pre_receive.plugin_dir_for('pre-receive'), 'branch_protect')
+        plugin = branch_protect.Plugin({'branches': {'master': {'.write_users': ['sydney'], '.write_groups': ['managers_group']}}}, {})
+        c1 = self.commit()
+        def check(username, groups, *references):
+            """Refs rejected"""
+            context = push_context.PushContext(['pre-receive'], references, self.gitwrapper, username, set(groups), set(), 'grp', 'project.git')
+            return sorted(plugin.check(context))
+        self.assertEqual(check('joe', [], [ZERO, c1, 'refs/heads/dev']), [])
+        self.assertEqual(check('joe', [], [ZERO, c1, 'refs/heads/master'], [ZERO, c1, 'refs/heads/release/master']), ['refs/heads/master', 'refs/heads/release/master'])
+        self.assertEqual(check('sydney', [], [ZERO, c1, 'refs/heads/release/master']), [])
+        self.assertEqual(check('joe', ['managers_group'], [ZERO, c1, 'refs/heads/master']), [])
+        self.assertEqual(check('sydney', [], [ZERO, c1, 'refs/tags/master']), ['refs/tags/master'])
+
+
+
+if __name__ == '__main__':
+    unittest.main()
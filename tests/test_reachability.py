@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""Check reachability answers match git
+"""
+
+
+import unittest
+import os
+import sys
+import random
+import shutil
+import tempfile
+import subprocess
+sys.path.append(os.path.realpath(os.path.join(os.path.dirname(__file__), '..')))
+import hook_helper
+import git_fixture
+
+
+
+
+class UnitTestReachability(unittest.TestCase):
+    """Ancestry with and without commit-graph against git merge-base
+    """
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.repo = os.path.join(self.temp_dir, 'project.git')
+        git_fixture.init_repo(self.repo)
+        self.commits = []
+        self.random = random.Random(42)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def add_commits(self, count):
+        """Add commits with random parents (including merges and octopus merges)
+        """
+        for _ in range(count):
+            parents = set(self.random.sample(self.commits[-10:], min(len(self.commits), self.random.choice([1, 1, 1, 2, 3]))))
+            self.commits.append(git_fixture.commit(self.repo, str(len(self.commits)), parents))
+        git_fixture.update_ref(self.repo, 'refs/heads/master', self.commits[-1])
+
+    def is_ancestor(self, ancestor, descendant):
+        """Answer from git
+        """
+        return subprocess.call(['git', '--git-dir', self.repo, 'merge-base', '--is-ancestor', ancestor, descendant]) == 0
+
+    def check(self, write_graph, walk_limit=None):
+        """Compare answers for random pairs
+        """
+        pairs = [(self.random.choice(self.commits), self.random.choice(self.commits)) for _ in range(100)]
+        gitwrapper = hook_helper.GitWrapper(self.repo)
+        gitwrapper._reachability = hook_helper.reachability.Reachability(gitwrapper, write_graph)   # pylint: disable=protected-access
+        if walk_limit is not None:
+            gitwrapper.reachability.walk_limit = walk_limit
+        try:
+            results = gitwrapper.are_ancestors(pairs)
+            self.assertEqual(gitwrapper.are_ancestors(pairs), results)
+        finally:
+            gitwrapper.close()
+        for pair in pairs:
+            self.assertEqual(results[pair], self.is_ancestor(*pair), pair)
+        return results
+
+    def test_without_graph(self):
+        """Walking with cat-file only
+        """
+        self.add_commits(60)
+        self.check(False)
+        self.assertFalse(os.path.exists(os.path.join(self.repo, 'objects', 'info', 'commit-graph')))
+
+    def test_with_graph(self):
+        """commit-graph written when missing, then used with newer commits outside it
+        """
+        self.add_commits(60)
+        self.check(True)
+        self.assertTrue(os.path.exists(os.path.join(self.repo, 'objects', 'info', 'commit-graph')))
+        self.add_commits(30)
+        self.check(True)
+        self.check(True, walk_limit=3)
+        gitwrapper = hook_helper.GitWrapper(self.repo)
+        self.assertEqual(gitwrapper.are_ancestors([(self.commits[0], 'master'), ('master', self.commits[0]), ('missing', 'master')]), {
+            (self.commits[0], 'master'): True,
+            ('master', self.commits[0]): False,
+            ('missing', 'master'): False,
+        })
+        gitwrapper.close()
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""Check pushes are mirrored to replicas and fetches routed to replicas in step
+"""
+
+
+import unittest
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+import yaml
+sys.path.append(os.path.realpath(os.path.join(os.path.dirname(__file__), '..')))
+import replication
+import git_refs
+import git_fixture
+
+
+REPO = 'grp/project.git'
+
+
+class UnitTestReplication(unittest.TestCase):
+    """Replication between local repo roots
+    """
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.repo_root = os.path.join(self.temp_dir, 'primary')
+        self.repo = os.path.join(self.repo_root, REPO)
+        git_fixture.init_repo(self.repo)
+        self.commits = 0
+        # a file where the replica root should be, so it always fails
+        with open(os.path.join(self.temp_dir, 'broken'), 'wt'):
+            pass
+        self.replicator = replication.Replicator(self.repo_root, os.path.join(self.temp_dir, 'state'), [
+            {'name': 'disk2', 'repo_root': os.path.join(self.temp_dir, 'disk2')},
+            {'name': 'broken', 'repo_root': os.path.join(self.temp_dir, 'broken')},
+        ], read_your_writes=300, unhealthy_after=2)
+        self.ref_cache = git_refs.RefCache('/usr/lib/git-core/git-http-backend')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def commit(self):
+        """New commit on master of the primary
+        """
+        self.commits += 1
+        commit = git_fixture.commit(self.repo, str(self.commits))
+        git_fixture.update_ref(self.repo, 'refs/heads/master', commit)
+        return commit
+
+    def route(self, user):
+        """Replica a user's fetch is served from
+        """
+        replica = self.replicator.read_replica(REPO, user, lambda path: self.ref_cache.snapshot(path).fingerprint())
+        return None if replica is None else replica[0]
+
+    def test_replication(self):
+        """Push, replicate, route, fall behind and catch up
+        """
+        commit = self.commit()
+        self.replicator.record_push(REPO, 'joe')
+        self.assertEqual(self.replicator.replicate(REPO), {'disk2': True, 'broken': False})
+        replica_head = subprocess.check_output(
+            ['git', '--git-dir', os.path.join(self.temp_dir, 'disk2', REPO), 'rev-parse', 'refs/heads/master']
+        ).decode('ascii').strip()
+        self.assertEqual(replica_head, commit)
+        status = self.replicator.status()
+        self.assertEqual((status['disk2']['healthy'], status['disk2']['repos_behind']), (True, 0))
+        self.assertEqual((status['broken']['failures'], status['broken']['repos_behind']), (1, 1))
+        # the user who pushed reads from the primary, others from the replica
+        self.assertIsNone(self.route('joe'))
+        self.assertEqual(self.route('geoff'), 'disk2')
+        # primary moved on without replication (eg. replica unreachable)
+        self.commit()
+        self.replicator.record_push(REPO, 'sydney')
+        self.assertIsNone(self.route('geoff'))
+        self.assertGreater(self.replicator.status()['disk2']['lag_seconds'], 0)
+        self.replicator.sync()
+        self.assertEqual(self.route('geoff'), 'disk2')
+        status = self.replicator.status()
+        self.assertEqual(status['disk2']['repos_behind'], 0)
+        self.assertFalse(status['broken']['healthy'])
+
+    def test_queued(self):
+        """Runs for a repo only mirror to replicas behind on it
+        """
+        self.commit()
+        self.replicator.record_push(REPO, 'joe')
+        self.assertEqual(self.replicator.replicate_queued(REPO), {'disk2': True, 'broken': False})
+        self.assertEqual(self.replicator.replicate_queued(REPO), {'broken': False})
+        self.replicator.replicas.pop()
+        self.assertEqual(self.replicator.replicate_queued(REPO), {})
+
+    def test_background(self):
+        """Replication runs in a separate process, the caller doesn't wait for it
+        """
+        config_path = os.path.join(self.temp_dir, 'config.yaml')
+        with open(config_path, 'wt') as f_config:
+            yaml.safe_dump({
+                'repo_root': self.repo_root,
+                'replication': {
+                    'path': self.replicator.path,
+                    'replicas': self.replicator.replicas[:1],
+                },
+            }, f_config)
+        commit = self.commit()
+        self.replicator.record_push(REPO, 'joe')
+        environ = dict(os.environ)
+        os.environ.update(GIT4NGINX_CONFIG=config_path, GIT_DIR=self.temp_dir)
+        try:
+            replication.start_replicate(REPO)
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+        for _ in range(100):
+            if not self.replicator.behind('disk2'):
+                break
+            time.sleep(0.1)
+        self.assertEqual(self.replicator.behind('disk2'), {})
+        replica_head = subprocess.check_output(
+            ['git', '--git-dir', os.path.join(self.temp_dir, 'disk2', REPO), 'rev-parse', 'refs/heads/master']
+        ).decode('ascii').strip()
+        self.assertEqual(replica_head, commit)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""Check the repo registry follows repo_root and the listing API
+"""
+
+
+import unittest
+import os
+import sys
+import json
+import shutil
+import tempfile
+sys.path.append(os.path.realpath(os.path.join(os.path.dirname(__file__), '..')))
+import repo_registry
+import githttp
+
+
+CONFIG = """
+repo_root: {root}
+bin_path: /usr/lib/git-core/git-http-backend
+repo_registry: true
+authentication:
+  plugin: lookup_groups
+  plugin_config:
+    users:
+      joe:
+        groups: [developers_group]
+authorisation:
+  grp:
+    .read_groups: [developers_group]
+    project_2.git:
+      .write_users: [joe]
+  null:
+    top.git:
+      .read_users: [joe]
+"""
+
+
+class UnitTestRepoRegistry(unittest.TestCase):
+    """Registry contents as repos and project groups come and go
+    """
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.now = [0.0]
+        for path in ['top.git', 'other.git', 'grp/project_1.git', 'grp/project_2.git', 'grp/not_a_repo', 'empty_group']:
+            os.makedirs(os.path.join(self.temp_dir, path))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def registry(self, use_inotify):
+        """Registry with a clock we control
+        """
+        return repo_registry.RepoRegistry(self.temp_dir, 300, use_inotify, clock=lambda: self.now[0])
+
+    def check(self, registry, names):
+        """Registry has exactly these repos
+        """
+        self.assertEqual([entry[0] for entry in registry.names()], names)
+
+    def test_inotify(self):
+        """Changes are followed without scanning
+        """
+        registry = self.registry(True)
+        try:
+            self.check(registry, ['grp/project_1.git', 'grp/project_2.git', 'other.git', 'top.git'])
+            os.makedirs(os.path.join(self.temp_dir, 'grp', 'new.git'))
+            os.rmdir(os.path.join(self.temp_dir, 'other.git'))
+            os.makedirs(os.path.join(self.temp_dir, 'empty_group', 'a.git'))
+            os.makedirs(os.path.join(self.temp_dir, 'new_group', 'b.git'))
+            os.rename(os.path.join(self.temp_dir, 'grp', 'project_1.git'), os.path.join(self.temp_dir, 'grp', 'renamed.git'))
+            self.check(registry, ['empty_group/a.git', 'grp/new.git', 'grp/project_2.git', 'grp/renamed.git', 'new_group/b.git', 'top.git'])
+            # repos created inside a new group after it is watched
+            os.makedirs(os.path.join(self.temp_dir, 'new_group', 'c.git'))
+            shutil.rmtree(os.path.join(self.temp_dir, 'grp'))
+            self.check(registry, ['empty_group/a.git', 'new_group/b.git', 'new_group/c.git', 'top.git'])
+            self.assertEqual(registry.scans, 1)
+            self.assertEqual(registry.lookup('new_group', 'c.git'), os.path.join(self.temp_dir, 'new_group', 'c.git'))
+            self.assertIsNone(registry.lookup('grp', 'project_2.git'))
+        finally:
+            registry.close()
+
+    def test_rescan(self):
+        """Without inotify changes are found by rescans, and lookups check disk for new repos
+        """
+        registry = self.registry(False)
+        self.check(registry, ['grp/project_1.git', 'grp/project_2.git', 'other.git', 'top.git'])
+        os.makedirs(os.path.join(self.temp_dir, 'grp', 'new.git'))
+        os.rmdir(os.path.join(self.temp_dir, 'other.git'))
+        self.check(registry, ['grp/project_1.git', 'grp/project_2.git', 'other.git', 'top.git'])
+        self.assertEqual(registry.lookup('grp', 'new.git'), os.path.join(self.temp_dir, 'grp', 'new.git'))
+        self.assertIsNone(registry.lookup('grp', 'missing.git'))
+        self.now[0] += 300
+        self.check(registry, ['grp/new.git', 'grp/project_1.git', 'grp/project_2.git', 'top.git'])
+        self.assertEqual(registry.scans, 2)
+        self.assertEqual([entry[0] for entry in registry.names('grp/project_2.git')], ['top.git'])
+
+    def test_listing(self):
+        """Listing is filtered by authorisation and paginated
+        """
+        config_path = os.path.join(self.temp_dir, 'config.yaml')
+        with open(config_path, 'wt') as f_config:
+            f_config.write(CONFIG.format(root=self.temp_dir))
+        environ = os.environ.get('GIT4NGINX_CONFIG')
+        os.environ['GIT4NGINX_CONFIG'] = config_path
+        try:
+            client = githttp.app.test_client()
+            pages = []
+            after = None
+            while True:
+                query = {'limit': 2}
+                if after is not None:
+                    query['after'] = after
+                response = client.get('/repos', query_string=query, environ_base={'REMOTE_USER': 'joe'})
+                self.assertEqual(response.status_code, 200)
+                result = json.loads(response.data)
+                pages.append([(repo['name'], repo['write']) for repo in result['repos']])
+                after = result['next']
+                if after is None:
+                    break
+            self.assertEqual(pages, [
+                [('grp/project_1.git', False), ('grp/project_2.git', True)],
+                [('top.git', False)],
+            ])
+            response = client.get('/repos', query_string={'group': 'grp'}, environ_base={'REMOTE_USER': 'joe'})
+            self.assertEqual(len(json.loads(response.data)['repos']), 2)
+            self.assertEqual(client.get('/repos').status_code, 401)
+        finally:
+            githttp.repo_registries.pop(self.temp_dir).close()
+            if environ is None:
+                del os.environ['GIT4NGINX_CONFIG']
+            else:
+                os.environ['GIT4NGINX_CONFIG'] = environ
+
+
+
+if __name__ == '__main__':
+    unittest.main()